@@ -0,0 +1,16 @@
+"""
+gunicorn settings, used with `python -m gunicorn -c config/gunicorn.py config.wsgi`
+"""
+bind = "0.0.0.0:8000"
+workers = 4
+
+# load the application and the data in the master, the workers share its memory after forking
+preload_app = True
+
+
+def on_starting(server):
+    from sworm.warmup import try_warmup
+
+    # a broken dataset must not keep the server from starting, the workers report the failure
+    # on /ready/ and try again
+    try_warmup()
@@ -0,0 +1,161 @@
+"""
+Approximate nearest neighbors of the topic vectors of the articles.
+
+The vectors are hashed by random hyperplanes through their mean, since topic vectors are all
+non-negative: every table concatenates the signs of `bits` projections into one code, and the
+rows of every table are sorted by code, so the rows of a bucket are found by binary search. A
+query collects the rows that share a bucket with it, or with one bit flipped, in any table and
+ranks them by their exact cosine similarity. The index is built once per dataset version.
+"""
+import logging
+import time
+
+import numpy as np
+
+from sworm.bokeh_data import get_dataset
+from sworm.file_cache import load_or_build, read_arrays, write_arrays
+
+log = logging.getLogger(__name__)
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1.0)
+
+
+class LSHIndex:
+    """
+    Random hyperplane LSH index of unit vectors, see the module
+    """
+
+    def __init__(self, arrays):
+        self.planes, self.center = arrays["planes"], arrays["center"]
+        self.n_tables, self.bits = arrays["codes"].shape[0], self.planes.shape[0]
+        self.bits //= self.n_tables
+        self._set(arrays["ids"], arrays["vectors"], arrays["codes"])
+
+    @staticmethod
+    def build_arrays(ids, vectors, n_tables=8, bits=12, seed=0):
+        t0 = time.perf_counter()
+        vectors = _normalize(vectors)
+        rng = np.random.default_rng(seed)
+        planes = rng.standard_normal((n_tables * bits, vectors.shape[1])).astype(np.float32)
+        center = vectors.mean(axis=0)
+        codes = LSHIndex._hash(planes, center, vectors, n_tables)
+        log.info(
+            f"Building the LSH index of {len(vectors)} vectors took {time.perf_counter() - t0} s"
+        )
+        return {
+            "ids": np.asarray(ids, dtype=np.int64),
+            "vectors": vectors,
+            "planes": planes,
+            "center": center,
+            "codes": codes,
+        }
+
+    @staticmethod
+    def _hash(planes, center, vectors, n_tables):
+        """
+        Code of each vector per table, an array with one row per table
+        """
+        signs = ((vectors - center) @ planes.T > 0).reshape(len(vectors), n_tables, -1)
+        weights = 1 << np.arange(signs.shape[2], dtype=np.int64)
+        return (signs * weights).sum(axis=2).T.astype(np.int64)
+
+    def _set(self, ids, vectors, codes):
+        self.ids, self.vectors, self.codes = ids, vectors, codes
+        self.order = np.argsort(codes, axis=1, kind="stable")
+        self.sorted_codes = np.take_along_axis(codes, self.order, axis=1)
+        self.id_order = np.argsort(ids, kind="stable")
+        self.sorted_ids = ids[self.id_order]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def arrays(self):
+        """
+        Arrays of the index, see `build_arrays`
+        """
+        return {
+            "ids": self.ids,
+            "vectors": self.vectors,
+            "planes": self.planes,
+            "center": self.center,
+            "codes": self.codes,
+        }
+
+    def vector(self, id):
+        """
+        Vector of an article, None if it is not in the index
+        """
+        position = np.searchsorted(self.sorted_ids, id)
+        if position == len(self.sorted_ids) or self.sorted_ids[position] != id:
+            return None
+        return self.vectors[self.id_order[position]]
+
+    def _candidates(self, vector):
+        """
+        Rows in the bucket of the vector or a bucket one bit away in any table
+        """
+        codes = self._hash(self.planes, self.center, vector[None, :], self.n_tables)[:, 0]
+        flips = np.concatenate([[0], 1 << np.arange(self.bits, dtype=np.int64)])
+        rows = []
+        for table, code in enumerate(codes):
+            probes = np.sort(code ^ flips)
+            starts = np.searchsorted(self.sorted_codes[table], probes, side="left")
+            ends = np.searchsorted(self.sorted_codes[table], probes, side="right")
+            rows.extend(self.order[table, start:end] for start, end in zip(starts, ends))
+        return np.unique(np.concatenate(rows)) if rows else np.zeros(0, dtype=np.int64)
+
+    def query(self, vector, k=10, exclude=()):
+        """
+        Ids and cosine similarities of the approximately k most similar vectors in descending
+        order
+
+        :param exclude: ids to leave out, like the ids the vector was built from
+        """
+        vector = _normalize(np.asarray(vector)[None, :])[0]
+        rows = self._candidates(vector)
+        ids = self.ids[rows]
+        scores = self.vectors[rows] @ vector
+
+        if len(exclude):
+            keep = ~np.isin(ids, np.asarray(list(exclude), dtype=np.int64))
+            ids, scores = ids[keep], scores[keep]
+        if len(ids) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            ids, scores = ids[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return ids[order], scores[order]
+
+    def similar(self, ids, k=10):
+        """
+        Articles most similar to the mean of the vectors of the given articles, without them
+        """
+        vectors = [v for v in (self.vector(id) for id in ids) if v is not None]
+        if not vectors:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        return self.query(np.mean(vectors, axis=0), k, exclude=ids)
+
+
+def get_ann_index():
+    """
+    The index of the topic vectors is built once per dataset version and shared between workers
+    through the cache directory
+    """
+    dataset = get_dataset()
+
+    def build():
+        # the views import this module
+        from sworm.views import helper_load_thetas
+
+        def build_arrays():
+            df_theta = helper_load_thetas()
+            return LSHIndex.build_arrays(df_theta.index.to_numpy(np.int64), df_theta.to_numpy())
+
+        return LSHIndex(
+            load_or_build("ann", dataset.version, ".npz", build_arrays, read_arrays, write_arrays)
+        )
+
+    return dataset.cached("ann index", build)
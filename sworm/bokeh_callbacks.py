@@ -1,116 +1,475 @@
 from bokeh.models import CustomJS
+from django.conf import settings
 
+from sworm.map_density import DENSITY_RESOLUTIONS
+from sworm.map_tiles import TILE_DEPTH
 
-def input_callback(source):
+
+def details_code():
+    """
+    client side LRU cache for the article details, which are not part of the map data source
+    """
+
+    code = """
+        var sworm = window.sworm = window.sworm || {};
+
+        if (sworm.get_details === undefined) {
+            // a Map iterates in insertion order, so the first key is the least recently used one
+            sworm.details = new Map();
+            sworm.get_details = function(id) {
+                var entry = sworm.details.get(id);
+                if (entry !== undefined) {
+                    sworm.details.delete(id);
+                } else {
+                    entry = fetch('/map/article/' + id)
+                        .then(response => response.json())
+                        .catch(error => {
+                            sworm.details.delete(id);
+                            throw error;
+                        });
+                    if (sworm.details.size >= 256) {
+                        sworm.details.delete(sworm.details.keys().next().value);
+                    }
+                }
+                sworm.details.set(id, entry);
+                return entry;
+            };
+        }
+    """
+    return code
+
+
+def input_callback(source, journal_codes, topic_codes, country_codes):
     """
     slider call back for date selection, keyword search and cluster selection
+
+    Every filter has a cached mask, only the one of the widget that changed is recomputed. For
+    each row we count the filters it fails, so that only rows whose count changes between zero
+    and non-zero are hidden or shown again. Journals, topics and countries are integer codes into
+    the given mappings, the keyword search is answered by the server.
     """
 
     callback = CustomJS(
-        args=dict(source=source),
+        args=dict(
+            source=source,
+            journal_codes=journal_codes,
+            topic_codes=topic_codes,
+            country_codes=country_codes,
+        ),
         code="""
+        var sworm = window.sworm = window.sworm || {};
         var data = source.data;
         var x1 = data['x1'];
         var x2 = data['x2'];
         var x1_backup = data['x1_backup'];
         var x2_backup = data['x2_backup'];
-        var timestamp = data['timestamp'];
-
-        var abstract = data['abstract'];
-        var title = data['title'];
-        var author = data['author'];
-        var journal = data['journal'];
-        var label = data['journal'];
-        var topic = data['cluster'];
-        var citations = data['citations'];
-        var country = data['country'];
-
-        var lower_date = date_range_slider.value[0];
-        var upper_date = date_range_slider.value[1];
-        var key = text_search.value;
-        var journal_select = journal_choice.value;
-        var topic_select = topic_choice.value;
-        var country_select = country_choice.value;
-
-        var lower_citation = citation_count_slider.value[0];
-        var upper_citation = citation_count_slider.value[1];
-
-        var found = 0;
-
-        for (var i = 0; i < x1.length; i++) {
-            var select_text = true;
-
-            if(key != "") {
-                select_text = abstract[i].toLowerCase().includes(key.toLowerCase())
-                    || title[i].toLowerCase().includes(key.toLowerCase())
-                    || author[i].toLowerCase().includes(key.toLowerCase())
-                    || journal[i].toLowerCase().includes(key.toLowerCase());
+        var n = x1.length;
+
+        function categorical(codes, choice, names) {
+            // lookup table shifted by one, so rows without category (-1) are never selected
+            var lut = new Uint8Array(Object.keys(names).length + 1);
+            choice.value.forEach(value => { lut[names[value] + 1] = 1; });
+            var mask = new Uint8Array(n);
+            for (var i = 0; i < n; i++) {
+                mask[i] = lut[codes[i] + 1];
+            }
+            return mask;
+        }
+
+        function range(values, slider) {
+            var lower = slider.value[0];
+            var upper = slider.value[1];
+            var mask = new Uint8Array(n);
+            for (var i = 0; i < n; i++) {
+                mask[i] = values[i] >= lower && values[i] <= upper ? 1 : 0;
+            }
+            return mask;
+        }
+
+        var facets = {journal: [journal_choice, journal_codes],
+                      topic: [topic_choice, topic_codes],
+                      country: [country_choice, country_codes]};
+        var predicates = {
+            journal: [journal_choice, () => categorical(data['journal'], journal_choice, journal_codes)],
+            topic: [topic_choice, () => categorical(data['topic'], topic_choice, topic_codes)],
+            country: [country_choice, () => categorical(data['country'], country_choice, country_codes)],
+            date: [date_range_slider, () => range(data['timestamp'], date_range_slider)],
+            citations: [citation_count_slider, () => range(data['citations'], citation_count_slider)],
+        };
+
+        function update(name, mask) {
+            var old = sworm.masks[name];
+            var failed = sworm.failed;
+            for (var i = 0; i < n; i++) {
+                if (old[i] == mask[i]) {
+                    continue;
+                }
+                if (mask[i] == 0) {
+                    if (failed[i]++ == 0) {
+                        x1[i] = NaN;
+                        x2[i] = NaN;
+                        sworm.found--;
+                    }
+                } else if (--failed[i] == 0) {
+                    x1[i] = x1_backup[i];
+                    x2[i] = x2_backup[i];
+                    sworm.found++;
+                }
+            }
+            sworm.masks[name] = mask;
+        }
+
+        function render() {
+            text_count.text = String(sworm.found);
+            source.change.emit();
+
+            // number of rows per category that pass all other filters
+            var failed = sworm.failed;
+            for (var name in facets) {
+                var choice = facets[name][0];
+                var names = facets[name][1];
+                var codes = data[name];
+                var mask = sworm.masks[name];
+                var counts = new Uint32Array(Object.keys(names).length);
+                for (var i = 0; i < n; i++) {
+                    if (codes[i] >= 0 && failed[i] == 1 - mask[i]) {
+                        counts[codes[i]]++;
+                    }
+                }
+                choice.options = choice.options.map(
+                    option => [option[0], option[0] + " (" + counts[names[option[0]]] + ")"]
+                );
+            }
+        }
+
+        // all rows are shown initially, widget states are applied on the first change
+        var initial = sworm.masks === undefined;
+        if (initial) {
+            sworm.masks = {text: new Uint8Array(n).fill(1)};
+            for (var name in predicates) {
+                sworm.masks[name] = new Uint8Array(n).fill(1);
+            }
+            sworm.failed = new Uint8Array(n);
+            sworm.found = n;
+        }
+
+        for (var name in predicates) {
+            if (initial || cb_obj === predicates[name][0]) {
+                update(name, predicates[name][1]());
+            }
+        }
+
+        if (!initial && cb_obj !== text_search) {
+            render();
+            return;
+        }
+
+        // answers may arrive out of order while typing, only the latest one is used
+        sworm.search_request = (sworm.search_request || 0) + 1;
+        var request = sworm.search_request;
+        var key = text_search.value_input;
+        if (key == "") {
+            update('text', new Uint8Array(n).fill(1));
+            render();
+            return;
+        }
+
+        fetch('/map/filter/?' + new URLSearchParams({q: key}).toString())
+            .then(response => response.json())
+            .then(result => {
+                if (request != sworm.search_request) {
+                    return;
+                }
+                // one bit per row, most significant bit first
+                var bits = atob(result.mask);
+                var mask = new Uint8Array(n);
+                for (var i = 0; i < n; i++) {
+                    mask[i] = (bits.charCodeAt(i >> 3) >> (7 - (i & 7))) & 1;
+                }
+                update('text', mask);
+                render();
+            });
+    """,
+    )
+    return callback
+
+
+def filter_query_code():
+    """
+    query string of the server side filter for the current widget states as `query`, expects the
+    filter widgets and the code mappings as arguments
+    """
+
+    code = """
+        var sworm = window.sworm = window.sworm || {};
+
+        var params = new URLSearchParams();
+        params.set('q', text_search.value_input);
+        params.set('date_from', date_range_slider.value[0]);
+        params.set('date_to', date_range_slider.value[1]);
+        params.set('citations_from', citation_count_slider.value[0]);
+        params.set('citations_to', citation_count_slider.value[1]);
+
+        // facets without restriction are left out of the query
+        var facets = {journal: [journal_choice, journal_codes],
+                      topic: [topic_choice, topic_codes],
+                      country: [country_choice, country_codes]};
+        for (var name in facets) {
+            var choice = facets[name][0];
+            var codes = facets[name][1];
+            if (choice.value.length < choice.options.length) {
+                params.set(name, choice.value.map(value => codes[value]).join(','));
+            }
+        }
+        var query = params.toString();
+    """
+    return code
+
+
+def tile_callback(source, x_range, y_range, bounds, journal_codes, topic_codes, country_codes):
+    """
+    range and filter call back of the level of detail map, loads the tiles covering the visible
+    range with the points matching the filters, see `sworm.map_tiles`
+    """
+
+    callback = CustomJS(
+        args=dict(
+            source=source,
+            x_range=x_range,
+            y_range=y_range,
+            bounds=bounds,
+            max_zoom=TILE_DEPTH,
+            journal_codes=journal_codes,
+            topic_codes=topic_codes,
+            country_codes=country_codes,
+        ),
+        code=filter_query_code()
+        + """
+
+        if (sworm.tiles !== undefined && sworm.tiles.size > 256) {
+            sworm.tiles.clear();
+        }
+
+        // loaded tiles are only valid for the filters they were requested with
+        if (query != sworm.tile_query) {
+            sworm.tile_query = query;
+            sworm.tiles = new Map();
+
+            fetch('/map/filter/?mask=0&' + query)
+                .then(response => response.json())
+                .then(result => {
+                    if (query != sworm.tile_query) {
+                        return;
+                    }
+                    text_count.text = String(result.count);
+                    for (var name in facets) {
+                        var choice = facets[name][0];
+                        var codes = facets[name][1];
+                        var counts = result.counts[name];
+                        choice.options = choice.options.map(
+                            option => [option[0], option[0] + " (" + counts[codes[option[0]]] + ")"]
+                        );
+                    }
+                });
+        }
+
+        // zoom level at which about two tiles span the visible range
+        var width = bounds[1] - bounds[0];
+        var height = bounds[3] - bounds[2];
+        var extent = Math.max((x_range.end - x_range.start) / width,
+                              (y_range.end - y_range.start) / height);
+        var z = Math.min(max_zoom, Math.max(0, Math.floor(Math.log2(2 / extent))));
+        var n = 1 << z;
+
+        function tile(value, lower, size) {
+            return Math.min(n - 1, Math.max(0, Math.floor((value - lower) / size * n)));
+        }
+
+        var keys = [];
+        for (var x = tile(x_range.start, bounds[0], width); x <= tile(x_range.end, bounds[0], width); x++) {
+            for (var y = tile(y_range.start, bounds[2], height); y <= tile(y_range.end, bounds[2], height); y++) {
+                keys.push(z + '/' + x + '/' + y);
             }
+        }
 
-            var select_journal = journal_select.includes(journal[i]);
-            var select_topic = topic_select.includes(topic[i]);
-            var select_country = country_select.includes(country[i]);
-            var select_date = timestamp[i] >= lower_date && timestamp[i] <= upper_date;
-            var select_citations = citations[i]  >= lower_citation && citations[i] <= upper_citation;
-
-            if(select_date && select_text && select_journal && select_topic && select_citations && select_country) {
-                x1[i] = x1_backup[i];
-                x2[i] = x2_backup[i];
-                found++;
-            } else {
-                x1[i] = undefined;
-                x2[i] = undefined;
+        // answers may arrive out of order while panning, only the latest one is used
+        sworm.tile_request = (sworm.tile_request || 0) + 1;
+        var request = sworm.tile_request;
+
+        Promise.all(keys.map(key => {
+            if (!sworm.tiles.has(key)) {
+                sworm.tiles.set(key, fetch('/map/tiles/' + key + '?' + query).then(response => response.json()));
+            }
+            return sworm.tiles.get(key);
+        })).then(tiles => {
+            if (request != sworm.tile_request) {
+                return;
             }
+            var data = {};
+            for (var column of ['index', 'x1', 'x2', 'topic', 'citations']) {
+                data[column] = [].concat(...tiles.map(t => t[column]));
+            }
+            source.data = data;
+        });
+    """,
+    )
+    return callback
+
+
+def density_callback(
+    image_source,
+    image_renderer,
+    points_renderer,
+    x_range,
+    y_range,
+    bounds,
+    journal_codes,
+    topic_codes,
+    country_codes,
+):
+    """
+    range and filter call back of the density overview, shows the density image instead of the
+    points while zoomed out, see `sworm.map_density`
+    """
+
+    callback = CustomJS(
+        args=dict(
+            image_source=image_source,
+            image_renderer=image_renderer,
+            points_renderer=points_renderer,
+            x_range=x_range,
+            y_range=y_range,
+            bounds=bounds,
+            density_zoom=getattr(settings, "SWORM_MAP_DENSITY_ZOOM", 2),
+            resolutions=DENSITY_RESOLUTIONS,
+            journal_codes=journal_codes,
+            topic_codes=topic_codes,
+            country_codes=country_codes,
+        ),
+        code=filter_query_code()
+        + """
+
+        // the density image is shown until the visible range is 1 / 2^density_zoom of the map
+        var extent = Math.max((x_range.end - x_range.start) / (bounds[1] - bounds[0]),
+                              (y_range.end - y_range.start) / (bounds[3] - bounds[2]));
+        var zoom = Math.log2(1 / extent);
+        var show = zoom < density_zoom;
+        image_renderer.visible = show;
+        points_renderer.visible = !show;
+        if (!show) {
+            return;
         }
-        text_count.text = String(found);
-        source.change.emit();
 
+        var resolution = resolutions[Math.min(resolutions.length - 1, Math.max(0, Math.floor(zoom)))];
+        var key = resolution + '&' + query;
+        if (key == sworm.density_key) {
+            return;
+        }
+        sworm.density_key = key;
+
+        fetch('/map/density/?topics=1&resolution=' + resolution + '&' + query)
+            .then(response => response.json())
+            .then(result => {
+                if (key != sworm.density_key) {
+                    return;
+                }
+                var bits = atob(result.image);
+                var bytes = new Uint8Array(bits.length);
+                for (var i = 0; i < bits.length; i++) {
+                    bytes[i] = bits.charCodeAt(i);
+                }
+                // four bytes in RGBA order per pixel, rows from bottom to top
+                var pixels = new Uint32Array(bytes.buffer);
+                var image = [];
+                for (var row = 0; row < result.height; row++) {
+                    image.push(Array.from(pixels.subarray(row * result.width, (row + 1) * result.width)));
+                }
+                image_source.data = {image: [image], x: [result.x], y: [result.y],
+                                     dw: [result.dw], dh: [result.dh]};
+            });
     """,
     )
     return callback
 
 
+def debounce_callback(callback, delay=300):
+    """
+    run the callback once no change happened for `delay` milliseconds, e.g. to search only after
+    the user stopped typing
+    """
+
+    debounced = CustomJS(
+        args=dict(callback=callback, delay=delay),
+        code="""
+        var sworm = window.sworm = window.sworm || {};
+        sworm.timers = sworm.timers || {};
+        clearTimeout(sworm.timers[callback.id]);
+        sworm.timers[callback.id] = setTimeout(() => callback.execute(cb_obj, {}), delay);
+    """,
+    )
+    return debounced
+
+
+def hover_code():
+    """
+    show a preview of the hovered article
+    """
+
+    code = (
+        details_code()
+        + """
+            var indices = cb_data.index.indices;
+            if (indices.length == 0) {
+                return;
+            }
+
+            var id = source.data['index'][indices[0]];
+            sworm.hovered = id;
+
+            sworm.get_details(id).then(details => {
+                if (sworm.hovered != id) {
+                    return;
+                }
+                current_hover.text = "<b>" + details.title.replace(/<br>/g, ' ') + "</b><br>"
+                    + details.author + "<br>"
+                    + "<i>" + details.journal + ", " + details.date + "</i>";
+            });
+    """
+    )
+    return code
+
+
 def selected_code():
     """
     handle the currently selected article
     """
 
-    code = """
-            var titles = [];
-            var authors = [];
-            var journals = [];
-            var links = [];
-            var dates = [];
-            var abstracts = [];
-            var citations = [];
-            var countries = [];
-            var topics = [];
-            var ids = [];
-
-            cb_data.source.selected.indices.forEach(index => titles.push(source.data['title'][index]));
-            cb_data.source.selected.indices.forEach(index => authors.push(source.data['author'][index]));
-            cb_data.source.selected.indices.forEach(index => journals.push(source.data['journal'][index]));
-            cb_data.source.selected.indices.forEach(index => links.push(source.data['doi'][index]));
-            cb_data.source.selected.indices.forEach(index => countries.push(source.data['country'][index]));
-            cb_data.source.selected.indices.forEach(index => dates.push(source.data['date'][index]));
-            cb_data.source.selected.indices.forEach(index => abstracts.push(source.data['abstract'][index]));
-            cb_data.source.selected.indices.forEach(index => citations.push(source.data['citations'][index]));
-            cb_data.source.selected.indices.forEach(index => topics.push(source.data['topics'][index]));
-            cb_data.source.selected.indices.forEach(index => ids.push(source.data['index'][index]));
-
-            titles = "<b><a href='/article/" + ids[0].toString() + "'>" + titles[0].toString().replace(/<br>/g, ' ') + "</a></b><br>";
-            authors = "<b>Authors:</b> " + authors[0].toString() + "<br>";
-            var save_option = '<a class="btn btn-primary" href="/add/' + ids[0] + '">Add to Library</a><br>';
-            dates = "<b>Published:</b> " + dates[0].toString() + "<br>";
-            journals = "<b>Journal:</b> " + journals[0].toString() + "<br>";
-            citations = "<b>Citations:</b> " + citations[0].toString() + "<br>";
-            countries = "<b>Country:</b> " + countries[0].toString() + "<br>";
-            topics = "<b>LDA Topic(s):</b> " + topics[0].toString() + "<br>";
-            links = "<b>Link:</b> <a href='" + "https://doi.org/" + links[0].toString() + "'>" + "https://doi.org/"
-                + links[0].toString() + "</a><br>";
-            abstracts = "<p><b>Abstract: </b>" +  abstracts[0].toString() + "</p>";
-
-            current_selection.text = titles  + dates + authors + topics + journals + citations + countries + links + abstracts + save_option;
-            current_selection.change.emit();
+    code = (
+        details_code()
+        + """
+            var indices = cb_data.source.selected.indices;
+            if (indices.length == 0) {
+                return;
+            }
+
+            var id = source.data['index'][indices[0]];
+
+            sworm.get_details(id).then(details => {
+                var titles = "<b><a href='/article/" + id.toString() + "'>" + details.title.replace(/<br>/g, ' ') + "</a></b><br>";
+                var authors = "<b>Authors:</b> " + details.author + "<br>";
+                var save_option = '<a class="btn btn-primary" href="/add/' + id + '">Add to Library</a><br>';
+                var dates = "<b>Published:</b> " + details.date + "<br>";
+                var journals = "<b>Journal:</b> " + details.journal + "<br>";
+                var citations = "<b>Citations:</b> " + details.citations + "<br>";
+                var countries = "<b>Country:</b> " + details.country + "<br>";
+                var topics = "<b>LDA Topic(s):</b> " + details.topics + "<br>";
+                var links = "<b>Link:</b> <a href='" + "https://doi.org/" + details.doi + "'>" + "https://doi.org/"
+                    + details.doi + "</a><br>";
+                var abstracts = "<p><b>Abstract: </b>" +  details.abstract + "</p>";
+
+                current_selection.text = titles  + dates + authors + topics + journals + citations + countries + links + abstracts + save_option;
+                current_selection.change.emit();
+            });
     """
+    )
     return code
@@ -1,29 +1,98 @@
 """
-We add data as a module in order to avoid reloading it from disk on each new request.
+We keep the data in the process in order to avoid reloading it from disk on each new request.
+
+The data is loaded on first use by `get_dataset`, so importing the views, running management
+commands or migrations does not pay for it. `manage.py warmup` loads it ahead of time. The columns
+are memory-mapped from the columnar store, see `sworm.data_store`.
+
+When a new snapshot is published, `sworm.warmup.check_for_update` loads it in the background and
+replaces the dataset. Requests pin the dataset they started with, so they finish on it.
 
 See: https://discourse.bokeh.org/t/pre-loading-data-in-bokeh-server/4542/2
 """
 import logging
-from os.path import join, abspath, dirname
-import pandas as pd
+import threading
+import time
+from contextlib import contextmanager
+
+from sworm.data_store import open_store
 
 log = logging.getLogger(__name__)
 
-data_dir = join(abspath(join(dirname(__file__), "..")), "data")
-path = join(data_dir, "django-data.pkl")
-log.info(f"Loading data from {path}")
-df = pd.read_pickle(path)
 
-df["date"] = df["date"].apply(lambda x: x.strftime("%d.%m.%Y"))
+class Dataset:
+    """
+    Articles of one version of the data store. `df` holds the numeric and categorical columns
+    indexed by article id, the texts are read per row from `articles`.
+    """
+
+    def __init__(self, store):
+        t0 = time.perf_counter()
+        self.store = store
+        self.version, self.last_modified = store.version, store.last_modified
+        self.snapshot = store.snapshot
+
+        self.articles = store["articles"]
+        self.df = self.articles.frame(index="id")
+        self.neighbors = store["neighbors"]
+
+        self.topic_list = sorted(store["topics"].series("topic"))
+        self.journal_list = sorted(store["journals"].series("journal"))
+        self.country_list = sorted(self.df["country"].unique())
+
+        # objects derived from this version, see `cached`
+        self._cache = {}
+        self._lock = threading.RLock()
+        log.info(f"Mapping data from {store.path} took {time.perf_counter() - t0} s")
+
+    def cached(self, name, build):
+        """
+        Return the object built for this version under name, building it on first use
+        """
+        if name not in self._cache:
+            with self._lock:
+                if name not in self._cache:
+                    self._cache[name] = build()
+        return self._cache[name]
+
+
+_dataset = None
+_lock = threading.Lock()
+_pinned = threading.local()
+
+
+def get_dataset():
+    """
+    The dataset pinned by `use_dataset` in this thread, otherwise the current one
+    """
+    global _dataset
+    dataset = getattr(_pinned, "dataset", None)
+    if dataset is not None:
+        return dataset
+    if _dataset is None:
+        with _lock:
+            if _dataset is None:
+                _dataset = Dataset(open_store())
+    return _dataset
+
+
+def set_dataset(dataset):
+    global _dataset
+    _dataset = dataset
 
-path = join(data_dir, "topic-list.pkl")
-topic_list = list(pd.read_pickle(path)["topic"])
 
-path = join(data_dir, "journal-list.pkl")
-journal_list = list(pd.read_pickle(path)["journal"])
+def is_loaded():
+    return _dataset is not None
 
-country_list = list(df["country"].unique())
 
-journal_list.sort()
-country_list.sort()
-topic_list.sort()
+@contextmanager
+def use_dataset(dataset):
+    """
+    Make `get_dataset` return the given dataset in this thread
+    """
+    previous = getattr(_pinned, "dataset", None)
+    _pinned.dataset = dataset
+    try:
+        yield dataset
+    finally:
+        _pinned.dataset = previous
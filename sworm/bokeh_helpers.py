@@ -1,34 +1,343 @@
-from bokeh.models import HoverTool
+import logging
+import time
+from datetime import date
+
+import numpy as np
+import pandas as pd
+from bokeh.layouts import column, row
+from bokeh.models import (
+    ColumnDataSource,
+    CustomJS,
+    CustomJSHover,
+    DateRangeSlider,
+    Div,
+    HoverTool,
+    MultiSelect,
+    Range1d,
+    RangeSlider,
+    TapTool,
+    TextInput,
+)
+from bokeh.models.widgets import Panel, Tabs
 from bokeh.palettes import Turbo256, linear_palette
-from bokeh.transform import factor_cmap
+from bokeh.plotting import figure
+from bokeh.transform import linear_cmap
+
+import sworm.bokeh_callbacks as cb
+from sworm.map_density import DENSITY_RESOLUTIONS
+from sworm.map_tiles import tile_data
+
+log = logging.getLogger(__name__)
+
+# columns of the article data frame shipped with the map
+MAP_COLUMNS = ["x1", "x2", "x1_backup", "x2_backup", "timestamp", "citations"]
 
 
 def map_create_color_mapper(topics):
-    color_mapper = factor_cmap(
-        field_name="cluster",
+    """
+    Color by the topic codes, code i gets the i-th color of the palette
+    """
+    color_mapper = linear_cmap(
+        field_name="topic",
         palette=linear_palette(Turbo256, len(topics)),
-        factors=topics,
+        low=-0.5,
+        high=len(topics) - 0.5,
     )
     return color_mapper
 
 
-def map_create_hover_tool():
+def map_create_topic_source(topics):
+    """
+    One point per topic with its code and label that is never shown on the map. The articles only
+    carry topic codes, the legend is drawn from and the tooltip looks up labels in this source.
+    """
+    return ColumnDataSource(
+        {
+            "x1": np.full(len(topics), np.nan),
+            "x2": np.full(len(topics), np.nan),
+            "topic": np.arange(len(topics)),
+            "label": topics,
+        }
+    )
+
+
+def map_create_hover_tool(topic_source):
+    """
+    The tooltip only shows what the data source contains, a preview of the article is loaded
+    by the callback set in `map_create_layout`
+    """
     hover = HoverTool(
         tooltips=[
-            ("Title", '<div style="width:400px;">@title{safe}</div>'),
-            ("Index", "@index{safe}"),
-            ("Date", "@date{safe}"),
-            ("Author(s)", "@author{safe}"),
-            ("LDA Topics(s)", "@topics{safe}"),
-            ("Journal", "@journal{safe}"),
+            ("LDA Topic", "@topic{topic}"),
             ("Citations", "@citations"),
-            ("Country", "@country"),
-            (
-                "Abstract",
-                '<div style="width:400px;">@abstract{safe}</div>',
-            ),  # wrap abstracts
-            ("DOI", "@doi"),
         ],
+        formatters={
+            "@topic": CustomJSHover(
+                args=dict(topics=topic_source), code="return topics.data['label'][value] || ''"
+            )
+        },
         point_policy="follow_mouse",
     )
     return hover
+
+
+def map_create_source(df, journal_list, topic_list, country_list):
+    """
+    Create the data source with only the columns the scatter and the filters need. Journals,
+    topics and countries are shipped as integer codes into the given lists, details are loaded
+    per article from `endpoint_map_article`.
+    """
+    data = {column: df[column].to_numpy() for column in MAP_COLUMNS}
+    data["index"] = df.index.to_numpy(np.int64)
+    data["journal"] = map_create_codes(df["journal"], journal_list)
+    data["topic"] = map_create_codes(df["cluster"], topic_list)
+    data["country"] = map_create_codes(df["country"], country_list)
+    return ColumnDataSource(data)
+
+
+def map_create_codes(values, names):
+    """
+    Position of each value in names, -1 for values not in the list
+    """
+    return pd.Categorical(values, categories=names).codes.astype(np.int16)
+
+
+def map_create_options(values, names):
+    """
+    Options for a filter list, labeled with the number of articles. The filter callback updates
+    the numbers.
+    """
+    counts = values.value_counts()
+    return [(name, f"{name} ({counts.get(name, 0)})") for name in names]
+
+
+def map_create_density_data(density, resolution=DENSITY_RESOLUTIONS[0], mask=None):
+    """
+    Data of the density image, see `sworm.map_density`
+    """
+    x_min, x_max, y_min, y_max = density.bounds
+    return {
+        "image": [density.render(resolution, mask, by_topic=True)],
+        "x": [x_min],
+        "y": [y_min],
+        "dw": [x_max - x_min],
+        "dh": [y_max - y_min],
+    }
+
+
+def map_create_layout(df, topic_list, journal_list, country_list, tiles=None, density=None):
+    """
+    Create the bokeh map layout with all interactive components
+
+    :param tiles: `sworm.map_tiles.TileIndex`, if given the map only holds the points of the
+        visible tiles, which are loaded and filtered by the server
+    :param density: `sworm.map_density.DensityGrid`, if given the zoomed out map shows a density
+        image rendered by the server instead of the points
+    """
+    log.info("Loading data...")
+    t1 = time.perf_counter()
+
+    if tiles is None:
+        source = map_create_source(df, journal_list, topic_list, country_list)
+        ranges = {}
+    else:
+        topic_codes = map_create_codes(df["cluster"], topic_list)
+        source = ColumnDataSource(tile_data(df, tiles.tile_rows(0, 0, 0), topic_codes))
+        x_min, x_max, y_min, y_max = tiles.bounds
+        ranges = {"x_range": Range1d(x_min, x_max), "y_range": Range1d(y_min, y_max)}
+    log.info(f"Loading took: {time.perf_counter() - t1} s")
+    t2 = time.perf_counter()
+
+    color_mapper = map_create_color_mapper(topic_list)
+    topic_source = map_create_topic_source(topic_list)
+    hover = map_create_hover_tool(topic_source)
+
+    plot = figure(
+        plot_width=1800,
+        plot_height=1000,
+        tools=[hover, "pan", "wheel_zoom", "box_zoom", "reset", "save", "tap"],
+        title=None,
+        toolbar_location="above",
+        output_backend="canvas" if tiles is None else "webgl",
+        **ranges,
+    )
+
+    if density is not None:
+        image_source = ColumnDataSource(map_create_density_data(density))
+        image_renderer = plot.image_rgba(
+            image="image", x="x", y="y", dw="dw", dh="dh", source=image_source
+        )
+
+    renderer = plot.scatter(
+        source=source,
+        x="x1",
+        y="x2",
+        size=5,
+        fill_color=color_mapper,
+        line_alpha=0.3,
+        line_color="gray",
+    )
+    hover.renderers = [renderer]
+    plot.scatter(
+        source=topic_source,
+        x="x1",
+        y="x2",
+        size=5,
+        fill_color=color_mapper,
+        line_alpha=0.3,
+        line_color="gray",
+        legend_field="label",
+    )
+
+    log.info(renderer)
+
+    div_hover = Div(text="", height=75)
+    hover.callback = CustomJS(
+        args=dict(source=source, current_hover=div_hover), code=cb.hover_code()
+    )
+
+    div_info = Div(text="Click on an article for details.", height=150)
+    callback_selected = CustomJS(
+        args=dict(source=source, current_selection=div_info), code=cb.selected_code()
+    )
+    taptool = plot.select(type=TapTool)
+    taptool.callback = callback_selected
+
+    # other interactive components
+
+    journal_codes = {name: code for code, name in enumerate(journal_list)}
+    topic_codes = {name: code for code, name in enumerate(topic_list)}
+    country_codes = {name: code for code, name in enumerate(country_list)}
+    if tiles is None:
+        input_callback = cb.input_callback(source, journal_codes, topic_codes, country_codes)
+    else:
+        input_callback = cb.tile_callback(
+            source,
+            plot.x_range,
+            plot.y_range,
+            list(tiles.bounds),
+            journal_codes,
+            topic_codes,
+            country_codes,
+        )
+        for r in (plot.x_range, plot.y_range):
+            r.js_on_change("start", cb.debounce_callback(input_callback))
+            r.js_on_change("end", cb.debounce_callback(input_callback))
+    callbacks = [input_callback]
+
+    if density is not None:
+        renderer.visible = False
+        density_callback = cb.density_callback(
+            image_source,
+            image_renderer,
+            renderer,
+            plot.x_range,
+            plot.y_range,
+            list(density.bounds),
+            journal_codes,
+            topic_codes,
+            country_codes,
+        )
+        for r in (plot.x_range, plot.y_range):
+            r.js_on_change("start", cb.debounce_callback(density_callback))
+            r.js_on_change("end", cb.debounce_callback(density_callback))
+        callbacks.append(density_callback)
+
+    text_search = TextInput(title="Search:")
+    for callback in callbacks:
+        text_search.js_on_change("value_input", cb.debounce_callback(callback))
+
+    text_cout_label = Div(text="Displayed Documents:", height=25)
+    text_count = Div(text=f"{len(df)}", height=25)
+
+    date_range_slider = DateRangeSlider(
+        title="Publication Date",
+        value=(date(1959, 1, 1), date(2021, 9, 1)),
+        start=date(1959, 1, 1),
+        end=date(2021, 9, 1),
+        step=1,
+    )
+
+    citation_count_slider = RangeSlider(
+        title="Citation Count",
+        value=(0, df["citations"].max()),
+        start=0,
+        end=df["citations"].max(),
+        step=1,
+    )
+
+    journal_choice = MultiSelect(
+        value=journal_list, options=map_create_options(df["journal"], journal_list), size=25
+    )
+
+    topic_choice = MultiSelect(
+        value=topic_list, options=map_create_options(df["cluster"], topic_list), size=25
+    )
+
+    country_choice = MultiSelect(
+        value=country_list, options=map_create_options(df["country"], country_list), size=25
+    )
+
+    for callback in callbacks:
+        for widget in (
+            date_range_slider,
+            citation_count_slider,
+            journal_choice,
+            topic_choice,
+            country_choice,
+        ):
+            widget.js_on_change("value", callback)
+
+        # pass call back arguments
+        callback.args["text_search"] = text_search
+        callback.args["date_range_slider"] = date_range_slider
+        callback.args["journal_choice"] = journal_choice
+        callback.args["text_count"] = text_count
+        callback.args["topic_choice"] = topic_choice
+        callback.args["citation_count_slider"] = citation_count_slider
+        callback.args["country_choice"] = country_choice
+
+    # non interactive components
+    # title = Div(text="<h1>SWORM - Social Work Research Map</h1>")
+    filter_title = Div(text="<h2>Filter</h2>")
+    selection_title = Div(text="<h2>Selection</h2>")
+
+    # styling
+    plot.sizing_mode = "scale_both"
+    plot.margin = 5
+    plot.legend.visible = True
+    plot.legend.spacing = -7
+    plot.legend.label_text_font_size = "10px"
+    # plot.legend.orientation = "horizontal"
+    # plot.legend.location = "top_center"
+
+    plot.toolbar.autohide = True
+    # plot.legend.click_policy="hide"
+    plot.add_layout(plot.legend[0], "right")
+    plot.toolbar.logo = None
+
+    # layout
+    info_column = column([div_hover, selection_title, div_info])
+
+    journal_pane = Panel(child=journal_choice, title="Journals")
+    topic_pane = Panel(child=topic_choice, title="Topics")
+    country_pane = Panel(child=country_choice, title="Countries")
+    tab = Tabs(tabs=[journal_pane, topic_pane, country_pane])
+
+    filter_column = column(
+        [
+            filter_title,
+            row([text_cout_label, text_count]),
+            text_search,
+            date_range_slider,
+            citation_count_slider,
+            tab,
+        ]
+    )
+
+    content = row([filter_column, plot, info_column])
+    layout = column([content], name="main")
+    layout.sizing_mode = "scale_both"
+
+    log.info(f"Creating document took {time.perf_counter() - t2} s")
+    return layout
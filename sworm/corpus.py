@@ -0,0 +1,307 @@
+"""
+Import of the articles of `django-data.pkl` into the database.
+
+The import is a pipeline of three stages over batches of a bounded number of articles: the reader
+takes the rows of the memory-mapped articles table of the data store, the normalizer turns them
+into articles and the writer writes a batch with bulk operations in one transaction. Journals,
+countries and authors are resolved per batch, so memory does not grow with the corpus.
+
+The writer records an `ImportCheckpoint` with each batch it commits, an import that stopped is
+resumed from there. Every article stores a fingerprint of its imported fields, so importing a new
+export of the corpus only inserts the new articles, updates the changed ones and deletes the ones
+that are gone, and keeps the libraries of the users.
+"""
+import hashlib
+import logging
+from collections import Counter
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+from django.db import connection, transaction
+
+from sworm.models import Article, Author, Country, ImportCheckpoint, Journal
+from sworm.search import optimize_search_index
+
+log = logging.getLogger(__name__)
+
+# columns of the articles table the import reads
+COLUMNS = [
+    "id",
+    "title",
+    "abstract",
+    "date",
+    "topics",
+    "journal",
+    "journal-issn",
+    "citations",
+    "country",
+    "doi",
+    "x1",
+    "x2",
+    "author",
+    "author-id",
+]
+
+# fields written by the import besides the id
+FIELDS = [
+    "title",
+    "abstract",
+    "publish_on",
+    "lda_topics",
+    "journal",
+    "citations",
+    "country",
+    "doi",
+    "x1",
+    "x2",
+]
+
+# types numeric fields are hashed as, see `fingerprint`
+NUMBERS = {"citations": int, "x1": float, "x2": float}
+
+
+def _value(value):
+    """
+    None for missing values, the store keeps missing strings as empty strings
+    """
+    if isinstance(value, str):
+        return value or None
+    return None if pd.isna(value) else value
+
+
+def _authors(names, ids):
+    """
+    Pairs of author id and name of an article
+    """
+    if not isinstance(names, str) or not names:
+        return []
+    # TODO: change export formaty
+    names = [name.strip() for name in names.split(",")]
+    # lists of ids are padded with -1 in the store
+    return [(int(ident), name) for ident, name in zip(ids, names) if ident >= 0]
+
+
+def fingerprint(article, country, author_ids):
+    """
+    Hash of the imported fields of an article, the name of its country and the ids of its
+    authors. Only values of the export are hashed, so neither the ids the database assigns to
+    countries nor the dtypes of the export change it.
+    """
+    values = []
+    for field in FIELDS:
+        # the journal is hashed by its issn, which is the value of the export
+        attname = Article._meta.get_field(field).attname
+        value = country if field == "country" else getattr(article, attname)
+        if value is not None and field in NUMBERS:
+            value = NUMBERS[field](value)
+        values.append(value)
+    return hashlib.sha1(repr(values + [[int(ident) for ident in author_ids]]).encode()).hexdigest()
+
+
+def read_articles(table, start=0, batch_size=5000):
+    """
+    Reader: yields the position and the rows of each batch of the articles table of the store
+
+    :param start: position of the first row to read
+    """
+    for begin in range(start, table.n_rows, batch_size):
+        rows = np.arange(begin, min(begin + batch_size, table.n_rows))
+        yield begin, pd.DataFrame({column: table.series(column, rows) for column in COLUMNS})
+
+
+def normalize_articles(frame):
+    """
+    Normalizer: the articles of a batch of rows, each with its journal name, country name and the
+    pairs of id and name of its authors. Articles without a journal are skipped.
+    """
+    batch = []
+    # itertuples renames columns that are no identifiers
+    frame = frame.rename(columns={"journal-issn": "issn", "author-id": "author_ids"})
+    for row in frame.itertuples(index=False):
+        # the store keeps a missing issn as empty string
+        if not isinstance(row.issn, str) or not row.issn:
+            log.error(f"Skipping article {row.id} with broken issn {row.issn}")
+            continue
+        article = Article(
+            id=int(row.id),
+            title=row.title,
+            abstract=row.abstract,
+            publish_on=pd.Timestamp(row.date).date(),
+            lda_topics=_value(row.topics),
+            journal_id=row.issn,
+            citations=_value(row.citations),
+            doi=_value(row.doi),
+            x1=_value(row.x1),
+            x2=_value(row.x2),
+        )
+        authors = _authors(row.author, row.author_ids)
+        batch.append((article, row.journal, _value(row.country), authors))
+    return batch
+
+
+def _create_journals(batch):
+    names = {article.journal_id: name for article, name, _, _ in batch}
+    existing = set(Journal.objects.filter(issn__in=names).values_list("issn", flat=True))
+    Journal.objects.bulk_create(
+        [Journal(issn=issn, name=name) for issn, name in names.items() if issn not in existing]
+    )
+
+
+def _create_countries(batch):
+    """
+    Id of every country of the batch by name
+    """
+    names = {country for _, _, country, _ in batch if country is not None}
+    countries = dict(Country.objects.filter(name__in=names).values_list("name", "id"))
+    missing = sorted(names - set(countries))
+    if missing:
+        next_id = (Country.objects.order_by("-id").values_list("id", flat=True).first() or 0) + 1
+        new = [Country(id=next_id + i, name=name) for i, name in enumerate(missing)]
+        Country.objects.bulk_create(new)
+        countries.update((country.name, country.id) for country in new)
+    return countries
+
+
+def _create_authors(batch):
+    """
+    Create the authors of the batch that do not exist yet, the first name found for an id is used
+    """
+    names = {}
+    conflicts = 0
+    for _, _, _, authors in batch:
+        for ident, name in authors:
+            if names.setdefault(ident, name) != name:
+                conflicts += 1
+    if conflicts:
+        log.warning(f"Found {conflicts} author names that differ from the first name of the id")
+
+    existing = set(Author.objects.filter(id__in=names).values_list("id", flat=True))
+    Author.objects.bulk_create(
+        [Author(id=ident, name=name) for ident, name in names.items() if ident not in existing]
+    )
+
+
+def write_articles(batch):
+    """
+    Writer: insert the new and update the changed articles of a normalized batch and their links
+    to the authors, returns the number of inserted, updated and unchanged articles. Has to run in
+    a transaction.
+    """
+    Link = Article.authors.through
+    _create_journals(batch)
+    countries = _create_countries(batch)
+    _create_authors(batch)
+
+    ids = [article.id for article, _, _, _ in batch]
+    existing = dict(Article.objects.filter(id__in=ids).values_list("id", "fingerprint"))
+    new, changed, links = [], [], []
+    for article, _, country, authors in batch:
+        article.country_id = countries.get(country)
+        author_ids = [ident for ident, _ in authors]
+        article.fingerprint = fingerprint(article, country, author_ids)
+        if article.id not in existing:
+            new.append(article)
+        elif existing[article.id] != article.fingerprint:
+            changed.append(article)
+        else:
+            continue
+        links.extend(Link(article_id=article.id, author_id=ident) for ident in author_ids)
+
+    # the links go first, so that the search index gets the authors of a new article along with
+    # it, foreign keys are checked at the end of the transaction
+    Link.objects.filter(article_id__in=[article.id for article in changed]).delete()
+    Link.objects.bulk_create(links, ignore_conflicts=True)
+    Article.objects.bulk_create(new)
+    update_articles(changed)
+    return {
+        "inserted": len(new),
+        "updated": len(changed),
+        "unchanged": len(batch) - len(new) - len(changed),
+    }
+
+
+def update_articles(articles):
+    """
+    Write the imported fields of existing articles with one prepared statement, which is much
+    faster than the CASE expressions of `bulk_update`
+    """
+    fields = [Article._meta.get_field(field) for field in FIELDS + ["fingerprint"]]
+    quote = connection.ops.quote_name
+    columns = ", ".join(f"{quote(field.column)} = %s" for field in fields)
+    sql = (
+        f"UPDATE {quote(Article._meta.db_table)} SET {columns} "
+        f"WHERE {quote(Article._meta.pk.column)} = %s"
+    )
+    params = [
+        [field.get_db_prep_save(getattr(article, field.attname), connection) for field in fields]
+        + [article.pk]
+        for article in articles
+    ]
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+
+
+def delete_articles(ids, batch_size=5000):
+    """
+    Delete the articles that are not in the given ids, returns their number
+    """
+    ids = np.sort(ids)
+    stored = Article.objects.order_by("id").values_list("id", flat=True)
+    stored = stored.iterator(chunk_size=batch_size)
+    gone = []
+    while True:
+        chunk = np.fromiter(islice(stored, batch_size), dtype=np.int64)
+        if len(chunk) == 0:
+            break
+        # the ids are sorted like the chunk, only the ones in its range can match
+        start = np.searchsorted(ids, chunk[0], side="left")
+        end = np.searchsorted(ids, chunk[-1], side="right")
+        gone.extend(chunk[~np.isin(chunk, ids[start:end])].tolist())
+    for start in range(0, len(gone), batch_size):
+        with transaction.atomic():
+            Article.objects.filter(id__in=gone[start : start + batch_size]).delete()
+    return len(gone)
+
+
+def import_corpus(store, batch_size=5000, delete=True, restart=False):
+    """
+    Import the articles of a data store into the database, resuming an import of the same store
+    that stopped. Yields the number of inserted, updated, unchanged and deleted articles so far
+    after each batch.
+
+    :param store: `sworm.data_store.Store`
+    :param delete: delete the articles that are not in the store
+    :param restart: start from the first article even if there is a checkpoint
+    """
+    table = store["articles"]
+    # imports of other versions are superseded
+    ImportCheckpoint.objects.exclude(source=store.version).delete()
+    checkpoint, _ = ImportCheckpoint.objects.get_or_create(source=store.version)
+    if restart:
+        checkpoint.position = checkpoint.inserted = checkpoint.updated = checkpoint.unchanged = 0
+    elif checkpoint.position:
+        log.info(f"Resuming the import of {store.version} at article {checkpoint.position}")
+
+    counts = Counter(
+        inserted=checkpoint.inserted,
+        updated=checkpoint.updated,
+        unchanged=checkpoint.unchanged,
+        deleted=0,
+    )
+    for start, frame in read_articles(table, checkpoint.position, batch_size):
+        batch = normalize_articles(frame)
+        with transaction.atomic():
+            counts.update(write_articles(batch))
+            checkpoint.position = start + len(frame)
+            checkpoint.inserted = counts["inserted"]
+            checkpoint.updated = counts["updated"]
+            checkpoint.unchanged = counts["unchanged"]
+            checkpoint.save()
+        yield counts
+
+    if delete:
+        counts["deleted"] = delete_articles(table["id"], batch_size)
+    optimize_search_index()
+    checkpoint.delete()
+    yield counts
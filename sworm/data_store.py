@@ -0,0 +1,528 @@
+"""
+Columnar store of the dataset.
+
+The pickles in `data/` are converted once into one `.npy` file per column and part, described by
+a manifest with the checksum of every file. Workers memory-map the files read-only, so they all
+share the pages of the page cache instead of holding private copies of the data, and opening the
+store only reads the manifest.
+
+Strings are stored like arrow does: the utf-8 bytes of all values and the offset of each value.
+Missing strings are stored as empty strings. Lists of non-negative integers, like the rows of the
+nearest neighbors of the articles, are stored as int32 matrix with one row per list, padded
+with -1. The TF-IDF matrix is stored as the parts of a CSR matrix with the norm of every row, so
+that workers score it without unpickling it.
+
+New exports are published as snapshots `data/v<N>/` holding the pickles, the symbolic link
+`data/current` points to the snapshot in use and is replaced atomically. Without snapshots, the
+pickles are read from `data/` itself.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from datetime import datetime, timezone
+from os.path import abspath, dirname, getsize, isdir, join, lexists, realpath
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+log = logging.getLogger(__name__)
+
+data_dir = join(abspath(join(dirname(__file__), "..")), "data")
+store_dir = join(data_dir, "store")
+current_link = join(data_dir, "current")
+
+# pickles the recommenders are fitted on, read as they are, the TF-IDF matrix is also converted
+django_theta_file = "django-theta.pkl"
+django_tfidf_file = "django-articles-tfidf.pkl"
+
+# pickles converted into the tables of the store
+SOURCES = {
+    "articles": "django-data.pkl",
+    "topics": "topic-list.pkl",
+    "journals": "journal-list.pkl",
+    "neighbors": "nn-tfidf.pkl",
+    "tfidf": django_tfidf_file,
+}
+
+ID_PREFIX = "SCOPUS_ID:"
+
+# layout of the store, stores of other formats are rebuilt
+STORE_FORMAT = 5
+
+
+def data_version(paths):
+    """
+    Fingerprint the given files by path, size and modification time, so that the result changes
+    whenever one of them is replaced. Also returns the latest modification time.
+    """
+    h = hashlib.sha1()
+    last_modified = 0.0
+    for p in paths:
+        stat = os.stat(p)
+        h.update(f"{p}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        last_modified = max(last_modified, stat.st_mtime)
+    return h.hexdigest()[:16], last_modified
+
+
+def current_snapshot():
+    """
+    Directory of the snapshot `data/current` points to, `data/` if there are no snapshots
+    """
+    return realpath(current_link) if lexists(current_link) else data_dir
+
+
+def is_published(directory):
+    """
+    Whether the directory is a published snapshot or the data the workers read, which must not
+    change
+    """
+    published = [join(data_dir, f"v{number}") for number in snapshots()] + [current_snapshot()]
+    return realpath(directory) in {realpath(path) for path in published}
+
+
+def source_version(snapshot):
+    # the ids of the rows of the TF-IDF matrix are read from the thetas
+    names = [*SOURCES.values(), django_theta_file]
+    return data_version([join(snapshot, name) for name in names])
+
+
+def snapshots():
+    """
+    Numbers of the published snapshots in ascending order
+    """
+    numbers = []
+    for name in os.listdir(data_dir):
+        if name.startswith("v") and name[1:].isdigit() and isdir(join(data_dir, name)):
+            numbers.append(int(name[1:]))
+    return sorted(numbers)
+
+
+def activate_snapshot(number):
+    """
+    Point `data/current` to snapshot `v<number>`, workers pick it up with their next requests
+    """
+    name = f"v{number}"
+    if not isdir(join(data_dir, name)):
+        raise ValueError(f"There is no snapshot {name}")
+    tmp = join(data_dir, f".current-{os.getpid()}")
+    if lexists(tmp):
+        os.remove(tmp)
+    os.symlink(name, tmp)
+    os.replace(tmp, current_link)
+    log.info(f"Activated snapshot {name}")
+
+
+def publish_snapshot(source, files=None):
+    """
+    Copy the pickles from the source directory into the next snapshot and return its number.
+    The snapshot is written to a temporary directory which is renamed when complete.
+
+    :param files: names of the files to copy, by default all pickles in source
+    """
+    if files is None:
+        files = [name for name in os.listdir(source) if name.endswith(".pkl")]
+    missing = {*SOURCES.values(), django_theta_file} - set(files)
+    if missing:
+        raise ValueError(f"Snapshot is missing {', '.join(sorted(missing))}")
+
+    number = (snapshots() or [0])[-1] + 1
+    tmp = tempfile.mkdtemp(dir=data_dir, prefix=".snapshot-")
+    try:
+        for name in files:
+            shutil.copy2(join(source, name), join(tmp, name))
+        os.chmod(tmp, 0o755)
+        os.rename(tmp, join(data_dir, f"v{number}"))
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return number
+
+
+def _checksum(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _load(path):
+    try:
+        return np.load(path, mmap_mode="r")
+    except ValueError:
+        # empty arrays can not be mapped
+        return np.load(path)
+
+
+class StringColumn:
+    """
+    Strings stored as utf-8 bytes with the offset of each of them
+    """
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @staticmethod
+    def encode(values):
+        encoded = [value.encode() for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return {"offsets": offsets, "data": data}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        return bytes(self.data[self.offsets[row] : self.offsets[row + 1]]).decode()
+
+    def take(self, rows):
+        return [self[row] for row in rows]
+
+
+class ListColumn:
+    """
+    Lists of numbers stored as one array of all values with the offset of each list
+    """
+
+    def __init__(self, offsets, values):
+        self.offsets = offsets
+        self.values = values
+
+    @staticmethod
+    def encode(values):
+        arrays = [np.asarray(value) for value in values]
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(array) for array in arrays], out=offsets[1:])
+        flat = np.concatenate(arrays) if arrays else np.zeros(0)
+        if flat.dtype == object or len(flat) == 0:
+            flat = flat.astype(np.int64)
+        return {"offsets": offsets, "values": flat}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        return self.values[self.offsets[row] : self.offsets[row + 1]]
+
+    def take(self, rows):
+        return [self[row] for row in rows]
+
+
+def _encode_matrix(lists):
+    """
+    Lists as int32 matrix with one row per list, shorter lists are padded with -1. None if the
+    values are not all integers from 0 to 2^31 - 1.
+    """
+    arrays = [np.asarray(value) for value in lists]
+    flat = np.concatenate(arrays) if arrays else np.zeros(0)
+    if len(flat) == 0 or flat.dtype.kind not in "iu" or flat.min() < 0 or flat.max() >= 2**31:
+        return None
+    matrix = np.full((len(arrays), max(len(array) for array in arrays)), -1, dtype=np.int32)
+    for row, array in enumerate(arrays):
+        matrix[row, : len(array)] = array
+    return matrix
+
+
+def _encode_column(values):
+    """
+    Kind and parts of a column
+
+    :param values: `pd.Series`
+    """
+    if values.dtype != object:
+        array = values.to_numpy()
+        # pandas attaches metadata to datetime dtypes, which npy files can not hold
+        return "numeric", {"values": array.view(np.dtype(array.dtype.str))}
+
+    present = values.dropna()
+    if len(present) and present.map(lambda v: isinstance(v, (list, tuple, np.ndarray))).all():
+        lists = [v if isinstance(v, (list, tuple, np.ndarray)) else [] for v in values]
+        matrix = _encode_matrix(lists)
+        if matrix is not None:
+            return "matrix", {"values": matrix}
+        return "list", ListColumn.encode(lists)
+
+    strings = values.map(lambda v: "" if pd.isna(v) else str(v))
+    categorical = pd.Categorical(values.where(values.isna(), strings))
+    if len(categorical.categories) * 10 <= len(values):
+        codes = categorical.codes.astype(
+            np.int16 if len(categorical.categories) < 2**15 else np.int32
+        )
+        categories = StringColumn.encode(categorical.categories)
+        return "category", {
+            "codes": codes,
+            **{f"categories_{p}": a for p, a in categories.items()},
+        }
+
+    return "string", StringColumn.encode(strings)
+
+
+class Table:
+    """
+    Columns of one table of the store
+    """
+
+    def __init__(self, path, name, spec):
+        self.path = path
+        self.name = name
+        self.n_rows = spec["rows"]
+        # rows and columns of the table, of the matrix for the TF-IDF table
+        self.shape = tuple(spec["shape"])
+        self.kinds = {column: c["kind"] for column, c in spec["columns"].items()}
+        # mapped right away, so the table stays usable when a newer store replaces its files
+        self.parts = {
+            column: {part: _load(join(path, f)) for part, f in c["parts"].items()}
+            for column, c in spec["columns"].items()
+        }
+        self._columns = {}
+
+    def __contains__(self, column):
+        return column in self.kinds
+
+    def __getitem__(self, column):
+        """
+        Numeric and matrix columns are memory-mapped arrays, categorical columns `pd.Categorical`,
+        string and list columns `StringColumn` and `ListColumn`
+        """
+        if column not in self._columns:
+            parts = self.parts[column]
+            kind = self.kinds[column]
+            if kind in ("numeric", "matrix"):
+                self._columns[column] = parts["values"]
+            elif kind == "category":
+                categories = StringColumn(parts["categories_offsets"], parts["categories_data"])
+                self._columns[column] = pd.Categorical.from_codes(
+                    parts["codes"], categories.take(range(len(categories)))
+                )
+            elif kind == "list":
+                self._columns[column] = ListColumn(parts["offsets"], parts["values"])
+            else:
+                self._columns[column] = StringColumn(parts["offsets"], parts["data"])
+        return self._columns[column]
+
+    def series(self, column, rows=None):
+        """
+        Column as `pd.Series`, string and list columns are decoded, which is slow for many rows
+        """
+        values = self[column]
+        if rows is None:
+            rows = np.arange(self.n_rows)
+        if isinstance(values, (StringColumn, ListColumn)):
+            return pd.Series(values.take(rows), dtype=object)
+        if self.kinds[column] == "matrix":
+            return pd.Series(list(values[rows]), dtype=object)
+        return pd.Series(values[rows])
+
+    def frame(self, index=None):
+        """
+        Data frame of the numeric and categorical columns, numeric columns share the memory of the
+        mapped files
+        """
+        columns = {
+            column: self[column]
+            for column, kind in self.kinds.items()
+            if kind in ("numeric", "category") and column != index
+        }
+        index = pd.Index(self[index], name=index) if index else None
+        return pd.DataFrame(columns, index=index, copy=False)
+
+    def find(self, value, column="id"):
+        """
+        Row of a value of a sorted numeric column
+        """
+        values = self[column]
+        row = np.searchsorted(values, value)
+        if row == len(values) or values[row] != value:
+            raise KeyError(value)
+        return int(row)
+
+
+class Store:
+    """
+    Tables of one version of the dataset
+    """
+
+    def __init__(self, path):
+        with open(join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        self.path = path
+        self.version = manifest["version"]
+        self.last_modified = manifest["last_modified"]
+        self.snapshot = manifest["snapshot"]
+        self.files = manifest["files"]
+
+        # cheap check for truncated files, `verify` compares the checksums
+        for f, spec in self.files.items():
+            if getsize(join(path, f)) != spec["size"]:
+                raise ValueError(f"Size of {f} in {path} does not match the manifest")
+
+        self.tables = {name: Table(path, name, spec) for name, spec in manifest["tables"].items()}
+
+    def __getitem__(self, name):
+        return self.tables[name]
+
+    def verify(self):
+        """
+        Compare the checksums of all files with the manifest
+        """
+        broken = [
+            f for f, spec in self.files.items() if _checksum(join(self.path, f)) != spec["sha256"]
+        ]
+        if broken:
+            raise ValueError(f"Checksums of {', '.join(broken)} in {self.path} do not match")
+
+
+def _read_source(name, path):
+    """
+    Read a pickle as data frame with the columns of its table
+    """
+    obj = pd.read_pickle(path)
+    if name == "articles":
+        ids = obj.index.astype(str).str.replace(ID_PREFIX, "", regex=False).astype(np.int64)
+        obj = obj.reset_index(drop=True)
+        obj.insert(0, "id", ids.to_numpy())
+    elif name == "neighbors":
+        obj = pd.DataFrame(_read_neighbors(obj))
+    return obj
+
+
+def _read_neighbors(obj):
+    """
+    Sorted article ids and the rows of the nearest neighbors of each article in that order, the
+    first neighbor is the article itself. Rows are used since the ids do not fit into int32.
+
+    :param obj: ids and rows as written by `sworm.neighbors.write_neighbors`, or maps each
+        article id to the ids of its neighbors
+    """
+    if isinstance(obj, dict) and "neighbors" in obj:
+        return {"id": obj["ids"], "neighbors": list(obj["neighbors"])}
+
+    ids = np.array(sorted(obj), dtype=np.int64)
+    neighbors = []
+    for i in ids:
+        others = np.asarray(obj[i], dtype=np.int64)
+        rows = np.searchsorted(ids, others).clip(max=len(ids) - 1)
+        # neighbors that are not in the table are dropped
+        neighbors.append(rows[ids[rows] == others])
+    return {"id": ids, "neighbors": neighbors}
+
+
+def _tfidf_columns(snapshot):
+    """
+    Columns of the TF-IDF matrix: the article id of every row, which are the rows of the thetas,
+    the terms and weights of every row as list columns sharing the offsets, which are the parts
+    of the CSR matrix, and the norm of every row
+    """
+    with open(join(snapshot, django_tfidf_file), "rb") as f:
+        X = sparse.csr_matrix(pickle.load(f))
+    X.sort_indices()
+    ids = pd.read_pickle(join(snapshot, django_theta_file)).index
+    ids = ids.astype(str).str.replace(ID_PREFIX, "", regex=False).astype(np.int64).to_numpy()
+    norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel())
+    columns = {
+        "id": ("numeric", {"values": ids}),
+        "norm": ("numeric", {"values": norms}),
+        "terms": ("list", {"offsets": X.indptr, "values": X.indices}),
+        "weights": ("list", {"offsets": X.indptr, "values": X.data}),
+    }
+    return X.shape, columns
+
+
+def tfidf_matrix(table):
+    """
+    TF-IDF matrix of the tfidf table of a store as CSR matrix of the mapped parts, see
+    `_tfidf_columns`
+    """
+    terms, weights = table["terms"], table["weights"]
+    return sparse.csr_matrix(
+        (weights.values, terms.values, terms.offsets), shape=tuple(table.shape), copy=False
+    )
+
+
+def build_store(path, snapshot, version, last_modified):
+    """
+    Convert the pickles of a snapshot into a store at path. The files are written to a temporary
+    directory which is renamed when complete.
+    """
+    t0 = time.perf_counter()
+    tmp = tempfile.mkdtemp(dir=dirname(path), prefix=".build-")
+    try:
+        files, tables = {}, {}
+        for name, source in SOURCES.items():
+            if name == "tfidf":
+                shape, encoded = _tfidf_columns(snapshot)
+            else:
+                frame = _read_source(name, join(snapshot, source))
+                shape = (len(frame), len(frame.columns))
+                encoded = {column: _encode_column(frame[column]) for column in frame.columns}
+            columns = {}
+            for column, (kind, parts) in encoded.items():
+                columns[column] = {"kind": kind, "parts": {}}
+                for part, array in parts.items():
+                    f = f"{name}.{column}.{part}.npy"
+                    np.save(join(tmp, f), array, allow_pickle=False)
+                    files[f] = {"size": getsize(join(tmp, f)), "sha256": _checksum(join(tmp, f))}
+                    columns[column]["parts"][part] = f
+            tables[name] = {"rows": shape[0], "shape": list(shape), "columns": columns}
+
+        manifest = {
+            "format": STORE_FORMAT,
+            "version": version,
+            "last_modified": last_modified,
+            "snapshot": snapshot,
+            "created": datetime.now(timezone.utc).isoformat(),
+            "sources": SOURCES,
+            "tables": tables,
+            "files": files,
+        }
+        with open(join(tmp, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.chmod(tmp, 0o755)
+        os.rename(tmp, path)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    log.info(f"Building data store {path} took {time.perf_counter() - t0} s")
+
+
+def _store_format(path):
+    try:
+        with open(join(path, "manifest.json")) as f:
+            return json.load(f).get("format")
+    except OSError:
+        return None
+
+
+def open_store(snapshot=None):
+    """
+    Open the store of a snapshot, converting its pickles first if needed. Only one worker
+    converts, the others wait for the lock. Stores of other versions are removed, workers still
+    using them keep their mapped files.
+
+    :param snapshot: directory of the pickles, the current snapshot by default
+    """
+    snapshot = snapshot or current_snapshot()
+    version, last_modified = source_version(snapshot)
+    path = join(store_dir, version)
+    os.makedirs(store_dir, exist_ok=True)
+
+    with open(join(store_dir, "store.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if _store_format(path) != STORE_FORMAT:
+            shutil.rmtree(path, ignore_errors=True)
+            build_store(path, snapshot, version, last_modified)
+            for stale in os.listdir(store_dir):
+                if stale not in (version, "store.lock"):
+                    log.info(f"Removing stale data store {stale}")
+                    shutil.rmtree(join(store_dir, stale), ignore_errors=True)
+
+    return Store(path)
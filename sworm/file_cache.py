@@ -0,0 +1,66 @@
+"""
+Files derived from the dataset, built once and shared between workers through `data/cache/`.
+"""
+import fcntl
+import glob
+import logging
+import os
+import tempfile
+from os.path import join
+
+import numpy as np
+
+from sworm.data_store import data_dir
+
+log = logging.getLogger(__name__)
+
+cache_dir = join(data_dir, "cache")
+
+
+def load_or_build(name, key, suffix, build, read, write):
+    """
+    Read `<name>-<key><suffix>` from the cache directory or build and write it, if it does not
+    exist. Only one worker builds, the others wait for the lock and read its result. Files of
+    other keys are removed.
+
+    :param build: callable returning the object
+    :param read: callable loading the object from a path
+    :param write: callable writing the object to a binary file
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = join(cache_dir, f"{name}-{key}{suffix}")
+
+    with open(join(cache_dir, f"{name}.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            obj = read(path)
+            log.info(f"Loaded {path}")
+            return obj
+        except (OSError, ValueError):
+            pass
+
+        obj = build()
+        _write(path, obj, write)
+
+        for stale in glob.glob(join(cache_dir, f"{name}-*{suffix}")):
+            if stale != path:
+                log.info(f"Removing stale {stale}")
+                os.remove(stale)
+
+    return obj
+
+
+def _write(path, obj, write):
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        write(f, obj)
+    os.replace(tmp, path)
+
+
+def read_arrays(path):
+    with np.load(path) as arrays:
+        return dict(arrays)
+
+
+def write_arrays(f, arrays):
+    np.savez(f, **arrays)
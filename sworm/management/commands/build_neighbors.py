@@ -0,0 +1,65 @@
+import pickle
+import time
+from os.path import join
+
+import pandas as pd
+from django.core.management.base import BaseCommand, CommandError
+
+from sworm.data_store import (
+    ID_PREFIX,
+    SOURCES,
+    django_tfidf_file,
+    django_theta_file,
+    is_published,
+)
+from sworm.neighbors import build_neighbors, sort_neighbors, write_neighbors
+
+
+class Command(BaseCommand):
+    help = (
+        "Find the nearest neighbors of all articles by the cosine similarity of their TF-IDF "
+        "rows and write them to nn-tfidf.pkl. Run it on an export before publishing it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "directory", help="directory of an export, publish it as snapshot afterwards"
+        )
+        parser.add_argument(
+            "-k", type=int, default=10, help="number of neighbors per article, itself included"
+        )
+        parser.add_argument(
+            "--processes", type=int, default=None, help="number of processes, default all cores"
+        )
+        parser.add_argument(
+            "--max-cells",
+            type=int,
+            default=2**24,
+            help="maximum number of similarities a process computes at once",
+        )
+
+    def handle(self, *args, **options):
+        directory = options["directory"]
+        if is_published(directory):
+            # workers would swap to the changed snapshot while it is written
+            raise CommandError(
+                f"{directory} is a published snapshot, run on a copy and publish that"
+            )
+        t0 = time.perf_counter()
+        ids = pd.read_pickle(join(directory, django_theta_file)).index
+        ids = ids.astype(str).str.replace(ID_PREFIX, "", regex=False).astype("int64")
+        with open(join(directory, django_tfidf_file), "rb") as f:
+            X = pickle.load(f)
+        self.stdout.write(f"Loaded {X.shape[0]} articles in {time.perf_counter() - t0:.2f} s")
+
+        t1 = time.perf_counter()
+        neighbors = build_neighbors(X, options["k"], options["processes"], options["max_cells"])
+        seconds = time.perf_counter() - t1
+        self.stdout.write(
+            f"Found the neighbors of {len(neighbors)} articles in {seconds:.2f} s "
+            f"({len(neighbors) / seconds:.0f} articles/s)"
+        )
+
+        path = join(directory, SOURCES["neighbors"])
+        write_neighbors(path, *sort_neighbors(ids.to_numpy(), neighbors))
+        self.stdout.write(f"Wrote {path}")
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from sworm.data_store import open_store
+
+
+class Command(BaseCommand):
+    help = "Convert the pickles in data/ into the memory-mapped columnar store"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--verify", action="store_true", help="compare the checksums of all files"
+        )
+
+    def handle(self, *args, **options):
+        t0 = time.perf_counter()
+        store = open_store()
+        if options["verify"]:
+            try:
+                store.verify()
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        rows = ", ".join(f"{name}: {table.n_rows} rows" for name, table in store.tables.items())
+        self.stdout.write(
+            f"Data store {store.path} ({rows}) ready after {time.perf_counter() - t0:.2f} s"
+        )
@@ -0,0 +1,58 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from sworm.corpus import import_corpus
+from sworm.data_store import open_store
+from sworm.models import ImportCheckpoint
+
+
+class Command(BaseCommand):
+    help = (
+        "Import the articles of django-data.pkl into the database, only new, changed and deleted "
+        "articles are written. An import that stopped is resumed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "snapshot",
+            nargs="?",
+            help="directory of the pickles, the current snapshot by default",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=5000, help="number of articles per transaction"
+        )
+        parser.add_argument(
+            "--keep-missing",
+            action="store_true",
+            help="keep the articles of the database that are not in the snapshot",
+        )
+        parser.add_argument(
+            "--restart", action="store_true", help="start over instead of resuming an import"
+        )
+
+    def handle(self, *args, **options):
+        store = open_store(options["snapshot"])
+        # the counts of a resumed import include the articles imported before
+        checkpoint = ImportCheckpoint.objects.filter(source=store.version).first()
+        resumed = 0
+        if checkpoint is not None and not options["restart"]:
+            resumed = checkpoint.inserted + checkpoint.updated + checkpoint.unchanged
+            self.stdout.write(f"Resuming the import after {resumed} articles")
+
+        t0 = time.perf_counter()
+        counts = {}
+        results = import_corpus(
+            store, options["batch_size"], not options["keep_missing"], options["restart"]
+        )
+        for counts in results:
+            rows = counts["inserted"] + counts["updated"] + counts["unchanged"]
+            seconds = time.perf_counter() - t0
+            self.stdout.write(
+                f"Processed {rows} of {store['articles'].n_rows} articles "
+                f"({(rows - resumed) / seconds:.0f} rows/s)"
+            )
+
+        seconds = time.perf_counter() - t0
+        summary = ", ".join(f"{n} {change}" for change, n in counts.items())
+        self.stdout.write(f"Imported the articles in {seconds:.2f} s ({summary})")
@@ -0,0 +1,48 @@
+import time
+from os.path import join
+
+from django.core.management.base import BaseCommand, CommandError
+
+from sworm.bokeh_data import Dataset
+from sworm.data_store import activate_snapshot, data_dir, open_store, publish_snapshot, snapshots
+from sworm.warmup import warmup
+
+
+class Command(BaseCommand):
+    help = (
+        "Publish the pickles of a directory as new dataset snapshot data/v<N>/ and point "
+        "data/current to it. Running workers swap to it in the background."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("source", nargs="?", help="directory with the exported pickles")
+        parser.add_argument(
+            "--activate", type=int, metavar="N", help="point data/current to snapshot v<N>"
+        )
+        parser.add_argument("--list", action="store_true", help="list the snapshots")
+
+    def handle(self, *args, **options):
+        if options["list"]:
+            for number in snapshots():
+                self.stdout.write(f"v{number}")
+            return
+
+        number = options["activate"]
+        if number is None:
+            if not options["source"]:
+                raise CommandError("Either a source directory or --activate is required")
+            try:
+                number = publish_snapshot(options["source"])
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.stdout.write(f"Copied {options['source']} to snapshot v{number}")
+        elif number not in snapshots():
+            raise CommandError(f"There is no snapshot v{number}")
+
+        # build the store and the shared caches first, so the workers only have to read them
+        t0 = time.perf_counter()
+        warmup(Dataset(open_store(join(data_dir, f"v{number}"))))
+        self.stdout.write(f"Warmed up snapshot v{number} in {time.perf_counter() - t0:.2f} s")
+
+        activate_snapshot(number)
+        self.stdout.write(f"data/current points to v{number}")
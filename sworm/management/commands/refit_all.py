@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from sworm.models import CustomUser
+from sworm.training import refit_users
+
+
+class Command(BaseCommand):
+    help = (
+        "Fit the recommenders of all users whose library changed since their last fit, in "
+        "parallel and with the TF-IDF matrix loaded once, and score the articles for all of them "
+        "in one pass"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processes", type=int, default=None, help="number of processes, default all cores"
+        )
+        parser.add_argument(
+            "--force", action="store_true", help="also fit users whose library did not change"
+        )
+
+    def handle(self, *args, **options):
+        user_ids = list(CustomUser.objects.order_by("id").values_list("id", flat=True))
+        refit_users(user_ids, options["processes"], options["force"], self.stdout.write)
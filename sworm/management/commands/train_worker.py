@@ -0,0 +1,79 @@
+import logging
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from sworm.models import TrainingJob
+from sworm.training import (
+    beat,
+    claim_job,
+    fail_job,
+    fail_stale_jobs,
+    load_training_data,
+    run_job,
+    training_concurrency,
+    training_pool,
+)
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Fit the queued recommenders, see sworm.training"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=training_concurrency(),
+            help="number of processes fitting at the same time",
+        )
+        parser.add_argument(
+            "--poll", type=float, default=2.0, help="seconds between looking for new jobs"
+        )
+        parser.add_argument(
+            "--once", action="store_true", help="exit when there are no more pending jobs"
+        )
+
+    def handle(self, *args, **options):
+        load_training_data()
+        processes = options["processes"]
+        # futures of the running jobs mapped to the jobs
+        running = {}
+        pool, broken = training_pool(processes), False
+        try:
+            while True:
+                # the jobs of workers that stopped beating are failed by the workers left
+                stale = fail_stale_jobs()
+                if stale:
+                    self.stdout.write(f"Marked {stale} stale jobs as failed")
+
+                for future in [f for f in running if f.done()]:
+                    job_id = running.pop(future)
+                    if future.exception() is not None:
+                        log.error(f"Training process failed: {future.exception()}")
+                        fail_job(job_id, str(future.exception()) or "Training process lost")
+                        # a process died, the pool takes no more jobs
+                        broken |= isinstance(future.exception(), BrokenProcessPool)
+                if broken and not running:
+                    pool.shutdown()
+                    pool, broken = training_pool(processes), False
+                beat(list(running.values()))
+
+                while len(running) < processes and not broken:
+                    job = claim_job()
+                    if job is None:
+                        break
+                    self.stdout.write(f"Starting {job}")
+                    # processes are forked on demand and must open their own connections
+                    connections.close_all()
+                    running[pool.submit(run_job, job.pk)] = job.pk
+
+                pending = TrainingJob.objects.filter(status=TrainingJob.PENDING).exists()
+                if options["once"] and not running and not pending:
+                    break
+                time.sleep(options["poll"])
+        finally:
+            pool.shutdown()
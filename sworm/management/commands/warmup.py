@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from sworm.warmup import warmup
+
+
+class Command(BaseCommand):
+    help = (
+        "Load the dataset and build the shared caches of the map, so that the first requests "
+        "after a deployment do not have to"
+    )
+
+    def handle(self, *args, **options):
+        t0 = time.perf_counter()
+        for name, seconds in warmup().items():
+            self.stdout.write(f"{name}: {seconds:.3f} s")
+        self.stdout.write(f"Warm after {time.perf_counter() - t0:.3f} s")
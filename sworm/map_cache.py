@@ -0,0 +1,93 @@
+"""
+Cache for the embedded bokeh map.
+
+Building the map layout and running it through bokeh's `components` takes seconds, so we do it
+once per dataset version. The resulting script and div are written to `data/cache/`, which lets
+all gunicorn workers share a single build. bokeh is only imported to build a document, so
+processes serving cached documents never load it.
+"""
+import hashlib
+import json
+import logging
+import time
+from importlib.metadata import version
+from os.path import dirname, join
+
+from sworm.bokeh_data import get_dataset
+from sworm.file_cache import load_or_build
+from sworm.map_density import get_density_grid, use_density
+from sworm.map_tiles import get_tile_index, use_tiles
+
+log = logging.getLogger(__name__)
+
+
+def _code_version():
+    """
+    Hash of everything besides the data that determines the document, so that deploying a
+    changed layout does not serve documents built by the old code.
+    """
+    h = hashlib.sha1(version("bokeh").encode())
+    for module in ("bokeh_callbacks", "bokeh_helpers", "map_density", "map_tiles"):
+        with open(join(dirname(__file__), f"{module}.py"), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+code_version = _code_version()
+
+
+def map_cache_key():
+    dataset = get_dataset()
+    n_rows = len(dataset.df)
+    return f"{dataset.version}-{code_version}-{int(use_tiles(n_rows))}{int(use_density(n_rows))}"
+
+
+def _build_document(key):
+    from bokeh.embed import components
+
+    from sworm.bokeh_helpers import map_create_layout
+
+    t0 = time.perf_counter()
+    dataset = get_dataset()
+    n_rows = len(dataset.df)
+    tiles = get_tile_index() if use_tiles(n_rows) else None
+    density = get_density_grid() if use_density(n_rows) else None
+    layout = map_create_layout(
+        dataset.df,
+        dataset.topic_list,
+        dataset.journal_list,
+        dataset.country_list,
+        tiles,
+        density,
+    )
+    script, div = components(layout)
+    log.info(f"Building map document {key} took {time.perf_counter() - t0} s")
+    return {
+        "key": key,
+        "last_modified": dataset.last_modified,
+        "script": script,
+        "div": div,
+    }
+
+
+def _read_document(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_document(f, document):
+    f.write(json.dumps(document).encode())
+
+
+def get_map_document():
+    """
+    Return the map document for the currently loaded dataset as dict with the keys
+    `key`, `last_modified`, `script` and `div`
+    """
+    key = map_cache_key()
+    return get_dataset().cached(
+        f"map document {key}",
+        lambda: load_or_build(
+            "map", key, ".json", lambda: _build_document(key), _read_document, _write_document
+        ),
+    )
@@ -0,0 +1,123 @@
+"""
+Density overview of the map.
+
+When zoomed out, drawing every article is slow and the points hide each other anyway. Instead we
+count the articles per cell of a grid over x1/x2 and render the counts into an RGBA image. The cell
+of every article is precomputed for a few resolutions, so a grid for the rows matching the filters
+is a single `bincount`.
+"""
+import base64
+import logging
+import time
+
+import numpy as np
+from django.conf import settings
+
+from sworm.bokeh_data import get_dataset
+from sworm.map_filter import get_filter_index
+
+log = logging.getLogger(__name__)
+
+# cells per axis of the precomputed grids
+DENSITY_RESOLUTIONS = (128, 256)
+
+# color of the cells when not colored by topic
+DENSITY_COLOR = (31, 119, 180)
+
+
+def use_density(n_rows):
+    return n_rows >= getattr(settings, "SWORM_MAP_DENSITY_MIN_ROWS", 50000)
+
+
+class DensityGrid:
+    """
+    Cell of every article for each of the `DENSITY_RESOLUTIONS`
+    """
+
+    def __init__(self, x, y, topics, palette):
+        """
+        :param topics: topic code per row, -1 for rows without topic
+        :param palette: hex color per topic code
+        """
+        t0 = time.perf_counter()
+        self.bounds = np.array([x.min(), x.max(), y.min(), y.max()], dtype=np.float64)
+        self.topics = topics
+        self.colors = np.array(
+            [[int(c[i : i + 2], 16) for i in (1, 3, 5)] for c in palette], np.uint8
+        )
+
+        # relative position in [0, 1)
+        px = (x - self.bounds[0]) / ((self.bounds[1] - self.bounds[0]) or 1.0) * (1 - 1e-9)
+        py = (y - self.bounds[2]) / ((self.bounds[3] - self.bounds[2]) or 1.0) * (1 - 1e-9)
+        self.cells = {}
+        for r in DENSITY_RESOLUTIONS:
+            self.cells[r] = (py * r).astype(np.int32) * r + (px * r).astype(np.int32)
+        log.info(f"Building density grids took {time.perf_counter() - t0} s")
+
+    def counts(self, resolution, mask=None):
+        """
+        Number of rows per cell, the first axis is y
+
+        :param mask: boolean mask of the rows to count
+        """
+        cells = self.cells[resolution]
+        if mask is not None:
+            cells = cells[mask]
+        return np.bincount(cells, minlength=resolution * resolution).reshape(resolution, -1)
+
+    def dominant_topics(self, resolution, mask=None):
+        """
+        Most frequent topic code per cell, -1 for empty cells
+        """
+        cells = self.cells[resolution]
+        topics = self.topics
+        if mask is not None:
+            cells, topics = cells[mask], topics[mask]
+        known = topics >= 0
+        n_topics = len(self.colors)
+        counts = np.bincount(
+            cells[known] * n_topics + topics[known], minlength=resolution * resolution * n_topics
+        ).reshape(resolution * resolution, n_topics)
+        dominant = counts.argmax(axis=1)
+        dominant[counts.max(axis=1) == 0] = -1
+        return dominant.reshape(resolution, -1)
+
+    def render(self, resolution, mask=None, by_topic=False):
+        """
+        Render the grid as RGBA image for bokeh's `image_rgba`, the opacity grows with the log of
+        the number of rows in a cell
+
+        :param by_topic: color cells by their most frequent topic
+        """
+        counts = self.counts(resolution, mask)
+        image = np.zeros(counts.shape + (4,), dtype=np.uint8)
+        if by_topic:
+            dominant = self.dominant_topics(resolution, mask)
+            image[..., :3] = self.colors[np.maximum(dominant, 0)]
+        else:
+            image[..., :3] = DENSITY_COLOR
+        scale = np.log1p(counts.max()) or 1.0
+        image[..., 3] = (np.log1p(counts) / scale * 255).astype(np.uint8)
+        return image.view(np.uint32).reshape(counts.shape)
+
+
+def encode_image(image):
+    """
+    Encode an image of `render` as base64, the bytes of each pixel are in RGBA order
+    """
+    return base64.b64encode(image.tobytes()).decode("ascii")
+
+
+def get_density_grid():
+    from bokeh.palettes import Turbo256, linear_palette
+
+    dataset = get_dataset()
+    return dataset.cached(
+        "density grid",
+        lambda: DensityGrid(
+            dataset.df["x1"].to_numpy(),
+            dataset.df["x2"].to_numpy(),
+            get_filter_index().facets["topic"].codes,
+            linear_palette(Turbo256, len(dataset.topic_list)),
+        ),
+    )
@@ -0,0 +1,161 @@
+"""
+Filter engine for the map.
+
+Instead of testing every article against every filter in the browser, we keep one bitmap per
+journal, topic and country and the sorted values of the date and citation columns. A query is then
+answered by combining bitmaps, the result is a packed bit mask over the rows of the articles.
+"""
+import base64
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+from sworm.bokeh_data import get_dataset
+from sworm.map_search import search_mask
+
+log = logging.getLogger(__name__)
+
+
+class Facet:
+    """
+    Categorical column with one packed bitmap per category
+    """
+
+    def __init__(self, values, categories):
+        self.categories = list(categories)
+        self.codes = pd.Categorical(values, categories=self.categories).codes
+        self.bitmaps = np.stack(
+            [np.packbits(self.codes == code) for code in range(len(self.categories))]
+        )
+
+    def mask(self, codes):
+        """
+        Rows with one of the given category codes
+        """
+        codes = [code for code in codes if 0 <= code < len(self.categories)]
+        if not codes:
+            return np.zeros(self.bitmaps.shape[1], dtype=np.uint8)
+        return np.bitwise_or.reduce(self.bitmaps[codes], axis=0)
+
+    def counts(self, mask):
+        """
+        Number of rows per category among the rows selected by the mask
+        """
+        selected = np.unpackbits(mask, count=len(self.codes)).view(bool)
+        codes = self.codes[selected]
+        return np.bincount(codes[codes >= 0], minlength=len(self.categories))
+
+
+class Range:
+    """
+    Numeric column, sorted once so that range queries are two binary searches
+    """
+
+    def __init__(self, values):
+        values = np.asarray(values)
+        self.order = np.argsort(values, kind="stable")
+        self.values = values[self.order]
+
+    def mask(self, lower, upper):
+        """
+        Rows with lower <= value <= upper
+        """
+        start = np.searchsorted(self.values, lower, side="left")
+        end = np.searchsorted(self.values, upper, side="right")
+        selected = np.zeros(len(self.values), dtype=bool)
+        selected[self.order[start:end]] = True
+        return np.packbits(selected)
+
+
+class FilterIndex:
+    """
+    Answers the filter queries of the map, facet codes are positions in the lists the map was
+    built with.
+    """
+
+    def __init__(self, df, journal_list, topic_list, country_list):
+        t0 = time.perf_counter()
+        self.n_rows = len(df)
+        self.facets = {
+            "journal": Facet(df["journal"], journal_list),
+            "topic": Facet(df["cluster"], topic_list),
+            "country": Facet(df["country"], country_list),
+        }
+        self.ranges = {
+            "date": Range(df["timestamp"].to_numpy()),
+            "citations": Range(df["citations"].to_numpy()),
+        }
+        self.all_rows = np.packbits(np.ones(self.n_rows, dtype=bool))
+        log.info(f"Building filter index took {time.perf_counter() - t0} s")
+
+    def _combine(self, masks):
+        result = self.all_rows
+        for mask in masks:
+            result = np.bitwise_and(result, mask)
+        return result
+
+    def query(self, selected=None, ranges=None, key="", counts=True):
+        """
+        Filter the rows.
+
+        :param selected: maps facet names to the list of selected codes, facets that are not
+            given are not restricted
+        :param ranges: maps range names to (lower, upper) tuples
+        :param key: keyword to search for in the article texts
+        :param counts: whether to count the rows per category
+        :return: dict with the packed `mask`, the number of matching rows as `count` and, for
+            every facet, the number of rows per category that match all other filters
+        """
+        masks = {}
+        for name, codes in (selected or {}).items():
+            masks[name] = self.facets[name].mask(codes)
+        for name, (lower, upper) in (ranges or {}).items():
+            masks[name] = self.ranges[name].mask(lower, upper)
+        if key:
+            masks["text"] = np.packbits(search_mask(key))
+
+        mask = self._combine(masks.values())
+        facet_counts = {}
+        if counts:
+            for name, facet in self.facets.items():
+                others = self._combine(m for n, m in masks.items() if n != name)
+                facet_counts[name] = facet.counts(others)
+
+        count = int(np.unpackbits(mask, count=self.n_rows).sum())
+        return {"mask": mask, "count": count, "counts": facet_counts}
+
+    def row_mask(self, selected=None, ranges=None, key=""):
+        """
+        Boolean mask of the rows matching the filters, None if there are no filters
+        """
+        if not (selected or ranges or key):
+            return None
+        mask = self.query(selected, ranges, key, counts=False)["mask"]
+        return np.unpackbits(mask, count=self.n_rows).view(bool)
+
+
+def encode_mask(mask):
+    """
+    Encode a packed mask as base64, bits are ordered most significant first
+    """
+    return base64.b64encode(mask.tobytes()).decode("ascii")
+
+
+def decode_mask(text, n_rows):
+    """
+    Boolean mask of n_rows rows from a mask encoded by `encode_mask`, like the map does
+    """
+    packed = np.frombuffer(base64.b64decode(text), dtype=np.uint8)
+    return np.unpackbits(packed, count=n_rows).view(bool)
+
+
+def get_filter_index():
+    dataset = get_dataset()
+    return dataset.cached(
+        "filter index",
+        lambda: FilterIndex(
+            dataset.df, dataset.journal_list, dataset.topic_list, dataset.country_list
+        ),
+    )
@@ -0,0 +1,192 @@
+"""
+Keyword search for the map.
+
+The article texts are not part of the map data source, so the browser asks the server for the
+rows matching a key. Instead of scanning all texts, we look the key up in an index of the lower
+cased tokens: trigram postings lead from the key to the tokens containing it, token postings lead
+from the tokens to the rows of the articles. The texts themselves stay in the data store and are
+only decoded to verify candidate rows.
+"""
+import logging
+import re
+import time
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from sworm.bokeh_data import get_dataset
+from sworm.file_cache import load_or_build, read_arrays, write_arrays
+
+log = logging.getLogger(__name__)
+
+SEARCH_COLUMNS = ["abstract", "title", "author", "journal"]
+
+TOKEN = re.compile(r"\w+")
+
+
+def _build_haystack(articles, rows=None):
+    """
+    Lower cased texts of all searchable columns, joined by a separator that can not be part of a
+    key, so a match never spans two columns. Indexed by position in rows.
+
+    :param articles: `sworm.data_store.Table` of the articles
+    :param rows: rows to decode, all rows if not given
+    """
+    columns = [
+        articles.series(column, rows).astype(object).fillna("").astype(str)
+        for column in SEARCH_COLUMNS
+    ]
+    haystack = columns[0]
+    for c in columns[1:]:
+        haystack = haystack + "\n" + c
+    return haystack.str.lower().reset_index(drop=True)
+
+
+def _postings(keys, values, n_keys):
+    """
+    Group values by key into one sorted array and the offsets of each key in it
+    """
+    order = np.lexsort((values, keys))
+    offsets = np.zeros(n_keys + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=n_keys), out=offsets[1:])
+    return offsets, values[order]
+
+
+class SearchIndex:
+    """
+    Token and trigram postings of the searchable texts, stored as flat arrays.
+    """
+
+    def __init__(self, arrays, articles):
+        # masks of the latest keys, the filters ask for the same key repeatedly while typing
+        self.mask = lru_cache(maxsize=32)(self._mask)
+
+        self.tokens = arrays["tokens"]
+        self.token_offsets = arrays["token_offsets"]
+        self.token_rows = arrays["token_rows"]
+        self.trigrams = arrays["trigrams"]
+        self.trigram_offsets = arrays["trigram_offsets"]
+        self.trigram_tokens = arrays["trigram_tokens"]
+        self.articles = articles
+
+    @staticmethod
+    def build_arrays(haystack):
+        t0 = time.perf_counter()
+
+        # (row, token) pairs, each token once per row
+        tokens = haystack.str.findall(TOKEN.pattern).explode().dropna()
+        codes, vocabulary = pd.factorize(tokens, sort=True)
+        n_rows = len(haystack)
+        pairs = np.unique(codes.astype(np.int64) * n_rows + tokens.index.to_numpy(np.int64))
+        token_offsets, token_rows = _postings(pairs // n_rows, pairs % n_rows, len(vocabulary))
+
+        # (trigram, token) pairs
+        trigram_keys, trigram_values = [], []
+        for code, token in enumerate(vocabulary):
+            grams = {token[i : i + 3] for i in range(len(token) - 2)}
+            trigram_keys.extend(grams)
+            trigram_values.extend([code] * len(grams))
+        trigram_codes, trigrams = pd.factorize(np.array(trigram_keys, dtype=str), sort=True)
+        trigram_offsets, trigram_tokens = _postings(
+            trigram_codes.astype(np.int64), np.array(trigram_values, dtype=np.int64), len(trigrams)
+        )
+
+        log.info(
+            f"Building search index with {len(vocabulary)} tokens and {len(trigrams)} trigrams "
+            f"took {time.perf_counter() - t0} s"
+        )
+        return {
+            "tokens": np.asarray(vocabulary, dtype=str),
+            "token_offsets": token_offsets,
+            "token_rows": token_rows.astype(np.int32),
+            "trigrams": np.asarray(trigrams, dtype=str),
+            "trigram_offsets": trigram_offsets,
+            "trigram_tokens": trigram_tokens.astype(np.int32),
+        }
+
+    def _trigram_tokens(self, gram):
+        i = np.searchsorted(self.trigrams, gram)
+        if i == len(self.trigrams) or self.trigrams[i] != gram:
+            return np.zeros(0, dtype=np.int32)
+        return self.trigram_tokens[self.trigram_offsets[i] : self.trigram_offsets[i + 1]]
+
+    def _tokens_containing(self, word):
+        """
+        Codes of the tokens containing the word
+        """
+        if len(word) < 3:
+            candidates = np.arange(len(self.tokens))
+        else:
+            grams = sorted(
+                (self._trigram_tokens(word[i : i + 3]) for i in range(len(word) - 2)), key=len
+            )
+            candidates = grams[0]
+            for g in grams[1:]:
+                candidates = np.intersect1d(candidates, g, assume_unique=True)
+        # trigrams may occur in a token in a different order than in the word
+        return candidates[np.char.find(self.tokens[candidates], word) >= 0]
+
+    def _rows_containing(self, word):
+        rows = [
+            self.token_rows[self.token_offsets[code] : self.token_offsets[code + 1]]
+            for code in self._tokens_containing(word)
+        ]
+        mask = np.zeros(self.articles.n_rows, dtype=bool)
+        if rows:
+            mask[np.concatenate(rows)] = True
+        return mask
+
+    def _mask(self, key):
+        mask = self.search(key)
+        mask.flags.writeable = False
+        return mask
+
+    def search(self, key):
+        """
+        Boolean mask of the rows whose texts contain the lower cased key
+        """
+        words = TOKEN.findall(key)
+        if not words:
+            return _build_haystack(self.articles).str.contains(key, regex=False).to_numpy()
+
+        mask = self._rows_containing(words[0])
+        for word in words[1:]:
+            mask &= self._rows_containing(word)
+
+        # a key made of a single word is found inside a token, everything else is verified on
+        # the rows containing all of its words
+        if TOKEN.fullmatch(key) is None:
+            rows = np.flatnonzero(mask)
+            haystack = _build_haystack(self.articles, rows)
+            mask[rows] = haystack.str.contains(key, regex=False).to_numpy()
+        return mask
+
+
+def get_search_index():
+    """
+    The index is built once per dataset version and shared between workers through the cache
+    directory
+    """
+    dataset = get_dataset()
+
+    def build():
+        arrays = load_or_build(
+            "search",
+            dataset.version,
+            ".npz",
+            lambda: SearchIndex.build_arrays(_build_haystack(dataset.articles)),
+            read_arrays,
+            write_arrays,
+        )
+        return SearchIndex(arrays, dataset.articles)
+
+    return dataset.cached("search index", build)
+
+
+def search_mask(key):
+    """
+    Boolean mask of the rows whose abstract, title, authors or journal contain the key, ignoring
+    case. The result is cached and must not be modified.
+    """
+    return get_search_index().mask(key.lower())
@@ -0,0 +1,125 @@
+"""
+Level of detail for large maps.
+
+The articles are sorted along a Z-order curve over x1/x2, so that every tile of the quadtree over
+the map is a contiguous range of that order. A tile is answered with two binary searches and, when
+it holds too many points, thinned by taking every n-th point along the curve, which keeps the
+spatial distribution of the points.
+"""
+import logging
+import time
+
+import numpy as np
+from django.conf import settings
+
+from sworm.bokeh_data import get_dataset
+from sworm.file_cache import load_or_build, read_arrays, write_arrays
+
+log = logging.getLogger(__name__)
+
+# resolution of the quadtree, points are quantized to 2^TILE_DEPTH cells per axis
+TILE_DEPTH = 16
+
+# maximum number of points per tile
+TILE_POINTS = 2000
+
+
+def use_tiles(n_rows):
+    return n_rows >= getattr(settings, "SWORM_MAP_LOD_MIN_ROWS", 200000)
+
+
+def _spread_bits(v):
+    """
+    Move the lower 16 bits of v to the even bit positions
+    """
+    v = v.astype(np.int64) & 0xFFFF
+    v = (v | (v << 8)) & 0x00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F
+    v = (v | (v << 2)) & 0x33333333
+    v = (v | (v << 1)) & 0x55555555
+    return v
+
+
+def morton(x, y):
+    """
+    Interleave the bits of integer coordinates into their position on the Z-order curve
+    """
+    return _spread_bits(np.asarray(x)) | (_spread_bits(np.asarray(y)) << 1)
+
+
+class TileIndex:
+    """
+    Rows of the articles in Z-order, with the Z-order code of each of them
+    """
+
+    def __init__(self, arrays):
+        self.order = arrays["order"]
+        self.codes = arrays["codes"]
+        self.bounds = arrays["bounds"]
+
+    @staticmethod
+    def build_arrays(x, y):
+        t0 = time.perf_counter()
+        bounds = np.array([x.min(), x.max(), y.min(), y.max()], dtype=np.float64)
+        cells = 2**TILE_DEPTH - 1
+        qx = (x - bounds[0]) / ((bounds[1] - bounds[0]) or 1.0) * cells
+        qy = (y - bounds[2]) / ((bounds[3] - bounds[2]) or 1.0) * cells
+        codes = morton(qx.astype(np.int64), qy.astype(np.int64))
+        order = np.argsort(codes, kind="stable")
+        log.info(f"Building tile index took {time.perf_counter() - t0} s")
+        return {"order": order.astype(np.int32), "codes": codes[order], "bounds": bounds}
+
+    def tile_rows(self, z, x, y, mask=None, limit=TILE_POINTS):
+        """
+        Rows inside tile (x, y) of zoom level z, at most `limit` of them
+
+        :param mask: boolean mask of the rows to consider
+        """
+        if not (0 <= z <= TILE_DEPTH and 0 <= x < 2**z and 0 <= y < 2**z):
+            raise ValueError(f"No tile {z}/{x}/{y}")
+
+        shift = 2 * (TILE_DEPTH - z)
+        prefix = int(morton(x, y))
+        start = np.searchsorted(self.codes, prefix << shift, side="left")
+        end = np.searchsorted(self.codes, (prefix + 1) << shift, side="left")
+
+        rows = self.order[start:end]
+        if mask is not None:
+            rows = rows[mask[rows]]
+        if len(rows) > limit:
+            rows = rows[:: -(-len(rows) // limit)]
+        return rows
+
+
+def tile_data(df, rows, topic_codes):
+    """
+    Columns of the given rows as needed by the level of detail map
+
+    :param topic_codes: position of the topic of every row in the topic list of the map
+    """
+    d = df.iloc[rows]
+    return {
+        "index": d.index.to_numpy(np.int64),
+        "x1": d["x1"].to_numpy(),
+        "x2": d["x2"].to_numpy(),
+        "topic": topic_codes[rows],
+        "citations": d["citations"].to_numpy(),
+    }
+
+
+def get_tile_index():
+    dataset = get_dataset()
+    df = dataset.df
+    return dataset.cached(
+        "tile index",
+        lambda: TileIndex(
+            load_or_build(
+                "tiles",
+                dataset.version,
+                ".npz",
+                lambda: TileIndex.build_arrays(df["x1"].to_numpy(), df["x2"].to_numpy()),
+                read_arrays,
+                write_arrays,
+            )
+        ),
+    )
@@ -0,0 +1,20 @@
+from sworm.bokeh_data import get_dataset, is_loaded, use_dataset
+from sworm.warmup import check_for_update
+
+
+class DatasetMiddleware:
+    """
+    Look for a new dataset snapshot and pin the current dataset for the request, so that swapping
+    it in the background does not change the data in the middle of a request
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not is_loaded():
+            return self.get_response(request)
+
+        check_for_update()
+        with use_dataset(get_dataset()):
+            return self.get_response(request)
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.3 on 2026-10-18 11:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sworm", "0002_auto_20210622_2337"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Recommendation",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="recommendation",
+                        serialize=False,
+                        to="sworm.customuser",
+                    ),
+                ),
+                ("ids", models.BinaryField()),
+                ("scores", models.BinaryField()),
+                ("updated_on", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
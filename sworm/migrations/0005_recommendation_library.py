@@ -0,0 +1,18 @@
+# Generated by Django 3.2.3 on 2026-10-18 11:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sworm", "0004_trainingjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="recommendation",
+            name="library",
+            field=models.CharField(blank=True, max_length=40),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.3 on 2026-10-18 11:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sworm", "0005_recommendation_library"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="recommendation",
+            name="coef",
+            field=models.BinaryField(default=b""),
+        ),
+        migrations.AddField(
+            model_name="recommendation",
+            name="intercept",
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name="recommendation",
+            name="updates",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.3 on 2026-10-18 12:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sworm", "0006_recommendation_model"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="article",
+            name="fingerprint",
+            field=models.CharField(blank=True, max_length=40),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.3 on 2026-10-18 12:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sworm", "0007_article_fingerprint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ImportCheckpoint",
+            fields=[
+                ("source", models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ("position", models.PositiveIntegerField(default=0)),
+                ("inserted", models.PositiveIntegerField(default=0)),
+                ("updated", models.PositiveIntegerField(default=0)),
+                ("unchanged", models.PositiveIntegerField(default=0)),
+                ("updated_on", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,101 @@
+"""
+Full-text index of the titles, abstracts and author names of the articles, see sworm.search. The
+index is an FTS5 table of SQLite kept in sync with the articles by triggers.
+"""
+from django.db import migrations
+
+# names of the authors of an article in the order they were linked, separated by spaces, linking
+# an author appends the name
+AUTHORS = """
+    (SELECT coalesce(group_concat(name, ' '), '') FROM (
+        SELECT sworm_author.name AS name FROM sworm_article_authors
+        JOIN sworm_author ON sworm_author.id = sworm_article_authors.author_id
+        WHERE sworm_article_authors.article_id = {article} ORDER BY sworm_article_authors.id
+    ))
+"""
+
+CREATE = [
+    """
+    CREATE VIRTUAL TABLE sworm_article_search USING fts5(
+        title, abstract, authors, tokenize = 'porter unicode61 remove_diacritics 2'
+    )
+    """,
+    f"""
+    INSERT INTO sworm_article_search (rowid, title, abstract, authors)
+    SELECT id, title, abstract, {AUTHORS.format(article="sworm_article.id")} FROM sworm_article
+    """,
+    f"""
+    CREATE TRIGGER sworm_article_search_insert AFTER INSERT ON sworm_article BEGIN
+        INSERT INTO sworm_article_search (rowid, title, abstract, authors)
+        VALUES (new.id, new.title, new.abstract, {AUTHORS.format(article="new.id")});
+    END
+    """,
+    """
+    CREATE TRIGGER sworm_article_search_update AFTER UPDATE OF title, abstract ON sworm_article
+    BEGIN
+        UPDATE sworm_article_search SET title = new.title, abstract = new.abstract
+        WHERE rowid = new.id;
+    END
+    """,
+    """
+    CREATE TRIGGER sworm_article_search_delete AFTER DELETE ON sworm_article BEGIN
+        DELETE FROM sworm_article_search WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER sworm_article_search_link AFTER INSERT ON sworm_article_authors BEGIN
+        UPDATE sworm_article_search
+        SET authors = ltrim(authors || ' ' || (
+            SELECT name FROM sworm_author WHERE id = new.author_id
+        ))
+        WHERE rowid = new.article_id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER sworm_article_search_unlink AFTER DELETE ON sworm_article_authors BEGIN
+        UPDATE sworm_article_search SET authors = {AUTHORS.format(article="old.article_id")}
+        WHERE rowid = old.article_id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER sworm_article_search_author AFTER UPDATE OF name ON sworm_author BEGIN
+        UPDATE sworm_article_search
+        SET authors = {AUTHORS.format(article="sworm_article_search.rowid")}
+        WHERE rowid IN (
+            SELECT article_id FROM sworm_article_authors WHERE author_id = new.id
+        );
+    END
+    """,
+]
+
+DROP = [
+    "DROP TRIGGER IF EXISTS sworm_article_search_author",
+    "DROP TRIGGER IF EXISTS sworm_article_search_unlink",
+    "DROP TRIGGER IF EXISTS sworm_article_search_link",
+    "DROP TRIGGER IF EXISTS sworm_article_search_delete",
+    "DROP TRIGGER IF EXISTS sworm_article_search_update",
+    "DROP TRIGGER IF EXISTS sworm_article_search_insert",
+    "DROP TABLE IF EXISTS sworm_article_search",
+]
+
+
+def _execute(statements):
+    def run(apps, schema_editor):
+        # FTS5 is specific to SQLite, search is not available on other databases
+        if schema_editor.connection.vendor != "sqlite":
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sworm", "0008_importcheckpoint"),
+    ]
+
+    operations = [
+        migrations.RunPython(_execute(CREATE), _execute(DROP)),
+    ]
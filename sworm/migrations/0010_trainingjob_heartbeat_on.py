@@ -0,0 +1,18 @@
+# Generated by Django 3.2.3 on 2026-10-18 12:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sworm", "0009_article_search"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="trainingjob",
+            name="heartbeat_on",
+            field=models.DateTimeField(null=True),
+        ),
+    ]
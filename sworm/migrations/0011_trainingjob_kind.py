@@ -0,0 +1,25 @@
+# Generated by Django 3.2.3 on 2026-10-18 12:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sworm", "0010_trainingjob_heartbeat_on"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="trainingjob",
+            name="changes",
+            field=models.JSONField(default=list),
+        ),
+        migrations.AddField(
+            model_name="trainingjob",
+            name="kind",
+            field=models.CharField(
+                choices=[("fit", "Fit"), ("update", "Update")], default="fit", max_length=16
+            ),
+        ),
+    ]
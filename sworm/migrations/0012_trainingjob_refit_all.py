@@ -0,0 +1,42 @@
+# Generated by Django 3.2.3 on 2026-10-18 12:34
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sworm", "0011_trainingjob_kind"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="trainingjob",
+            name="kind",
+            field=models.CharField(
+                choices=[("fit", "Fit"), ("update", "Update"), ("refit_all", "Refit all")],
+                default="fit",
+                max_length=16,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="trainingjob",
+            name="user",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="training_jobs",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="trainingjob",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("kind", "refit_all"), ("status", "pending")),
+                fields=("kind",),
+                name="unique_pending_refit_all",
+            ),
+        ),
+    ]
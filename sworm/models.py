@@ -39,6 +39,8 @@ class Article(models.Model):
     doi = models.TextField(max_length=256, null=True)
     x1 = models.FloatField(null=True)
     x2 = models.FloatField(null=True)
+    # hash of the imported fields, see `sworm.corpus.fingerprint`
+    fingerprint = models.CharField(max_length=40, blank=True)
 
     def __str__(self):
         return self.title
@@ -50,3 +52,100 @@ class CustomUser(AbstractUser):
 
     def __str__(self):
         return self.username
+
+
+class Recommendation(models.Model):
+    """
+    Top articles of the recommender of a user with saved articles excluded, fitted at
+    `updated_on`. Article ids and scores are stored as int64 and float32 arrays in descending
+    order of the score. `library` fingerprints the saved articles and the dataset version the
+    recommender was fitted on, `coef` and `intercept` are its linear model as float32 array, which
+    was updated `updates` times since by saving or removing articles.
+    """
+
+    user = models.OneToOneField(
+        CustomUser, on_delete=models.CASCADE, primary_key=True, related_name="recommendation"
+    )
+    ids = models.BinaryField()
+    scores = models.BinaryField()
+    library = models.CharField(max_length=40, blank=True)
+    coef = models.BinaryField(default=b"")
+    intercept = models.FloatField(default=0.0)
+    updates = models.PositiveIntegerField(default=0)
+    updated_on = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Recommendation for {self.user}"
+
+
+class TrainingJob(models.Model):
+    """
+    Queued fit of the recommender of a user, run by `manage.py train_worker`. An update job only
+    applies the `changes` to the fitted recommender, a list of article ids and whether they were
+    saved or removed. A refit of all users has no user, see `sworm.training.refit_users`.
+    """
+
+    FIT = "fit"
+    UPDATE = "update"
+    REFIT_ALL = "refit_all"
+    KIND_CHOICES = [(FIT, "Fit"), (UPDATE, "Update"), (REFIT_ALL, "Refit all")]
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    user = models.ForeignKey(
+        CustomUser, on_delete=models.CASCADE, null=True, related_name="training_jobs"
+    )
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES, default=FIT)
+    changes = models.JSONField(default=list)
+    created_on = models.DateTimeField(auto_now_add=True)
+    started_on = models.DateTimeField(null=True)
+    # updated by the worker while the job runs, see `sworm.training.fail_stale_jobs`
+    heartbeat_on = models.DateTimeField(null=True)
+    finished_on = models.DateTimeField(null=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "created_on"])]
+        constraints = [
+            # requests for a user that is already queued are coalesced into the pending job
+            models.UniqueConstraint(
+                fields=["user"],
+                condition=models.Q(status="pending"),
+                name="unique_pending_training_job",
+            ),
+            models.UniqueConstraint(
+                fields=["kind"],
+                condition=models.Q(status="pending", kind="refit_all"),
+                name="unique_pending_refit_all",
+            ),
+        ]
+
+    def __str__(self):
+        return f"Training for {self.user or 'all users'} ({self.kind}, {self.status})"
+
+
+class ImportCheckpoint(models.Model):
+    """
+    Progress of the import of a version of the data store, see `sworm.corpus`. The articles before
+    `position` are imported, the counts are the changes so far.
+    """
+
+    source = models.CharField(max_length=64, primary_key=True)
+    position = models.PositiveIntegerField(default=0)
+    inserted = models.PositiveIntegerField(default=0)
+    updated = models.PositiveIntegerField(default=0)
+    unchanged = models.PositiveIntegerField(default=0)
+    updated_on = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Import of {self.source} at {self.position}"
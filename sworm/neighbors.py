@@ -0,0 +1,96 @@
+"""
+Nearest neighbors of the articles by the cosine similarity of their TF-IDF rows.
+
+The similarities are computed in chunks of rows, each a sparse product with the whole matrix that
+holds at most `max_cells` scores, split across a pool of processes forked after loading the
+matrix. The result is written in the compact format of the store: the sorted article ids and an
+int32 matrix with the rows of the neighbors of each article in that order, the article itself
+first.
+"""
+import logging
+import multiprocessing
+import os
+import pickle
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from os.path import dirname
+
+import numpy as np
+from scipy import sparse
+
+log = logging.getLogger(__name__)
+
+# normalized TF-IDF matrix shared with the forked processes
+_shared = {}
+
+
+def _normalize(X):
+    X = sparse.csr_matrix(X, dtype=np.float32)
+    norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel())
+    return sparse.diags(1.0 / np.where(norms > 0, norms, 1.0)).dot(X).tocsr()
+
+
+def _top_chunk(start, end, k):
+    """
+    Rows of the k most similar rows of the rows from start to end, each row first
+    """
+    X, XT = _shared["X"], _shared["XT"]
+    scores = X[start:end].dot(XT).toarray()
+    scores[np.arange(end - start), np.arange(start, end)] = np.inf
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind="stable")
+    return start, np.take_along_axis(top, order, axis=1).astype(np.int32)
+
+
+def build_neighbors(X, k=10, processes=None, max_cells=2**24):
+    """
+    Rows of the k - 1 nearest neighbors of each row of the TF-IDF matrix X, preceded by the row
+    itself
+
+    :param max_cells: maximum number of similarities computed at once per process
+    :return: int32 matrix with k columns
+    """
+    t0 = time.perf_counter()
+    _shared["X"] = _normalize(X)
+    _shared["XT"] = _shared["X"].T.tocsc()
+    n_rows = X.shape[0]
+    chunk = max(1, max_cells // max(n_rows, 1))
+    neighbors = np.zeros((n_rows, min(k, n_rows)), dtype=np.int32)
+
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(processes or multiprocessing.cpu_count(), mp_context=context) as pool:
+        starts = range(0, n_rows, chunk)
+        ends = [min(start + chunk, n_rows) for start in starts]
+        for start, top in pool.map(_top_chunk, starts, ends, [k] * len(ends)):
+            neighbors[start : start + len(top)] = top
+    _shared.clear()
+    log.info(f"Finding the neighbors of {n_rows} articles took {time.perf_counter() - t0} s")
+    return neighbors
+
+
+def sort_neighbors(ids, neighbors):
+    """
+    Sort the articles by id and translate the rows of their neighbors to that order, returns the
+    sorted ids and the neighbors
+    """
+    order = np.argsort(ids, kind="stable")
+    position = np.empty(len(ids), dtype=np.int32)
+    position[order] = np.arange(len(ids), dtype=np.int32)
+    return np.asarray(ids, dtype=np.int64)[order], position[neighbors[order]]
+
+
+def write_neighbors(path, ids, neighbors):
+    """
+    Pickle the sorted ids and the neighbor rows to path, replacing the file atomically
+    """
+    fd, tmp = tempfile.mkstemp(dir=dirname(path), prefix=".neighbors-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump({"ids": ids, "neighbors": neighbors}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
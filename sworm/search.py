@@ -0,0 +1,126 @@
+"""
+Full-text search of the articles.
+
+Titles, abstracts and author names are indexed in the FTS5 table `sworm_article_search` of SQLite,
+which triggers keep in sync with the articles and their authors, see migration 0009. Matches are
+ranked by BM25 with a title match weighing more than an author match, which weighs more than an
+abstract match. Queries go to the database only, the dataset is not loaded. Other databases have
+no index, searching them finds nothing.
+"""
+import re
+
+from django.db import connection
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+TABLE = "sworm_article_search"
+
+# BM25 weights of the title, abstract and authors columns
+WEIGHTS = (10.0, 1.0, 5.0)
+
+# marks of the matched terms in highlights, escaped separately from the text
+MARK_START, MARK_END = "\x02", "\x03"
+
+SNIPPET_TOKENS = 32
+
+_terms = re.compile(r"\w+")
+
+
+def search_available():
+    """
+    Whether the database has the index, which migration 0009 only creates on SQLite
+    """
+    return connection.vendor == "sqlite"
+
+
+def fts_query(text):
+    """
+    FTS5 query matching the articles that contain all words of the text, None if there are no
+    words. The words are quoted, so the syntax of FTS5 queries can not be used.
+    """
+    terms = _terms.findall(text)
+    if not terms:
+        return None
+    return " ".join(f'"{term}"' for term in terms)
+
+
+def _highlight(text):
+    """
+    Html of a text returned by FTS5 with the matched terms in <mark> tags
+    """
+    html = escape(text).replace(MARK_START, "<mark>").replace(MARK_END, "</mark>")
+    return mark_safe(html)
+
+
+def search_articles(text, page=1, per_page=20):
+    """
+    Page of the articles matching the text with the total number of matches. Every article has
+    its highlighted title and a snippet of the matching part of the abstract as html.
+    """
+    query = fts_query(text)
+    if query is None or not search_available():
+        return {
+            "count": 0,
+            "page": page,
+            "pages": 0,
+            "articles": [],
+            "available": search_available(),
+        }
+
+    weights = ", ".join(str(w) for w in WEIGHTS)
+    marks = f"'{MARK_START}', '{MARK_END}'"
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT count(*) FROM {TABLE} WHERE {TABLE} MATCH %s", [query])
+        count = cursor.fetchone()[0]
+        cursor.execute(
+            f"""
+            SELECT rowid FROM {TABLE} WHERE {TABLE} MATCH %s
+            ORDER BY bm25({TABLE}, {weights}) LIMIT %s OFFSET %s
+            """,
+            [query, per_page, (page - 1) * per_page],
+        )
+        ids = [id for id, in cursor.fetchall()]
+        # highlights are only made for the page, not for every match that is ranked
+        cursor.execute(
+            f"""
+            SELECT s.rowid, highlight({TABLE}, 0, {marks}),
+                snippet({TABLE}, 1, {marks}, '…', {SNIPPET_TOKENS}),
+                a.publish_on, a.citations, j.issn, j.name
+            FROM {TABLE} s
+            JOIN sworm_article a ON a.id = s.rowid
+            JOIN sworm_journal j ON j.issn = a.journal_id
+            WHERE {TABLE} MATCH %s AND s.rowid IN ({", ".join(["%s"] * len(ids))})
+            """,
+            [query] + ids,
+        )
+        order = {id: position for position, id in enumerate(ids)}
+        rows = sorted(cursor.fetchall(), key=lambda row: order[row[0]])
+
+    articles = [
+        {
+            "id": id,
+            "title": _highlight(title),
+            "snippet": _highlight(snippet),
+            "publish_on": publish_on,
+            "citations": citations,
+            "journal": {"issn": issn, "name": journal},
+        }
+        for id, title, snippet, publish_on, citations, issn, journal in rows
+    ]
+    return {
+        "count": count,
+        "page": page,
+        "pages": -(-count // per_page),
+        "articles": articles,
+        "available": True,
+    }
+
+
+def optimize_search_index():
+    """
+    Merge the segments of the index into one, which speeds up queries after large imports
+    """
+    if not search_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('optimize')")
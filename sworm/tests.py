@@ -1,3 +1,497 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from os.path import join
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from scipy import sparse
+
+from sworm import warmup
+from sworm.ann import LSHIndex
+from sworm.corpus import fingerprint, import_corpus, normalize_articles, write_articles
+from sworm.data_store import SOURCES, Store, build_store, django_theta_file, tfidf_matrix
+from sworm.file_cache import read_arrays, write_arrays
+from sworm.map_filter import FilterIndex, decode_mask, encode_mask
+from sworm.models import (
+    Article,
+    CustomUser,
+    ImportCheckpoint,
+    Journal,
+    Recommendation,
+    TrainingJob,
+)
+from sworm.search import optimize_search_index, search_articles
+from sworm.training import (
+    beat,
+    claim_job,
+    enqueue_refit_all,
+    enqueue_training,
+    enqueue_update,
+    fail_stale_jobs,
+    run_job,
+    top_rows_batch,
+)
+from sworm.typeahead import KEY_BYTES, TypeaheadIndex
+
+
+class FilterIndexTest(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        n = 101
+        self.df = pd.DataFrame(
+            {
+                "journal": rng.choice(["a", "b", "c"], n),
+                "cluster": rng.choice(["t0", "t1"], n),
+                "country": rng.choice(["de", "fr", None], n),
+                "timestamp": rng.integers(0, 1000, n),
+                "citations": rng.integers(0, 50, n),
+            }
+        )
+        self.index = FilterIndex(self.df, ["a", "b", "c"], ["t0", "t1"], ["de", "fr"])
+
+    def test_mask_round_trip(self):
+        for bits in ([], [True], [True, False, True], list(np.arange(101) % 3 == 0)):
+            selected = np.array(bits, dtype=bool)
+            encoded = encode_mask(np.packbits(selected))
+            np.testing.assert_array_equal(decode_mask(encoded, len(selected)), selected)
+
+    def test_query_matches_the_rows(self):
+        df = self.df
+        result = self.index.query(
+            {"journal": [0, 2], "country": [1]}, {"citations": (10, 30)}, counts=True
+        )
+        expected = (
+            df["journal"].isin(["a", "c"])
+            & (df["country"] == "fr")
+            & df["citations"].between(10, 30)
+        ).to_numpy()
+
+        mask = decode_mask(encode_mask(result["mask"]), len(df))
+        np.testing.assert_array_equal(mask, expected)
+        self.assertEqual(result["count"], expected.sum())
+
+        # the counts of a facet leave out its own filter
+        others = (df["country"] == "fr") & df["citations"].between(10, 30)
+        journals = df.loc[others, "journal"].value_counts()
+        self.assertEqual(result["counts"]["journal"].tolist(), [journals.get(j, 0) for j in "abc"])
+
+    def test_without_filters(self):
+        self.assertIsNone(self.index.row_mask())
+        result = self.index.query()
+        self.assertEqual(result["count"], len(self.df))
+        self.assertTrue(decode_mask(encode_mask(result["mask"]), len(self.df)).all())
+
+    def test_unknown_codes_select_nothing(self):
+        self.assertEqual(self.index.query({"topic": [5, -1]})["count"], 0)
+
+
+class WarmupTest(SimpleTestCase):
+    def tearDown(self):
+        warmup._state.update(status="cold", error=None)
+
+    def test_failure_is_reported(self):
+        with mock.patch("sworm.warmup.warmup", side_effect=OSError("django-data.pkl missing")):
+            warmup.try_warmup()
+        self.assertEqual(
+            warmup.warmup_status(), {"status": "failed", "error": "django-data.pkl missing"}
+        )
+
+
+@override_settings(SWORM_TRAINING_CONCURRENCY=2)
+class TrainingQueueTest(TestCase):
+    def setUp(self):
+        self.users = [CustomUser.objects.create(username=f"user{i}") for i in range(3)]
+
+    def test_pending_jobs_are_coalesced(self):
+        job = enqueue_training(self.users[0])
+        self.assertEqual(enqueue_training(self.users[0]).pk, job.pk)
+        self.assertEqual(TrainingJob.objects.count(), 1)
+
+    def test_updates_are_coalesced(self):
+        user = self.users[0]
+        job = enqueue_update(user, 1, True)
+        self.assertEqual(enqueue_update(user, 2, False).pk, job.pk)
+        job.refresh_from_db()
+        self.assertEqual((job.kind, job.changes), (TrainingJob.UPDATE, [[1, True], [2, False]]))
+
+        # a fit covers the changes
+        self.assertEqual(enqueue_training(user).pk, job.pk)
+        self.assertEqual(enqueue_update(user, 3, True).pk, job.pk)
+        job.refresh_from_db()
+        self.assertEqual((job.kind, job.changes), (TrainingJob.FIT, []))
+
+    @override_settings(SWORM_RECOMMEND_INCREMENTAL=False)
+    def test_updates_can_be_turned_off(self):
+        self.assertIsNone(enqueue_update(self.users[0], 1, True))
+        self.assertFalse(TrainingJob.objects.exists())
+
+    def test_claim_job(self):
+        jobs = [enqueue_training(user) for user in self.users]
+        claimed = claim_job()
+        self.assertEqual(claimed.pk, jobs[0].pk)
+        claimed.refresh_from_db()
+        self.assertEqual(claimed.status, TrainingJob.RUNNING)
+        self.assertIsNotNone(claimed.started_on)
+        self.assertIsNotNone(claimed.heartbeat_on)
+
+        # a user with a running job can be queued again
+        self.assertNotEqual(enqueue_training(self.users[0]).pk, jobs[0].pk)
+
+        self.assertEqual(claim_job().pk, jobs[1].pk)
+        # at most SWORM_TRAINING_CONCURRENCY jobs run at the same time
+        self.assertIsNone(claim_job())
+        self.assertEqual(TrainingJob.objects.filter(status=TrainingJob.PENDING).count(), 2)
+
+    @mock.patch("sworm.training.load_training_data", return_value=(None, None))
+    def test_run_job(self, load_training_data):
+        user = self.users[0]
+        enqueue_training(user)
+        job = claim_job()
+        with mock.patch("sworm.views.helper_fit_recommender") as fit:
+            self.assertEqual(run_job(job.pk), TrainingJob.DONE)
+        fit.assert_called_once_with(None, user, None)
+        job.refresh_from_db()
+        self.assertIsNotNone(job.finished_on)
+
+        enqueue_training(user)
+        failed = claim_job()
+        with mock.patch("sworm.views.helper_fit_recommender", side_effect=ValueError("no data")):
+            self.assertEqual(run_job(failed.pk), TrainingJob.FAILED)
+        failed.refresh_from_db()
+        self.assertEqual(failed.error, "no data")
+        # only the latest finished job of a user is kept
+        self.assertFalse(TrainingJob.objects.filter(pk=job.pk).exists())
+
+    def test_refit_all_takes_every_slot(self):
+        enqueue_training(self.users[0])
+        refit = enqueue_refit_all()
+        self.assertEqual(enqueue_refit_all().pk, refit.pk)
+        enqueue_training(self.users[1])
+
+        fit = claim_job()
+        # the refit waits for the running fit
+        self.assertIsNone(claim_job())
+        TrainingJob.objects.filter(pk=fit.pk).update(status=TrainingJob.DONE)
+        self.assertEqual(claim_job().pk, refit.pk)
+        # no job starts next to the refit
+        self.assertIsNone(claim_job())
+
+        with mock.patch("sworm.training.refit_users") as refit_users:
+            self.assertEqual(run_job(refit.pk), TrainingJob.DONE)
+        refit_users.assert_called_once_with([user.pk for user in self.users], 2)
+        self.assertIsNotNone(claim_job())
+
+    @mock.patch("sworm.training.load_training_data", return_value=(None, None))
+    def test_run_update_job(self, load_training_data):
+        user = self.users[0]
+        enqueue_update(user, 1, True)
+        with mock.patch("sworm.views.helper_update_recommender") as update:
+            self.assertEqual(run_job(claim_job().pk), TrainingJob.DONE)
+        update.assert_called_once_with(None, user, [[1, True]], None)
+
+    def test_stale_jobs_fail(self):
+        for user in self.users[:2]:
+            enqueue_training(user)
+        lost, alive = claim_job(), claim_job()
+        TrainingJob.objects.update(heartbeat_on=timezone.now() - timedelta(minutes=10))
+        beat([alive.pk])
+
+        self.assertEqual(fail_stale_jobs(), 1)
+        lost.refresh_from_db()
+        alive.refresh_from_db()
+        self.assertEqual((lost.status, lost.error), (TrainingJob.FAILED, "Worker lost"))
+        self.assertEqual(alive.status, TrainingJob.RUNNING)
+        # the slot of the lost job is free again
+        enqueue_training(self.users[2])
+        self.assertIsNotNone(claim_job())
+
+
+@override_settings(SWORM_RECOMMEND_CENTROID_MAX=2, SWORM_RECOMMEND_MAX_UPDATES=3)
+class UpdateRecommenderTest(TestCase):
+    def setUp(self):
+        journal = Journal.objects.create(issn="0000-0000", name="Journal")
+        self.articles = [
+            Article.objects.create(
+                id=i, title=f"Article {i}", abstract="", publish_on="2020-01-01", journal=journal
+            )
+            for i in range(8)
+        ]
+        self.user = CustomUser.objects.create(username="user")
+        self.user.articles.add(*self.articles[:4])
+        self.df_theta = pd.DataFrame(index=pd.Index(range(8)))
+        self.X = sparse.random(8, 4, density=0.5, format="csr", random_state=0)
+        Recommendation.objects.create(
+            user=self.user,
+            ids=b"",
+            scores=b"",
+            coef=np.ones(4, dtype=np.float32).tobytes(),
+            updates=1,
+        )
+
+    def test_updates_queue_a_fit(self):
+        from sworm.views import helper_update_recommender
+
+        self.user.articles.add(self.articles[4])
+        helper_update_recommender(self.df_theta, self.user, [[4, True]], self.X)
+        recommendation = Recommendation.objects.get(user=self.user)
+        self.assertEqual(recommendation.updates, 2)
+        self.assertEqual(sorted(np.frombuffer(recommendation.ids, np.int64)), [5, 6, 7])
+        self.assertFalse(TrainingJob.objects.exists())
+
+        # the counter starts again when the fit is queued
+        self.user.articles.remove(self.articles[4])
+        helper_update_recommender(self.df_theta, self.user, [[4, False]], self.X)
+        self.assertEqual(Recommendation.objects.get(user=self.user).updates, 0)
+        self.assertEqual(TrainingJob.objects.get().kind, TrainingJob.FIT)
+
+    def test_centroid_without_articles_in_the_dataset_queues_a_fit(self):
+        from sworm.views import helper_fit_small_library
+
+        self.user.articles.set(self.articles[6:])
+        norms = np.sqrt(np.asarray(self.X.multiply(self.X).sum(axis=1)).ravel())
+        tfidf = (np.arange(6), self.X[:6], norms[:6])
+        with mock.patch("sworm.views.helper_tfidf", return_value=tfidf):
+            self.assertTrue(helper_fit_small_library(self.user, [6, 7]))
+        self.assertEqual(Recommendation.objects.get(user=self.user).ids, b"")
+        self.assertEqual(TrainingJob.objects.get().kind, TrainingJob.FIT)
+
+        # larger libraries are left to the fit
+        self.assertFalse(helper_fit_small_library(self.user, [4, 5, 6]))
+
+
+class TopRowsBatchTest(SimpleTestCase):
+    def test_matches_scoring_every_row(self):
+        rng = np.random.default_rng(0)
+        X = sparse.random(50, 8, density=0.5, format="csr", random_state=1)
+        coef, intercept = rng.normal(size=(3, 8)), rng.normal(size=3)
+        excluded = sparse.random(50, 3, density=0.2, format="csr", random_state=2).astype(bool)
+
+        # few cells per chunk, so that the top rows are merged across chunks
+        for k in (5, 50):
+            rows, scores = top_rows_batch(X, coef, intercept, excluded, k, max_cells=30)
+            self.assertEqual(rows.shape, (k, 3))
+            for model in range(3):
+                expected = X.dot(coef[model]) + intercept[model]
+                allowed = np.flatnonzero(~excluded[:, model].toarray().ravel())
+                top = allowed[np.argsort(-expected[allowed], kind="stable")][:k]
+                found = np.isfinite(scores[:, model])
+                np.testing.assert_array_equal(rows[found, model], top)
+                np.testing.assert_allclose(scores[found, model], expected[top])
+
+
+class LSHIndexTest(SimpleTestCase):
+    def test_arrays_round_trip(self):
+        rng = np.random.default_rng(0)
+        index = LSHIndex(LSHIndex.build_arrays(np.arange(200), rng.random((200, 16))))
+
+        with tempfile.NamedTemporaryFile(suffix=".npz") as f:
+            write_arrays(f, index.arrays())
+            f.flush()
+            loaded = LSHIndex(read_arrays(f.name))
+
+        self.assertEqual(len(loaded), 200)
+        np.testing.assert_array_equal(loaded.vector(199), index.vector(199))
+        for id in (0, 5, 199):
+            for expected, found in zip(index.similar([id]), loaded.similar([id])):
+                np.testing.assert_array_equal(expected, found)
+
+
+class TypeaheadIndexTest(SimpleTestCase):
+    def test_wide_range_finds_the_most_cited_names(self):
+        rng = np.random.default_rng(0)
+        # authors only, every name is in the range of "a" under each of its words
+        names = [f"ann {' '.join(['abc'] * int(n))}" for n in rng.integers(1, 8, 300)]
+        keys = [(name, item) for item, name in enumerate(names) for _ in name.split(" ")]
+        keys.sort()
+        index = TypeaheadIndex(
+            {
+                "keys": np.array([key.encode() for key, _ in keys], dtype=f"S{KEY_BYTES}"),
+                "entries": np.array([item for _, item in keys], dtype=np.int32),
+                "kinds": np.ones(len(names), dtype=np.int8),
+                "refs": np.array([str(i) for i in range(len(names))]),
+                "names": np.array(names),
+                "citations": rng.permutation(len(names)),
+            },
+            mock.MagicMock(n_rows=0),
+        )
+
+        for k in (1, 10, 50):
+            expected = np.argsort(-index.citations, kind="stable")[:k]
+            found = [int(suggestion["ref"]) for suggestion in index.suggest("a", k)]
+            self.assertEqual(found, list(expected))
+        self.assertEqual(index.suggest("a", 10, "journal"), [])
+
+
+class NormalizeArticlesTest(SimpleTestCase):
+    def test_articles_without_issn_are_skipped(self):
+        frame = pd.DataFrame(
+            {
+                "id": [1, 2, 3],
+                "title": ["a", "b", "c"],
+                "abstract": ["", "", ""],
+                "date": ["2020-01-01"] * 3,
+                "topics": ["", "", ""],
+                "journal": ["Journal", "", None],
+                "journal-issn": ["0000-0000", "", None],
+                "citations": [1.0, np.nan, 3.0],
+                "country": ["de", "", ""],
+                "doi": ["", "", ""],
+                "x1": [0.0, 0.0, 0.0],
+                "x2": [0.0, 0.0, 0.0],
+                "author": ["Author 1, Author 2", "", ""],
+                "author-id": [[1, 2], [-1, -1], [-1, -1]],
+            }
+        )
+        batch = normalize_articles(frame)
+        self.assertEqual(len(batch), 1)
+        article, journal, country, authors = batch[0]
+        self.assertEqual((article.id, article.journal_id, journal), (1, "0000-0000", "Journal"))
+        self.assertIsNone(article.lda_topics)
+        self.assertEqual((country, authors), ("de", [(1, "Author 1"), (2, "Author 2")]))
+
+
+class SearchWithoutSqliteTest(SimpleTestCase):
+    def test_other_databases_do_not_query_the_index(self):
+        # a query would fail, tests without a database may not run any
+        with mock.patch.object(connection, "vendor", "postgresql"):
+            result = search_articles("topic model")
+            optimize_search_index()
+        self.assertEqual((result["count"], result["available"]), (0, False))
+
+
+class ImportCorpusTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.version = 0
+        self.tfidf = sparse.random(5, 7, density=0.4, format="csr", random_state=0)
+        self.frame = pd.DataFrame(
+            {
+                "date": pd.to_datetime(["2020-01-01"] * 5),
+                "title": [
+                    f"Article {word}" for word in ("alpha", "beta", "gamma", "delta", "eta")
+                ],
+                "abstract": ["Topic models of words"] * 5,
+                "author": ["Ada Lovelace, Alan Turing", "Alan Turing", "", "Grace Hopper", ""],
+                "journal": ["Journal 0", "Journal 0", "Journal 1", "Journal 1", "Journal 1"],
+                "journal-issn": ["1234-0000", "1234-0000", "1234-0001", "1234-0001", "1234-0001"],
+                "topics": ["topic 0"] * 5,
+                "citations": [5, 4, 3, 2, 1],
+                "country": ["Germany", "Germany", "France", "", ""],
+                "doi": [f"10.1/{i}" for i in range(5)],
+                "x1": np.zeros(5),
+                "x2": np.zeros(5),
+                "author-id": [[1, 2], [2], [], [3], []],
+            },
+            index=[f"SCOPUS_ID:{i}" for i in range(1, 6)],
+        )
+
+    def store(self, frame):
+        """
+        Store of a new snapshot with the articles of the frame, every store is another version
+        """
+        self.version += 1
+        snapshot = join(self.dir, f"v{self.version}")
+        os.mkdir(snapshot)
+        frame.to_pickle(join(snapshot, SOURCES["articles"]))
+        pd.DataFrame({"topic": ["topic 0"]}).to_pickle(join(snapshot, SOURCES["topics"]))
+        pd.DataFrame({"journal": ["Journal 0"]}).to_pickle(join(snapshot, SOURCES["journals"]))
+        pd.to_pickle({}, join(snapshot, SOURCES["neighbors"]))
+        pd.DataFrame(index=frame.index).to_pickle(join(snapshot, django_theta_file))
+        pd.to_pickle(self.tfidf[: len(frame)], join(snapshot, SOURCES["tfidf"]))
+        path = join(self.dir, f"store-{self.version}")
+        build_store(path, snapshot, str(self.version), 0)
+        return Store(path)
+
+    def run_import(self, frame, **kwargs):
+        return dict(list(import_corpus(self.store(frame), **kwargs))[-1])
+
+    def search(self, text):
+        return [article["id"] for article in search_articles(text)["articles"]]
+
+    def test_unchanged_articles_are_not_written(self):
+        counts = self.run_import(self.frame)
+        self.assertEqual(counts, {"inserted": 5, "updated": 0, "unchanged": 0, "deleted": 0})
+        article = Article.objects.get(id=1)
+        self.assertEqual((article.journal_id, article.country.name), ("1234-0000", "Germany"))
+        self.assertEqual(
+            list(article.authors.order_by("id").values_list("name", flat=True)),
+            ["Ada Lovelace", "Alan Turing"],
+        )
+        self.assertIsNone(Article.objects.get(id=4).country)
+
+        counts = self.run_import(self.frame)
+        self.assertEqual(counts, {"inserted": 0, "updated": 0, "unchanged": 5, "deleted": 0})
+        self.assertFalse(ImportCheckpoint.objects.exists())
+
+    def test_changed_articles_are_updated(self):
+        self.run_import(self.frame)
+        frame = self.frame.copy()
+        frame.loc["SCOPUS_ID:2", "title"] = "Article omega"
+        frame.at["SCOPUS_ID:3", "author-id"] = [3]
+        frame.loc["SCOPUS_ID:3", "author"] = "Grace Hopper"
+
+        counts = self.run_import(frame)
+        self.assertEqual(counts, {"inserted": 0, "updated": 2, "unchanged": 3, "deleted": 0})
+        self.assertEqual(Article.objects.get(id=2).title, "Article omega")
+        self.assertEqual(list(Article.objects.get(id=3).authors.values_list("id", flat=True)), [3])
+
+    def test_fingerprints_hash_the_values_of_the_export(self):
+        article = Article(id=1, title="a", publish_on="2020-01-01", journal_id="1234-0000")
+        article.citations, article.country_id = np.int64(5), 1
+        expected = fingerprint(article, "Germany", [np.int64(1)])
+        # a fresh database numbers the countries differently, an export may store floats
+        article.citations, article.country_id = 5.0, 7
+        self.assertEqual(fingerprint(article, "Germany", [1]), expected)
+        self.assertNotEqual(fingerprint(article, "France", [1]), expected)
+
+    def test_missing_articles_are_deleted_unless_kept(self):
+        self.run_import(self.frame)
+        counts = self.run_import(self.frame.drop("SCOPUS_ID:5"), delete=False)
+        self.assertEqual(counts["deleted"], 0)
+        self.assertTrue(Article.objects.filter(id=5).exists())
+
+        counts = self.run_import(self.frame.drop(["SCOPUS_ID:1", "SCOPUS_ID:5"]), batch_size=2)
+        self.assertEqual(counts["deleted"], 2)
+        self.assertEqual(sorted(Article.objects.values_list("id", flat=True)), [2, 3, 4])
+
+    def test_stopped_import_is_resumed(self):
+        store = self.store(self.frame)
+        # stop after the first batch was committed
+        results = import_corpus(store, batch_size=2)
+        next(results)
+        results.close()
+        self.assertEqual(ImportCheckpoint.objects.get(source=store.version).position, 2)
+
+        with mock.patch("sworm.corpus.write_articles", wraps=write_articles) as write:
+            counts = dict(list(import_corpus(store, batch_size=2))[-1])
+        written = [[a.id for a, _, _, _ in call.args[0]] for call in write.call_args_list]
+        self.assertEqual(written, [[3, 4], [5]])
+        self.assertEqual(counts, {"inserted": 5, "updated": 0, "unchanged": 0, "deleted": 0})
+        self.assertEqual(Article.objects.count(), 5)
+
+    def test_tfidf_matrix_is_mapped(self):
+        table = self.store(self.frame)["tfidf"]
+        X = tfidf_matrix(table)
+        self.assertTrue(np.shares_memory(X.data, table["weights"].values))
+        self.assertEqual(abs(X - self.tfidf).max(), 0)
+        self.assertEqual(table["id"].tolist(), [1, 2, 3, 4, 5])
+        np.testing.assert_allclose(table["norm"], sparse.linalg.norm(self.tfidf, axis=1))
+
+    def test_search_index_follows_the_articles(self):
+        self.run_import(self.frame)
+        self.assertEqual(self.search("beta"), [2])
+        self.assertEqual(sorted(self.search("Turing")), [1, 2])
+
+        frame = self.frame.drop("SCOPUS_ID:1")
+        frame.loc["SCOPUS_ID:2", "title"] = "Article omega"
+        self.run_import(frame)
+        self.assertEqual(self.search("beta"), [])
+        self.assertEqual(self.search("omega"), [2])
+        self.assertEqual(self.search("Lovelace"), [])
@@ -0,0 +1,377 @@
+"""
+Database backed queue for fitting recommenders.
+
+Requests only enqueue a `TrainingJob`, `manage.py train_worker` claims the jobs and fits them in a
+pool of processes. Saving or removing an article queues an update job instead, which is cheaper
+than a fit. Pending jobs of a user are coalesced into one and at most
+`SWORM_TRAINING_CONCURRENCY` jobs run at the same time, across all workers. Workers beat the
+heartbeat of their running jobs on every poll, the jobs of a worker that is gone are failed by the
+other workers after `HEARTBEAT_TIMEOUT`.
+"""
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db import IntegrityError, connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from scipy import sparse
+
+from sworm.bokeh_data import get_dataset
+from sworm.models import CustomUser, TrainingJob
+
+log = logging.getLogger(__name__)
+
+HEARTBEAT_TIMEOUT = timedelta(minutes=5)
+
+
+def training_concurrency():
+    return getattr(settings, "SWORM_TRAINING_CONCURRENCY", 2)
+
+
+def recommend_top_k():
+    return getattr(settings, "SWORM_RECOMMEND_TOP_K", 100)
+
+
+def recommend_incremental():
+    return getattr(settings, "SWORM_RECOMMEND_INCREMENTAL", True)
+
+
+def enqueue_training(user):
+    """
+    Queue a fit of the recommender of the user, returns the pending job of the user if there is
+    one already. A pending update job becomes a fit, which covers its changes.
+    """
+    for _ in range(3):
+        try:
+            with transaction.atomic():
+                return TrainingJob.objects.create(user=user)
+        except IntegrityError:
+            pass
+        try:
+            job = TrainingJob.objects.get(user=user, status=TrainingJob.PENDING)
+        except TrainingJob.DoesNotExist:
+            # claimed by a worker in the meantime
+            continue
+        if job.kind == TrainingJob.FIT:
+            return job
+        if TrainingJob.objects.filter(pk=job.pk, status=TrainingJob.PENDING).update(
+            kind=TrainingJob.FIT, changes=[]
+        ):
+            job.kind, job.changes = TrainingJob.FIT, []
+            return job
+    raise RuntimeError(f"Could not queue training for {user}")
+
+
+def enqueue_refit_all():
+    """
+    Queue a refit of all users with `refit_users`, returns the pending refit if there is one
+    already
+    """
+    for _ in range(3):
+        try:
+            with transaction.atomic():
+                return TrainingJob.objects.create(kind=TrainingJob.REFIT_ALL)
+        except IntegrityError:
+            pass
+        job = TrainingJob.objects.filter(
+            kind=TrainingJob.REFIT_ALL, status=TrainingJob.PENDING
+        ).first()
+        if job is not None:
+            return job
+    raise RuntimeError("Could not queue a refit of all users")
+
+
+def enqueue_update(user, id, saved):
+    """
+    Queue an update of the recommender of the user after saving or removing an article, see
+    `sworm.views.helper_update_recommender`. The change is added to the pending job of the user if
+    there is one. Returns the job, None if incremental updates are off.
+    """
+    if not recommend_incremental():
+        return None
+    change = [id, saved]
+    for _ in range(3):
+        try:
+            with transaction.atomic():
+                return TrainingJob.objects.create(
+                    user=user, kind=TrainingJob.UPDATE, changes=[change]
+                )
+        except IntegrityError:
+            pass
+        with transaction.atomic():
+            job = (
+                TrainingJob.objects.select_for_update()
+                .filter(user=user, status=TrainingJob.PENDING)
+                .first()
+            )
+            if job is None:
+                # claimed by a worker in the meantime
+                continue
+            if job.kind == TrainingJob.FIT:
+                # the fit covers the change
+                return job
+            job.changes.append(change)
+            if TrainingJob.objects.filter(pk=job.pk, status=TrainingJob.PENDING).update(
+                changes=job.changes
+            ):
+                return job
+    raise RuntimeError(f"Could not queue update for {user}")
+
+
+def claim_job():
+    """
+    Mark the oldest pending job as running and return it, None if there is none or if the maximum
+    number of jobs is running. A refit of all users takes all `SWORM_TRAINING_CONCURRENCY` slots,
+    it waits for the running jobs and no other job starts while it runs.
+    """
+    with transaction.atomic():
+        running = TrainingJob.objects.filter(status=TrainingJob.RUNNING)
+        if (
+            running.count() >= training_concurrency()
+            or running.filter(kind=TrainingJob.REFIT_ALL).exists()
+        ):
+            return None
+        job = TrainingJob.objects.filter(status=TrainingJob.PENDING).order_by("created_on").first()
+        if job is None or (job.kind == TrainingJob.REFIT_ALL and running.exists()):
+            return None
+        now = timezone.now()
+        claimed = TrainingJob.objects.filter(pk=job.pk, status=TrainingJob.PENDING).update(
+            status=TrainingJob.RUNNING, started_on=now, heartbeat_on=now
+        )
+    return job if claimed else None
+
+
+def load_training_data():
+    """
+    Thetas and TF-IDF matrix of the articles, cached on the dataset. Processes forked after
+    loading share them read-only instead of unpickling them again.
+    """
+    # the views import this module
+    from sworm.views import helper_load_tfidf, helper_load_thetas
+
+    dataset = get_dataset()
+    return dataset.cached("thetas", helper_load_thetas), dataset.cached("tfidf", helper_load_tfidf)
+
+
+def training_pool(processes):
+    """
+    Pool of processes forked from this one, so that they share the loaded training data
+    """
+    # imported before forking, so that the processes do not import it each
+    import sklearn.svm  # noqa: F401
+
+    # forked processes must open their own connections
+    connections.close_all()
+    return ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("fork"))
+
+
+def run_job(job_id):
+    """
+    Fit or update the recommender of a claimed job and record the outcome. A refit of all users
+    runs on `SWORM_TRAINING_CONCURRENCY` processes of its own.
+    """
+    from sworm.views import helper_fit_recommender, helper_update_recommender
+
+    job = TrainingJob.objects.select_related("user").get(pk=job_id)
+    t0 = time.perf_counter()
+    try:
+        if job.kind == TrainingJob.REFIT_ALL:
+            user_ids = list(CustomUser.objects.order_by("id").values_list("id", flat=True))
+            refit_users(user_ids, training_concurrency())
+        else:
+            df_theta, X = load_training_data()
+            if job.kind == TrainingJob.UPDATE:
+                helper_update_recommender(df_theta, job.user, job.changes, X)
+            else:
+                helper_fit_recommender(df_theta, job.user, X)
+        job.status = TrainingJob.DONE
+    except Exception as e:
+        log.exception(e)
+        job.status, job.error = TrainingJob.FAILED, str(e)
+    job.finished_on = timezone.now()
+    job.save(update_fields=["status", "error", "finished_on"])
+    log.info(f"{job} took {time.perf_counter() - t0} s")
+
+    # only the latest finished job of a user is kept, and the latest refit of all users
+    TrainingJob.objects.filter(
+        user_id=job.user_id, status__in=[TrainingJob.DONE, TrainingJob.FAILED]
+    ).exclude(pk=job.pk).delete()
+    return job.status
+
+
+def beat(job_ids):
+    """
+    Update the heartbeat of the running jobs of this worker
+    """
+    return TrainingJob.objects.filter(pk__in=job_ids, status=TrainingJob.RUNNING).update(
+        heartbeat_on=timezone.now()
+    )
+
+
+def fail_job(job_id, error):
+    """
+    Mark a running job as failed whose process did not record the outcome
+    """
+    return TrainingJob.objects.filter(pk=job_id, status=TrainingJob.RUNNING).update(
+        status=TrainingJob.FAILED, finished_on=timezone.now(), error=error
+    )
+
+
+def fail_stale_jobs(timeout=HEARTBEAT_TIMEOUT):
+    """
+    Mark running jobs as failed whose heartbeat is older than the timeout, their worker is gone
+    """
+    cutoff = timezone.now() - timeout
+    # jobs claimed before there were heartbeats only have the time they started
+    stale = Q(heartbeat_on__lt=cutoff) | Q(heartbeat_on=None, started_on__lt=cutoff)
+    return TrainingJob.objects.filter(stale, status=TrainingJob.RUNNING).update(
+        status=TrainingJob.FAILED, finished_on=timezone.now(), error="Worker lost"
+    )
+
+
+def fit_user(user_id, force=False):
+    """
+    Fit the recommender of a user without scoring the articles, returns the user id, whether it
+    was fitted, the model and the seconds fitting took. The model holds the coefficients, the
+    intercept, the saved rows and the library fingerprint of the SVM. It is None if the user was
+    skipped or if the library was small enough to be scored by its centroid right away.
+    """
+    from sworm.views import (
+        helper_fit_centroid,
+        helper_fit_svm,
+        helper_library_to_fit,
+        helper_use_centroid,
+    )
+
+    t0 = time.perf_counter()
+    df_theta, X = load_training_data()
+    user = CustomUser.objects.get(pk=user_id)
+    library = helper_library_to_fit(user, force)
+    if library is None:
+        return user_id, False, None, time.perf_counter() - t0
+
+    ids, fingerprint = library
+    if helper_use_centroid(ids):
+        fitted = helper_fit_centroid(user, ids, fingerprint)
+        return user_id, fitted, None, time.perf_counter() - t0
+
+    coef, intercept, saved = helper_fit_svm(df_theta, ids, X)
+    model = (coef, intercept, np.flatnonzero(saved), fingerprint)
+    return user_id, True, model, time.perf_counter() - t0
+
+
+def fit_users(user_ids, processes=None, force=False):
+    """
+    Fit the recommenders of the users whose library changed since their last fit in a pool of
+    processes, yields the results of `fit_user` as the users finish
+    """
+    load_training_data()
+    with training_pool(processes or multiprocessing.cpu_count()) as pool:
+        futures = [pool.submit(fit_user, user_id, force) for user_id in user_ids]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def refit_users(user_ids, processes=None, force=False, write=log.info):
+    """
+    Fit the recommenders of the users with `fit_users` and score the articles for all of them in
+    one pass with `store_users`, returns the number of users fitted
+
+    :param write: called with a line of progress per user
+    """
+    t0 = time.perf_counter()
+    models, n_fitted = {}, 0
+    for user_id, fitted, model, seconds in fit_users(user_ids, processes, force):
+        n_fitted += fitted
+        if model is not None:
+            models[user_id] = model
+        write(f"User {user_id}: {'fitted' if fitted else 'skipped'} {seconds:.3f} s")
+
+    t1 = time.perf_counter()
+    store_users(models)
+    write(f"Scoring {len(models)} users took {time.perf_counter() - t1:.3f} s")
+
+    seconds = time.perf_counter() - t0
+    write(
+        f"Fitted {n_fitted} of {len(user_ids)} users in {seconds:.3f} s "
+        f"({n_fitted / seconds:.2f} users/s)"
+    )
+    return n_fitted
+
+
+def top_rows_batch(X, coef, intercept, excluded, k, max_cells=2**24):
+    """
+    Rows of the k highest scores of several linear models in descending order, computed in one
+    pass over X in chunks of rows that hold at most max_cells scores
+
+    :param coef: coefficients of the models, one row per model
+    :param excluded: sparse matrix of the rows excluded per model, one column per model
+    :return: rows and scores with one column per model, rows that do not make it into the top k
+        of a model, for instance because there are not enough rows, have a score of -inf
+    """
+    n_rows, n_models = X.shape[0], len(coef)
+    chunk = max(1, max_cells // n_models)
+    rows = np.zeros((0, n_models), dtype=np.int64)
+    scores = np.zeros((0, n_models))
+    for start in range(0, n_rows, chunk):
+        end = min(start + chunk, n_rows)
+        chunk_scores = np.asarray(X[start:end].dot(coef.T)) + intercept
+        chunk_scores[excluded[start:end].nonzero()] = -np.inf
+        chunk_rows = np.broadcast_to(np.arange(start, end)[:, None], chunk_scores.shape)
+
+        # merge the chunk into the top k so far
+        scores = np.vstack([scores, chunk_scores])
+        rows = np.vstack([rows, chunk_rows])
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1, axis=0)[:k]
+            scores = np.take_along_axis(scores, top, axis=0)
+            rows = np.take_along_axis(rows, top, axis=0)
+
+    order = np.argsort(-scores, axis=0, kind="stable")
+    return np.take_along_axis(rows, order, axis=0), np.take_along_axis(scores, order, axis=0)
+
+
+def store_users(models):
+    """
+    Score the articles for the fitted models of `fit_user` in one pass and store the
+    recommendations
+
+    :param models: maps user ids to their models
+    """
+    from sworm.views import helper_store_recommends
+
+    if not models:
+        return
+    df_theta, X = load_training_data()
+    user_ids = list(models)
+    coef = np.stack([models[user_id][0] for user_id in user_ids])
+    intercept = np.array([models[user_id][1] for user_id in user_ids])
+
+    saved = [models[user_id][2] for user_id in user_ids]
+    excluded = sparse.csr_matrix(
+        (
+            np.ones(sum(len(s) for s in saved), dtype=bool),
+            (np.concatenate(saved), np.repeat(np.arange(len(saved)), [len(s) for s in saved])),
+        ),
+        shape=(X.shape[0], len(user_ids)),
+    )
+
+    rows, scores = top_rows_batch(X, coef, intercept, excluded, recommend_top_k())
+
+    ids = df_theta.index.to_numpy(np.int64)
+    users = CustomUser.objects.in_bulk(user_ids)
+    for column, user_id in enumerate(user_ids):
+        found = np.isfinite(scores[:, column])
+        model = models[user_id]
+        helper_store_recommends(
+            users[user_id],
+            ids[rows[found, column]],
+            scores[found, column],
+            model[3],
+            model[:2],
+        )
@@ -0,0 +1,220 @@
+"""
+Typeahead suggestions of articles, authors and journals.
+
+Every title and name is folded to lower case words without accents, and is indexed under every
+suffix that starts at a word, so that typing any word of a name finds it. The keys are UTF-8
+bytes cut to `KEY_BYTES` in one sorted array, the names starting with a prefix are a contiguous
+range of it that is found by two binary searches. The names in the range are ranked by their
+citations, the citations of an author or a journal are the sum of the citations of their articles.
+The index is built from the data store once per dataset version.
+"""
+import logging
+import re
+import time
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+from sworm.bokeh_data import get_dataset
+from sworm.file_cache import load_or_build, read_arrays, write_arrays
+
+log = logging.getLogger(__name__)
+
+KINDS = ("article", "author", "journal")
+
+# longer prefixes are cut as well, the suggestions for them may not match beyond this length
+KEY_BYTES = 32
+
+# words shorter than this are not indexed unless a name starts with them
+MIN_WORD = 3
+
+WORD = re.compile(r"\w+")
+
+
+def fold(text):
+    """
+    Lower case words of a text without accents, separated by single spaces
+    """
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(WORD.findall(text.lower()))
+
+
+def _keys(name):
+    """
+    Keys of a name, one per suffix starting at a word
+    """
+    words = fold(name).split(" ")
+    return [
+        " ".join(words[i:]).encode()[:KEY_BYTES]
+        for i in range(len(words))
+        if i == 0 or len(words[i]) >= MIN_WORD
+    ]
+
+
+class TypeaheadIndex:
+    """
+    Sorted prefix keys of the names of articles, authors and journals, see the module
+    """
+
+    def __init__(self, arrays, articles):
+        self.keys = arrays["keys"]
+        self.entries = arrays["entries"]
+        self.kinds = arrays["kinds"]
+        self.refs = arrays["refs"]
+        self.names = arrays["names"]
+        self.citations = arrays["citations"]
+        # titles are read from the store, the other names are kept after them
+        self.articles = articles
+
+    @staticmethod
+    def build_arrays(articles):
+        """
+        :param articles: `sworm.data_store.Table` of the articles
+        """
+        t0 = time.perf_counter()
+        citations = pd.Series(articles["citations"]).fillna(0).to_numpy(np.int64)
+
+        journals = (
+            pd.DataFrame(
+                {
+                    "issn": articles.series("journal-issn").astype(object),
+                    "name": articles.series("journal").astype(object),
+                    "citations": citations,
+                }
+            )
+            .dropna()
+            .groupby("issn")
+            .agg(name=("name", "first"), citations=("citations", "sum"))
+        )
+
+        # the first name found for an author id is used, like the import does
+        authors, author_citations = {}, {}
+        author_ids = articles["author-id"]
+        for row, text in enumerate(articles.series("author")):
+            if not isinstance(text, str) or not text:
+                continue
+            for ident, name in zip(author_ids[row], text.split(",")):
+                if ident >= 0:
+                    authors.setdefault(int(ident), name.strip())
+                    author_citations[int(ident)] = (
+                        author_citations.get(int(ident), 0) + citations[row]
+                    )
+
+        kinds = np.concatenate(
+            [
+                np.full(articles.n_rows, 0, dtype=np.int8),
+                np.full(len(authors), 1, dtype=np.int8),
+                np.full(len(journals), 2, dtype=np.int8),
+            ]
+        )
+        refs = [str(i) for i in authors] + list(journals.index)
+        names = list(authors.values()) + list(journals["name"])
+        citations = np.concatenate(
+            [
+                citations,
+                np.fromiter(author_citations.values(), np.int64, len(authors)),
+                journals["citations"].to_numpy(np.int64),
+            ]
+        )
+
+        keys, entries = [], []
+        titles = articles.series("title").fillna("")
+        for item, name in enumerate(list(titles) + names):
+            for key in _keys(name):
+                if key:
+                    keys.append(key)
+                    entries.append(item)
+        keys = np.array(keys, dtype=f"S{KEY_BYTES}")
+        order = np.argsort(keys, kind="stable")
+
+        log.info(
+            f"Building typeahead index with {len(keys)} keys of {len(kinds)} names took "
+            f"{time.perf_counter() - t0} s"
+        )
+        return {
+            "keys": keys[order],
+            "entries": np.array(entries, dtype=np.int32)[order],
+            "kinds": kinds,
+            "refs": np.array(refs, dtype=str),
+            "names": np.array(names, dtype=str),
+            "citations": citations,
+        }
+
+    def _range(self, prefix):
+        """
+        Positions of the first key starting with the prefix and after the last one
+        """
+        start = np.searchsorted(self.keys, prefix, side="left")
+        if len(prefix) < KEY_BYTES:
+            # UTF-8 has no 0xff byte, every key starting with the prefix is smaller
+            end = np.searchsorted(self.keys, prefix + b"\xff", side="left")
+        else:
+            end = np.searchsorted(self.keys, prefix, side="right")
+        return start, end
+
+    def suggest(self, text, k=10, kind=None):
+        """
+        Kind, reference, name and citations of the k most cited names with a word starting with
+        the text, the reference is the id of an article or author and the ISSN of a journal
+
+        :param kind: one of `KINDS` to suggest only names of that kind
+        """
+        prefix = fold(text).encode()[:KEY_BYTES]
+        if not prefix:
+            return []
+        start, end = self._range(prefix)
+        entries = self.entries[start:end]
+        if kind is not None:
+            entries = entries[self.kinds[entries] == KINDS.index(kind)]
+
+        # a short prefix has a wide range, only its most cited entries are deduplicated. A name is
+        # in the range once per matching word, so the cap grows until it holds k distinct names.
+        cap = k
+        while True:
+            top = entries
+            if len(entries) > cap:
+                top = entries[np.argpartition(-self.citations[entries], cap - 1)[:cap]]
+            items = np.unique(top)
+            if len(items) >= k or len(top) == len(entries):
+                break
+            cap *= 2
+        if len(items) > k:
+            items = items[np.argpartition(-self.citations[items], k - 1)[:k]]
+        items = items[np.argsort(-self.citations[items], kind="stable")]
+
+        n_articles = self.articles.n_rows
+        rows = items[items < n_articles]
+        titles = dict(zip(rows, self.articles.series("title", rows)))
+        ids = dict(zip(rows, self.articles["id"][rows]))
+        return [
+            {
+                "kind": KINDS[self.kinds[item]],
+                "ref": str(ids[item]) if item < n_articles else str(self.refs[item - n_articles]),
+                "name": titles[item] if item < n_articles else str(self.names[item - n_articles]),
+                "citations": int(self.citations[item]),
+            }
+            for item in items
+        ]
+
+
+def get_typeahead_index():
+    """
+    The index is built once per dataset version and shared between workers through the cache
+    directory
+    """
+    dataset = get_dataset()
+
+    def build():
+        arrays = load_or_build(
+            "typeahead",
+            dataset.version,
+            ".npz",
+            lambda: TypeaheadIndex.build_arrays(dataset.articles),
+            read_arrays,
+            write_arrays,
+        )
+        return TypeaheadIndex(arrays, dataset.articles)
+
+    return dataset.cached("typeahead index", build)
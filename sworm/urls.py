@@ -4,8 +4,16 @@ from .views import (
     SignUpView,
     endpoint_fir_all_recommender,
     endpoint_fit_recommender,
+    endpoint_library_similar,
+    endpoint_map_article,
+    endpoint_map_density,
+    endpoint_map_filter,
+    endpoint_map_tile,
     endpoint_populate_db,
+    endpoint_ready,
     endpoint_save_article,
+    endpoint_search,
+    endpoint_typeahead,
     endpoint_unsave_article,
     view_articles,
     view_author,
@@ -13,6 +21,7 @@ from .views import (
     view_journal,
     view_library,
     view_map,
+    view_search,
 )
 
 urlpatterns = [
@@ -23,7 +32,16 @@ urlpatterns = [
     path("journal/<str:issn>", view_journal, name="journal"),
     path("library/", view_library, name="library"),
     path("imprint/", view_impress, name="imprint"),
+    path("search/", view_search, name="search"),
     # services
+    path("map/article/<int:id>", endpoint_map_article, name="map_article"),
+    path("map/filter/", endpoint_map_filter, name="map_filter"),
+    path("map/tiles/<int:z>/<int:x>/<int:y>", endpoint_map_tile, name="map_tile"),
+    path("map/density/", endpoint_map_density, name="map_density"),
+    path("search/articles/", endpoint_search, name="search_articles"),
+    path("search/typeahead/", endpoint_typeahead, name="typeahead"),
+    path("ready/", endpoint_ready, name="ready"),
+    path("library/similar/", endpoint_library_similar, name="library_similar"),
     path("add/<str:id>", endpoint_save_article, name="add_to_library"),
     path("remove/<str:id>", endpoint_unsave_article, name="remove_from_library"),
     # helpers for administration
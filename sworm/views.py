@@ -1,47 +1,47 @@
+import hashlib
 import logging
+import os
 import pickle
 import time
-from datetime import date
+from datetime import datetime, timezone
 from os.path import abspath, dirname, exists, join
 
 import numpy as np
 import pandas as pd
-from bokeh.embed import components
-from bokeh.layouts import column, row
-from bokeh.models import (
-    ColumnDataSource,
-    CustomJS,
-    DateRangeSlider,
-    Div,
-    MultiSelect,
-    RangeSlider,
-    TapTool,
-    TextInput,
-)
-from bokeh.models.widgets import Panel, Tabs
-from bokeh.plotting import figure
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.shortcuts import redirect, render
-from django.urls import reverse_lazy
+from django.urls import reverse, reverse_lazy
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.views.generic.edit import CreateView
-from sklearn import neighbors, svm
 
-import sworm.bokeh_callbacks as cb
-from sworm.bokeh_data import country_list, df, journal_list, topic_list
+from sworm.bokeh_data import get_dataset
 
-from .bokeh_helpers import map_create_color_mapper, map_create_hover_tool
+from .ann import get_ann_index
+from .data_store import django_tfidf_file, django_theta_file, tfidf_matrix
 from .forms import CustomUserCreationForm
-from .models import Article, Author, Country, CustomUser, Journal
+from .map_cache import get_map_document, map_cache_key
+from .map_density import DENSITY_RESOLUTIONS, encode_image, get_density_grid
+from .map_filter import encode_mask, get_filter_index
+from .map_tiles import get_tile_index, tile_data
+from .models import Article, Author, Journal, Recommendation
+from .search import search_articles
+from .training import (
+    enqueue_refit_all,
+    enqueue_training,
+    enqueue_update,
+    recommend_top_k,
+)
+from .typeahead import KINDS, get_typeahead_index
+from .warmup import start_warmup, warmup_status
 
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
 data_dir = join(abspath(join(dirname(__file__), "..")), "data")
-django_nn_tfidf_file = join(data_dir, "nn-tfidf.pkl")
-django_theta_file = join(data_dir, "django-theta.pkl")
-django_tfidf_file = join(data_dir, "django-articles-tfidf.pkl")
-
-nearest_neighbors_cache = pickle.load(open(django_nn_tfidf_file, "rb"))
 
 
 class SignUpView(CreateView):
@@ -51,15 +51,22 @@ class SignUpView(CreateView):
 
 
 def helper_load_thetas():
-    df_theta = pd.read_pickle(django_theta_file)
-    df_theta.reset_index(inplace=True)
-    df_theta["index"] = df_theta["index"].apply(lambda x: int(x.replace("SCOPUS_ID:", "")))
-    df_theta.set_index("index", inplace=True)
+    df_theta = pd.read_pickle(join(get_dataset().snapshot, django_theta_file))
+    df_theta.index = df_theta.index.str.replace("SCOPUS_ID:", "", regex=False).astype(np.int64)
     return df_theta
 
 
+def helper_score_ids():
+    """
+    Article id of each row of the thetas and the tf-idf matrix, which the recommender scores are
+    aligned with. Read once per dataset version.
+    """
+    dataset = get_dataset()
+    return dataset.cached("score ids", lambda: helper_load_thetas().index.to_numpy(np.int64))
+
+
 def helper_load_tfidf():
-    return pickle.load(open(django_tfidf_file, "rb"))
+    return pickle.load(open(join(get_dataset().snapshot, django_tfidf_file), "rb"))
 
 
 def view_author(request, id: int):
@@ -69,17 +76,24 @@ def view_author(request, id: int):
 
 
 def view_articles(request, id: int):
-    article = Article.objects.get(id=id)
-    authors = article.authors.all()
-
-    authors = [a.name for a in authors]
+    article = (
+        Article.objects.select_related("journal", "country").prefetch_related("authors").get(id=id)
+    )
+    authors = [a.name for a in article.authors.all()]
 
     similar_articles = []
 
     try:
-        for i in nearest_neighbors_cache[id][1:]:
-            sim = Article.objects.filter(id=int(i)).get()
-            similar_articles.append(sim)
+        neighbors = get_dataset().neighbors
+        try:
+            # rows of the neighbors, the first is the article itself, padded with -1
+            rows = neighbors["neighbors"][neighbors.find(article.id)][1:]
+            ids = [int(i) for i in neighbors["id"][rows[rows >= 0]]]
+        except KeyError:
+            # articles added after the neighbors were computed
+            ids = [int(i) for i in get_ann_index().similar([article.id], k=5)[0]]
+        found = Article.objects.select_related("journal").prefetch_related("authors").in_bulk(ids)
+        similar_articles = [found[i] for i in ids if i in found]
     except Exception as e:
         log.exception(e)
 
@@ -111,10 +125,12 @@ def view_journal(request, issn):
 @login_required
 def endpoint_fit_recommender(request):
     """
-    Fitting SVM recommender for single user
+    Queue fitting the SVM recommender for a single user, see sworm.training. Small libraries
+    are scored by their centroid right away.
     """
-    df_theta = helper_load_thetas()
-    helper_fit_recommender(df_theta, request.user)
+    ids = list(request.user.articles.order_by("id").values_list("id", flat=True))
+    if not helper_fit_small_library(request.user, ids):
+        enqueue_training(request.user)
     return redirect(view_library)
 
 
@@ -124,258 +140,621 @@ def endpoint_fir_all_recommender(request):
         log.error("Illegal Access")
         return redirect(view_library)
 
-    users = CustomUser.objects.order_by("id")
-    log.info(f"Training for {len(users)} users")
+    # fitted in one batch by the worker, which scores all users in one pass
+    log.info(f"Queueing {enqueue_refit_all()}")
+    return redirect(view_library)
 
-    df_theta = helper_load_thetas()
 
-    for user in users:
-        helper_fit_recommender(df_theta, user)
+def helper_fit_recommender(df_theta, user, X=None, force=False):
+    """
+    Fit SVM for a specific user, pass all articles though it and store the results. Small
+    libraries are scored by their centroid instead, see `helper_fit_centroid`.
 
-    return redirect(view_library)
+    :param X: TF-IDF matrix of the articles, loaded if not given
+    :param force: also fit if the library did not change since the last fit
+    :return: whether the recommender was fitted
+    """
+    t0 = time.time()
+    library = helper_library_to_fit(user, force)
+    if library is None:
+        return False
+
+    ids, fingerprint = library
+    if helper_use_centroid(ids):
+        if not helper_fit_centroid(user, ids, fingerprint):
+            return False
+    else:
+        if X is None:
+            X = helper_load_tfidf()
+        coef, intercept, saved = helper_fit_svm(df_theta, ids, X)
+        scores = X.dot(coef) + intercept
+        index = df_theta.index.to_numpy(np.int64)
+        helper_dump_recommends(user, scores, index, saved, fingerprint, (coef, intercept))
+    t1 = time.time()
+    log.info(f"Fitting took {t1 - t0} s")
+    return True
 
 
-def helper_fit_recommender(df_theta, user):
+def helper_library_to_fit(user, force=False):
     """
-    Fit SVM for a specific user, pass all articles though it and store the results
+    Sorted ids of the saved articles of the user and their fingerprint, None if there is nothing
+    to fit
 
-    Inspired by
-    https://github.com/karpathy/arxiv-sanity-preserver/blob/master/buildsvm.py
+    :param force: also return the library if it did not change since the last fit
     """
-    t0 = time.time()
-    ids = [article.id for article in user.articles.order_by("id")]
+    ids = list(user.articles.order_by("id").values_list("id", flat=True))
     log.info(f"Saved Articles for {user}: {ids}")
     if len(ids) == 0:
         log.info("Can not fit without articles.")
-        return
+        return None
+
+    library = helper_library_fingerprint(ids)
+    if not force and Recommendation.objects.filter(user=user, library=library).exists():
+        log.info(f"Library of {user} did not change since the last fit")
+        return None
+    return ids, library
+
+
+def helper_fit_svm(df_theta, ids, X):
+    """
+    Fit SVM separating the saved articles from all others, returns its coefficients, its
+    intercept and the mask of the saved rows
+
+    Inspired by
+    https://github.com/karpathy/arxiv-sanity-preserver/blob/master/buildsvm.py
+    """
+    # importing sklearn takes a second, so only processes fitting recommenders pay for it
+    from sklearn import svm
 
     saved = df_theta.index.isin(ids)
     log.info(saved.sum())
     y = np.array(saved).astype(np.uint8)
-    X = helper_load_tfidf()
     log.info(X.shape)
     log.info(y.shape)
     clf = svm.LinearSVC(class_weight="balanced", verbose=False, max_iter=10000, tol=1e-6, C=0.1)
     clf.fit(X, y)
+    return clf.coef_[0], clf.intercept_[0], saved
 
-    scores = clf.decision_function(X)
-    helper_dump_recommends(user, scores)
-    t1 = time.time()
-    log.info(f"Fitting took {t1 - t0} s")
+
+def helper_use_centroid(ids):
+    """
+    Whether the library is small enough to be scored by its centroid
+    """
+    return len(ids) <= getattr(settings, "SWORM_RECOMMEND_CENTROID_MAX", 5)
+
+
+def helper_tfidf():
+    """
+    Article id of each row, TF-IDF matrix and norm of each row, memory-mapped from the data store,
+    so that the workers share them instead of unpickling the matrix each
+    """
+    dataset = get_dataset()
+
+    def load():
+        table = dataset.store["tfidf"]
+        return np.asarray(table["id"]), tfidf_matrix(table), np.asarray(table["norm"])
+
+    return dataset.cached("tfidf rows", load)
 
 
-def helper_dump_recommends(user, scores):
+def helper_fit_centroid(user, ids, library=""):
+    """
+    Score the articles by the cosine similarity of their TF-IDF rows to the centroid of the
+    normalized rows of the saved articles and store the results. There is nothing to train and
+    only the saved rows are read besides scoring the mapped matrix, so this is fast enough to run
+    inside a request.
+
+    :return: whether the results were stored, there is no centroid if none of the saved articles
+        are in the dataset
+    """
+    row_ids, X, norms = helper_tfidf()
+    saved = np.isin(row_ids, ids)
+    rows = np.flatnonzero(saved)
+    if len(rows) == 0:
+        log.warning(f"None of the saved articles of {user} are in the dataset")
+        return False
+
+    norms = np.where(norms > 0, norms, 1.0)
+    centroid = np.asarray(X[rows].multiply(1.0 / norms[rows, None]).mean(axis=0)).ravel()
+    scores = X.dot(centroid) / norms / max(np.linalg.norm(centroid), 1e-12)
+    # no model is stored, so incremental updates score the centroid again
+    helper_dump_recommends(user, scores, row_ids, saved, library)
+    return True
+
+
+def helper_fit_small_library(user, ids):
+    """
+    Score a library small enough by its centroid right away, see `helper_use_centroid`. A fit is
+    queued instead if there is no centroid.
+
+    :param ids: sorted ids of the saved articles
+    :return: whether the library was small enough, otherwise it needs a fit
+    """
+    if not ids or not helper_use_centroid(ids):
+        return False
+    if not helper_fit_centroid(user, ids, helper_library_fingerprint(ids)):
+        enqueue_training(user)
+    return True
+
+
+def helper_library_fingerprint(ids):
+    """
+    Fingerprint of the sorted ids of saved articles and of the dataset version
+    """
+    digest = hashlib.sha1(str(get_dataset().version).encode())
+    digest.update(np.asarray(ids, dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+
+def helper_top_rows(scores, k):
+    """
+    Rows of the k highest scores in descending order
+    """
+    k = min(k, len(scores))
+    if k == 0:
+        return np.zeros(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def helper_dump_recommends(user, scores, ids, saved, library="", model=None, updates=0):
+    """
+    Store the top `SWORM_RECOMMEND_TOP_K` articles the user has not saved
+
+    :param ids: article id of each row of the scores
+    :param saved: boolean mask of the rows of saved articles
+    :param library: fingerprint of the library, see `helper_library_fingerprint`
+    :param model: coefficients and intercept of the linear model the scores come from
+    :param updates: number of incremental updates of the model since it was fitted
+    """
+    unsaved = np.flatnonzero(~saved)
+    top = unsaved[helper_top_rows(scores[unsaved], recommend_top_k())]
+    helper_store_recommends(user, ids[top], scores[top], library, model, updates)
+
+
+def helper_store_recommends(user, ids, scores, library="", model=None, updates=0):
+    """
+    Store the recommended articles of the user, see `helper_dump_recommends`
+
+    :param ids: ids of the recommended articles in descending order of their scores
+    """
+    coef, intercept = model if model is not None else (np.zeros(0), 0.0)
+    log.info(f"Storing {len(ids)} recommendations for {user}")
+    Recommendation.objects.update_or_create(
+        user=user,
+        defaults={
+            "ids": np.asarray(ids, dtype=np.int64).tobytes(),
+            "scores": np.asarray(scores, dtype=np.float32).tobytes(),
+            "library": library,
+            "coef": np.asarray(coef, dtype=np.float32).tobytes(),
+            "intercept": float(intercept),
+            "updates": updates,
+        },
+    )
+
+
+def helper_migrate_legacy_scores(user):
+    """
+    Store the top articles of the scores of the whole corpus that fitting used to pickle per user
+    as recommendation of the user, returns it or None if there are no scores. The pickle is
+    removed once it is stored.
+    """
     path = join(data_dir, "svm", f"{user.id}-scores.pkl")
-    with open(path, "wb") as f:
-        log.info(f"Writing recommender scores for {user} to {path}")
-        pickle.dump(scores, f)
+    if not exists(path):
+        return None
+
+    with open(path, "rb") as f:
+        log.info(f"Migrating scores from {path}")
+        scores = np.asarray(pickle.load(f))
+    ids = helper_score_ids()
+    if len(scores) != len(ids):
+        log.warning(f"Scores in {path} do not match the dataset, the recommender needs a refit")
+        enqueue_training(user)
+        return None
+
+    saved = np.isin(ids, list(user.articles.values_list("id", flat=True)))
+    # no library fingerprint, so that the next fit replaces them
+    helper_dump_recommends(user, scores, ids, saved)
+    os.remove(path)
+    return Recommendation.objects.get(user=user)
+
+
+def helper_update_recommender(df_theta, user, changes, X):
+    """
+    Update the recommender of the user after saving or removing articles, instead of fitting it
+    again, see `sworm.training.enqueue_update`. Small libraries are scored by their centroid
+    again. Otherwise the stored model takes one passive-aggressive step per change towards
+    classifying the article as saved or not, then the corpus is scored again. A full fit is
+    queued after `SWORM_RECOMMEND_MAX_UPDATES` updates.
+
+    :param changes: ids of the articles and whether they were saved, in the order they changed
+    """
+    t0 = time.perf_counter()
+    ids = list(user.articles.order_by("id").values_list("id", flat=True))
+    if helper_fit_small_library(user, ids):
+        log.info(f"Updating the centroid of {user} took {time.perf_counter() - t0} s")
+        return
+
+    recommendation = Recommendation.objects.filter(user=user).first()
+    if recommendation is None:
+        # nothing to update before the first fit
+        return
+    if not recommendation.coef:
+        # the library outgrew the centroid
+        enqueue_training(user)
+        return
+
+    rows = df_theta.index.get_indexer([id for id, _ in changes])
+    coef = np.frombuffer(recommendation.coef, np.float32).astype(np.float64)
+    if (rows < 0).any() or len(coef) != X.shape[1]:
+        # the model belongs to another version of the dataset
+        enqueue_training(user)
+        return
+
+    intercept = recommendation.intercept
+    for row, (_, saved) in zip(rows, changes):
+        x = X[row]
+        y = 1.0 if saved else -1.0
+        loss = max(0.0, 1.0 - y * (x.dot(coef)[0] + intercept))
+        if loss > 0:
+            step = y * min(1.0, loss / (x.multiply(x).sum() + 1.0))
+            coef += step * x.toarray()[0]
+            intercept += step
+
+    updates = recommendation.updates + len(changes)
+    if updates >= getattr(settings, "SWORM_RECOMMEND_MAX_UPDATES", 20):
+        enqueue_training(user)
+        # counted again from the queued fit, so that further updates do not queue fits
+        updates = 0
+    helper_dump_recommends(
+        user,
+        X.dot(coef) + intercept,
+        df_theta.index.to_numpy(np.int64),
+        df_theta.index.isin(ids),
+        recommendation.library,
+        (coef, intercept),
+        updates,
+    )
+    log.info(f"Updating the recommender of {user} took {time.perf_counter() - t0} s")
+
+
+def helper_queue_update(user, id, saved):
+    """
+    Queue updating the recommender of the user, see `sworm.training.enqueue_update`. The article
+    was saved or removed already, so failing to queue is only logged.
+    """
+    try:
+        enqueue_update(user, id, saved)
+    except Exception as e:
+        log.exception(e)
 
 
 def view_impress(request):
     return render(request, "imprint.html", {"active": "imprint"})
 
 
-def view_map(request):
+def helper_parse_search_query(params):
     """
-    Create the bokeh map and return required elements
+    Text and page of a search query, raises ValueError for a malformed page
     """
-    log.info("Loading data...")
-    t1 = time.perf_counter()
+    page = int(params.get("page", 1))
+    if page < 1:
+        raise ValueError(f"Illegal page {page}")
+    return params.get("q", "").strip(), page
 
-    d = df.copy()
-    d.index.rename("index", inplace=True)
-    d.index = d.reset_index()["index"].apply(lambda x: x.replace("SCOPUS_ID:", ""))
 
-    source = ColumnDataSource(d)
-    log.info(f"Loading took: {time.perf_counter() - t1} s")
-    t2 = time.perf_counter()
+def view_search(request):
+    """
+    Page of the articles matching the query by their title, abstract and authors
+    """
+    try:
+        text, page = helper_parse_search_query(request.GET)
+    except ValueError:
+        return HttpResponseBadRequest("Malformed search query")
 
-    color_mapper = map_create_color_mapper(topic_list)
-    hover = map_create_hover_tool()
+    result = search_articles(text, page)
+    return render(request, "search.html", {"query": text, "result": result, "active": "search"})
 
-    plot = figure(
-        plot_width=1800,
-        plot_height=1000,
-        tools=[hover, "pan", "wheel_zoom", "box_zoom", "reset", "save", "tap"],
-        title=None,
-        toolbar_location="above",
-    )
 
-    renderer = plot.scatter(
-        source=source,
-        x="x1",
-        y="x2",
-        size=5,
-        fill_color=color_mapper,
-        line_alpha=0.3,
-        line_color="gray",
-        legend_field="cluster",
-    )
+def endpoint_search(request):
+    """
+    Page of the articles matching the query as json, titles and snippets are html with the
+    matched terms in <mark> tags
+    """
+    try:
+        text, page = helper_parse_search_query(request.GET)
+        per_page = min(max(int(request.GET.get("n", 20)), 1), 100)
+    except ValueError:
+        return HttpResponseBadRequest("Malformed search query")
 
-    log.info(renderer)
+    return JsonResponse(search_articles(text, page, per_page))
 
-    div_info = Div(text="Click on an article for details.", height=150)
-    callback_selected = CustomJS(
-        args=dict(source=source, current_selection=div_info), code=cb.selected_code()
-    )
-    taptool = plot.select(type=TapTool)
-    taptool.callback = callback_selected
 
-    # other interactive components
+def endpoint_typeahead(request):
+    """
+    Most cited articles, authors and journals with a word starting with the query and the urls of
+    their pages, answered from memory
+    """
+    kind = request.GET.get("kind")
+    if kind is not None and kind not in KINDS:
+        return HttpResponseBadRequest(f"kind must be one of {', '.join(KINDS)}")
+    try:
+        k = min(max(int(request.GET.get("k", 10)), 1), 50)
+    except ValueError:
+        return HttpResponseBadRequest("k must be an integer")
+
+    suggestions = get_typeahead_index().suggest(request.GET.get("q", ""), k, kind)
+    # the index is built from the data store, which may hold rows the database does not have yet
+    existing = {}
+    for name, model in zip(KINDS, (Article, Author, Journal)):
+        refs = [suggestion["ref"] for suggestion in suggestions if suggestion["kind"] == name]
+        if refs:
+            existing[name] = {
+                str(pk) for pk in model.objects.filter(pk__in=refs).values_list("pk", flat=True)
+            }
+    suggestions = [
+        suggestion
+        for suggestion in suggestions
+        if suggestion["ref"] in existing.get(suggestion["kind"], ())
+    ]
+    for suggestion in suggestions:
+        # the url names are the kinds
+        suggestion["url"] = reverse(suggestion["kind"], args=[suggestion["ref"]])
+    return JsonResponse({"suggestions": suggestions})
+
+
+def endpoint_ready(request):
+    """
+    Readiness probe for the load balancer, answers 503 until the data of this process is loaded.
+    The first probe starts loading it in the background.
+    """
+    state = warmup_status()
+    if state["status"] != "ready":
+        start_warmup()
+        return JsonResponse(state, status=503)
+    return JsonResponse({**state, "version": get_dataset().version})
 
-    input_callback = cb.input_callback(source)
 
-    text_search = TextInput(title="Search:")
-    text_search.js_on_change("value", input_callback)
+def _map_etag(request):
+    # the navigation bar shows the logged in user, so every user gets their own entity tag
+    return f"{get_map_document()['key']}-{request.user.pk or 0}"
 
-    text_cout_label = Div(text="Displayed Documents:", height=25)
-    text_count = Div(text=f"{len(df)}", height=25)
 
-    date_range_slider = DateRangeSlider(
-        title="Publication Date",
-        value=(date(1959, 1, 1), date(2021, 9, 1)),
-        start=date(1959, 1, 1),
-        end=date(2021, 9, 1),
-        step=1,
-    )
+def _map_last_modified(request):
+    return datetime.fromtimestamp(get_map_document()["last_modified"], tz=timezone.utc)
 
-    date_range_slider.js_on_change("value", input_callback)
 
-    citation_count_slider = RangeSlider(
-        title="Citation Count",
-        value=(0, df["citations"].max()),
-        start=0,
-        end=df["citations"].max(),
-        step=1,
-    )
-    citation_count_slider.js_on_change("value", input_callback)
-
-    journal_choice = MultiSelect(value=journal_list, options=journal_list, size=25)
-    journal_choice.js_on_change("value", input_callback)
-
-    topic_choice = MultiSelect(value=topic_list, options=topic_list, size=25)
-    topic_choice.js_on_change("value", input_callback)
-
-    country_choice = MultiSelect(value=country_list, options=country_list, size=25)
-    country_choice.js_on_change("value", input_callback)
-
-    # pass call back arguments
-    input_callback.args["text_search"] = text_search
-    input_callback.args["date_range_slider"] = date_range_slider
-    input_callback.args["journal_choice"] = journal_choice
-    input_callback.args["text_count"] = text_count
-    input_callback.args["topic_choice"] = topic_choice
-    input_callback.args["citation_count_slider"] = citation_count_slider
-    input_callback.args["country_choice"] = country_choice
-
-    # non interactive components
-    # title = Div(text="<h1>SWORM - Social Work Research Map</h1>")
-    filter_title = Div(text="<h2>Filter</h2>")
-    selection_title = Div(text="<h2>Selection</h2>")
-
-    # styling
-    plot.sizing_mode = "scale_both"
-    plot.margin = 5
-    plot.legend.visible = True
-    plot.legend.spacing = -7
-    plot.legend.label_text_font_size = "10px"
-    # plot.legend.orientation = "horizontal"
-    # plot.legend.location = "top_center"
-
-    plot.toolbar.autohide = True
-    # plot.legend.click_policy="hide"
-    plot.add_layout(plot.legend[0], "right")
-    plot.toolbar.logo = None
-
-    # layout
-    info_column = column([selection_title, div_info])
-
-    journal_pane = Panel(child=journal_choice, title="Journals")
-    topic_pane = Panel(child=topic_choice, title="Topics")
-    country_pane = Panel(child=country_choice, title="Countries")
-    tab = Tabs(tabs=[journal_pane, topic_pane, country_pane])
-
-    filter_column = column(
-        [
-            filter_title,
-            row([text_cout_label, text_count]),
-            text_search,
-            date_range_slider,
-            citation_count_slider,
-            tab,
-        ]
+@condition(etag_func=_map_etag, last_modified_func=_map_last_modified)
+def view_map(request):
+    """
+    Serve the bokeh map, the document itself is built once per dataset version
+    """
+    document = get_map_document()
+    response = render(
+        request,
+        "map.html",
+        {"script": document["script"], "div": document["div"], "active": "map"},
     )
+    # let browsers revalidate with the entity tag instead of downloading the document again, the
+    # page differs per session
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ["Cookie"])
+    return response
+
+
+def _map_data_etag(request, *args, **kwargs):
+    # the data loaded by the map changes with the dataset, like the map document itself
+    return map_cache_key()
+
+
+# fields of the article data frame sent by endpoint_map_article
+MAP_DETAIL_COLUMNS = [
+    "title",
+    "date",
+    "author",
+    "topics",
+    "journal",
+    "citations",
+    "country",
+    "doi",
+    "abstract",
+]
+
+
+@cache_control(no_cache=True)
+@condition(etag_func=_map_data_etag)
+def endpoint_map_article(request, id):
+    """
+    Details of a single article, loaded by the map on hover and selection
+    """
+    dataset = get_dataset()
+    try:
+        row = dataset.df.index.get_loc(id)
+    except KeyError:
+        raise Http404(f"Article with id '{id}' does not exist")
 
-    content = row([filter_column, plot, info_column])
-    layout = column([content], name="main")
-    layout.sizing_mode = "scale_both"
+    details = {"id": id}
+    for column in MAP_DETAIL_COLUMNS:
+        value = dataset.articles[column][row]
+        if pd.isna(value):
+            value = ""
+        elif column == "date":
+            value = pd.Timestamp(value).strftime("%d.%m.%Y")
+        details[column] = value.item() if isinstance(value, np.generic) else value
 
-    log.info(f"Creating document took {time.perf_counter() - t2} s")
-    t3 = time.perf_counter()
+    return JsonResponse(details)
 
-    log.info(f"Finished:  {time.perf_counter() - t3} s")
 
-    script, div = components(layout)
+def helper_parse_filter_query(params):
+    """
+    Read the filters of the map from the query parameters. Facets are given as comma separated
+    codes and left out when they are not restricted, ranges as `<name>_from` and `<name>_to`.
+    """
+    selected = {}
+    for facet in ("journal", "topic", "country"):
+        if facet in params:
+            value = params[facet]
+            selected[facet] = [int(code) for code in value.split(",")] if value else []
 
-    return render(request, "map.html", {"script": script, "div": div, "active": "map"})
+    ranges = {}
+    for name in ("date", "citations"):
+        if f"{name}_from" in params and f"{name}_to" in params:
+            ranges[name] = (float(params[f"{name}_from"]), float(params[f"{name}_to"]))
+
+    return selected, ranges, params.get("q", "")
+
+
+@cache_control(no_cache=True)
+@condition(etag_func=_map_data_etag)
+def endpoint_map_filter(request):
+    """
+    Rows of the map matching the filters as packed bit mask, and the number of matching rows per
+    journal, topic and country. The mask is left out for `mask=0`.
+    """
+    try:
+        selected, ranges, key = helper_parse_filter_query(request.GET)
+    except ValueError:
+        return HttpResponseBadRequest("Malformed filter query")
+
+    result = get_filter_index().query(selected, ranges, key)
+
+    response = {
+        "count": result["count"],
+        "counts": {name: counts.tolist() for name, counts in result["counts"].items()},
+    }
+    if request.GET.get("mask") != "0":
+        response["mask"] = encode_mask(result["mask"])
+    return JsonResponse(response)
+
+
+@cache_control(no_cache=True)
+@condition(etag_func=_map_data_etag)
+def endpoint_map_tile(request, z, x, y):
+    """
+    Points of a tile of the level of detail map, restricted to the rows matching the filters
+    """
+    try:
+        selected, ranges, key = helper_parse_filter_query(request.GET)
+        mask = get_filter_index().row_mask(selected, ranges, key)
+        rows = get_tile_index().tile_rows(z, x, y, mask)
+    except ValueError:
+        return HttpResponseBadRequest("Malformed tile query")
+
+    # the filter index holds the topic codes of all rows
+    topic_codes = get_filter_index().facets["topic"].codes
+    data = tile_data(get_dataset().df, rows, topic_codes)
+    return JsonResponse({column: values.tolist() for column, values in data.items()})
+
+
+@cache_control(no_cache=True)
+@condition(etag_func=_map_data_etag)
+def endpoint_map_density(request):
+    """
+    Density image of the rows matching the filters, colored by topic for `topics=1`
+    """
+    try:
+        selected, ranges, key = helper_parse_filter_query(request.GET)
+        resolution = int(request.GET.get("resolution", DENSITY_RESOLUTIONS[0]))
+    except ValueError:
+        return HttpResponseBadRequest("Malformed density query")
+    if resolution not in DENSITY_RESOLUTIONS:
+        return HttpResponseBadRequest(f"Resolution must be one of {DENSITY_RESOLUTIONS}")
+
+    grid = get_density_grid()
+    mask = get_filter_index().row_mask(selected, ranges, key)
+    image = grid.render(resolution, mask, by_topic=request.GET.get("topics") == "1")
+    x_min, x_max, y_min, y_max = grid.bounds.tolist()
+
+    return JsonResponse(
+        {
+            "image": encode_image(image),
+            "width": resolution,
+            "height": resolution,
+            "x": x_min,
+            "y": y_min,
+            "dw": x_max - x_min,
+            "dh": y_max - y_min,
+        }
+    )
 
 
 @login_required
 def view_library(request):
-    articles = request.user.articles.order_by("id")
+    articles = request.user.articles.select_related("journal").order_by("id")
 
     recommended_articles = helper_get_recommends(request.user)
+    training_job = request.user.training_jobs.order_by("-created_on").first()
+    recommendation = getattr(request.user, "recommendation", None)
 
     template_params = {
         "articles": articles,
         "active": "library",
         "recommended": recommended_articles,
+        "training_job": training_job,
+        "recommended_on": recommendation.updated_on if recommendation else None,
     }
     return render(request, "library.html", template_params)
 
 
 def helper_get_recommends(user, n=10):
     """
-    Load article scores from file, select top n results, find their scopus ids and return
-    matching entries from the database
+    Return the entries of the top n recommended articles the user has not saved, read from the
+    top articles stored when fitting. A fit is queued when articles saved since then leave fewer
+    than n of them.
     """
-    data_dir = join(abspath(join(dirname(__file__), "..")), "data")
-
-    path = join(data_dir, "svm", f"{user.id}-scores.pkl")
-    # newly registered users will not have recommendations
-    if not exists(path):
-        return []
-
-    with open(path, "rb") as f:
-        log.info(f"Loading scores from {path}")
-        scores = pickle.load(f)
-
-    # FIXME: this will lead to too few results in some cases
-    top_indexes = np.argsort(scores)[::-1][:100]
-    log.info(f"Top indices: {top_indexes}")
-    log.info(f"Top scores: {scores[top_indexes]}")
-
-    # read thetas from disk, get ids of top x articles
-    path = join(data_dir, "django-theta.pkl")
-    df_theta = pd.read_pickle(path)
-    df_theta.reset_index(inplace=True)
-    # TODO: we should not have to do this each time
-    index = df_theta["index"].apply(lambda x: x.replace("SCOPUS_ID:", ""))
-    top_ids = index[top_indexes]
-
-    recommended_articles = []
-    saved_articles = user.articles.order_by("id")
-
-    for id in top_ids:
-        recommendation = Article.objects.get(id=id)
-        if recommendation in saved_articles:
-            continue
+    try:
+        recommendation = user.recommendation
+    except Recommendation.DoesNotExist:
+        recommendation = helper_migrate_legacy_scores(user)
+        if recommendation is None:
+            # newly registered users will not have recommendations
+            return []
+
+    # articles saved after fitting are excluded here
+    saved = sorted(user.articles.values_list("id", flat=True))
+    stored = np.frombuffer(recommendation.ids, np.int64)
+    excluded = set(saved)
+    candidates = [int(id) for id in stored if id not in excluded]
+
+    found = Article.objects.select_related("journal").in_bulk(candidates)
+    recommended = [found[id] for id in candidates if id in found][:n]
+
+    # fewer stored articles than the top k means there are no more articles to recommend
+    if (
+        len(recommended) < n
+        and len(stored) >= recommend_top_k()
+        and recommendation.library != helper_library_fingerprint(saved)
+    ):
+        log.info(f"Recommendations of {user} ran out, queueing a fit")
+        enqueue_training(user)
+    return recommended
 
-        recommended_articles.append(recommendation)
-        if len(recommended_articles) == n:
-            break
 
-    return recommended_articles
+@login_required
+def endpoint_library_similar(request):
+    """
+    Articles similar to the library of the user as a whole, by the approximate nearest neighbors
+    of the mean of their topic vectors
+    """
+    try:
+        k = min(max(int(request.GET.get("k", 10)), 1), 100)
+    except ValueError:
+        return HttpResponseBadRequest("k must be an integer")
+
+    saved = list(request.user.articles.values_list("id", flat=True))
+    ids, scores = get_ann_index().similar(saved, k)
+    found = Article.objects.select_related("journal").in_bulk([int(id) for id in ids])
+    articles = [
+        {
+            "id": int(id),
+            "title": found[id].title,
+            "journal": found[id].journal.name,
+            "score": float(score),
+        }
+        for id, score in zip(ids, scores)
+        if id in found
+    ]
+    return JsonResponse({"articles": articles})
 
 
 @login_required
@@ -383,6 +762,7 @@ def endpoint_save_article(request, id):
     try:
         art = Article.objects.get(id=id)
         request.user.articles.add(art)
+        helper_queue_update(request.user, art.id, saved=True)
     except Article.DoesNotExist:
         log.error(f"Article with id '{id}' does not exist")
 
@@ -394,6 +774,7 @@ def endpoint_unsave_article(request, id):
     try:
         art = Article.objects.get(id=id)
         request.user.articles.remove(art)
+        helper_queue_update(request.user, art.id, saved=False)
     except Article.DoesNotExist:
         log.error(f"Article with id '{id}' does not exist")
 
@@ -403,99 +784,16 @@ def endpoint_unsave_article(request, id):
 @login_required
 def endpoint_populate_db(request):
     """
-    Populate database with data from Pandas Dataframe
+    Point to `manage.py import_corpus`, importing takes too long to run inside a request
     """
 
     if not request.user.is_superuser:
         log.error("import_articles(): Illegal Access")
         return render(request, "library.html")
 
-    path = join(data_dir, "django-data.pkl")
-    log.info(f"Loading data from {path}")
-    local_df = pd.read_pickle(path)
-    log.info(df.columns)
-
-    # add all authors
-    idx = ~(df["author"].isna() | df["author-id"].isna())
-    author_name_map = {}
-    for _, (author_names, author_ids) in df[idx][["author", "author-id"]].iterrows():
-        # TODO: change export formaty
-        # convert
-        author_names = author_names.split(",")
-        author_names = [name.strip() for name in author_names]
-
-        log.info(author_ids)
-        author_ids = [int(ident) for ident in author_ids]
-
-        for author_name, author_id in zip(author_names, author_ids):
-            if author_id in author_name_map:
-                actual_name = author_name_map[author_id]
-                if actual_name != author_name:
-                    log.warning(
-                        f"Wrong author name mapping: {author_id} -> '{author_name}' but is '{actual_name}'"
-                    )
-            else:
-                author_name_map[author_id] = author_name
-                log.info(f"Author Name {author_id} -> {author_name}")
-                author = Author.objects.create(id=author_id, name=author_name)
-                author.save()
-
-    # add all journals
-    issns = local_df["journal-issn"].unique()
-    log.info(f"Found {len(issns)} issns")
-    for issn in issns:
-        if type(issn) is not str:
-            log.error(f"Found broken issn {issn}")
-            return redirect(view_library)
-
-        names = local_df[local_df["journal-issn"] == issn]["journal"].unique()
-        log.info(f"Journal Name {issn} -> {names}")
-        assert len(names == 1)
-        Journal.objects.create(issn=issn, name=names[0])
-
-    # create countries
-    countries = local_df["country"].unique()
-    for country in countries:
-        Country.objects.create(name=country)
-
-    # add all articles
-    for n, (index, article) in enumerate(local_df.iterrows()):
-        log.info(f"Entry {index}: {n/len(local_df):.2%}")
-
-        # date = datetime.datetime.strptime(article["date"], '%d.%m.%Y')
-        ident = index.replace("SCOPUS_ID:", "")
-
-        try:
-            journal = Journal.objects.get(issn=article["journal-issn"])
-            country = Country.objects.get(name=article["country"])
-
-            entry = Article.objects.create(
-                id=ident,
-                title=article["title"],
-                abstract=article["abstract"],
-                publish_on=article["date"],
-                lda_topics=article["topics"],
-                journal=journal,
-                citations=article["citations"],
-                country=country,
-                doi=article["doi"],
-                x1=article["x1"],
-                x2=article["x2"],
-            )
-
-            entry.save()
-
-            authors = article["author-id"]
-            if type(authors) is list:
-                authors = [int(ident) for ident in authors]
-                for ident in authors:
-                    author = Author.objects.get(id=ident)
-                    log.info(f"Adding author: {author}")
-                    entry.authors.add(author)
-            entry.save()
-
-        except Journal.DoesNotExist:
-            log.error(f"Missing Journal with issn: {article['journal-issn']}")
-
-    log.warning("Import finished.")
-    return redirect(view_library)
+    return HttpResponse(
+        "Import the articles of the current snapshot on the server with\n\n"
+        "    python manage.py import_corpus\n\n"
+        "An import that stopped is resumed, see python manage.py import_corpus --help.\n",
+        content_type="text/plain",
+    )
@@ -0,0 +1,132 @@
+"""
+Loading of the dataset and of the indexes derived from it ahead of the first requests, and
+swapping to new dataset snapshots in the background.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from sworm.ann import get_ann_index
+from sworm.bokeh_data import Dataset, get_dataset, is_loaded, set_dataset, use_dataset
+from sworm.data_store import current_snapshot, open_store, source_version
+from sworm.map_cache import get_map_document
+from sworm.map_density import get_density_grid, use_density
+from sworm.map_filter import get_filter_index
+from sworm.map_search import get_search_index
+from sworm.map_tiles import get_tile_index, use_tiles
+from sworm.typeahead import get_typeahead_index
+
+log = logging.getLogger(__name__)
+
+# warm up state of this process, one of cold, warming, ready and failed
+_state = {"status": "cold", "error": None}
+_lock = threading.Lock()
+
+# time of the last check for a new snapshot and the version swapped to last
+_update = {"checked": 0.0, "version": None}
+
+
+def warmup(dataset=None):
+    """
+    Load the dataset and read or build everything the map needs, returns the seconds each step
+    took
+
+    :param dataset: `sworm.bokeh_data.Dataset` to warm up, the current one by default
+    """
+    t0 = time.perf_counter()
+    dataset = dataset or get_dataset()
+    timings = {"dataset": time.perf_counter() - t0}
+    with use_dataset(dataset):
+        timings.update(_warmup_indexes())
+
+    _state.update(status="ready", error=None)
+    return timings
+
+
+def _warmup_indexes():
+    steps = [
+        ("filter index", get_filter_index),
+        ("search index", get_search_index),
+        ("typeahead index", get_typeahead_index),
+        ("tile index", lambda: use_tiles(len(get_dataset().df)) and get_tile_index()),
+        ("density grid", lambda: use_density(len(get_dataset().df)) and get_density_grid()),
+        ("map document", get_map_document),
+        ("ann index", get_ann_index),
+    ]
+    timings = {}
+    for name, step in steps:
+        t0 = time.perf_counter()
+        step()
+        timings[name] = time.perf_counter() - t0
+        log.info(f"Warming up {name} took {timings[name]} s")
+    return timings
+
+
+def try_warmup():
+    """
+    Warm up, a failure is logged and reported by `warmup_status` instead of raised. The next
+    `start_warmup` tries again.
+    """
+    try:
+        warmup()
+    except Exception as e:
+        log.exception(e)
+        _state.update(status="failed", error=str(e))
+
+
+def start_warmup():
+    """
+    Warm up in a background thread, unless this process is warm or warming up already
+    """
+    with _lock:
+        if _state["status"] in ("warming", "ready"):
+            return
+        _state["status"] = "warming"
+    threading.Thread(target=try_warmup, daemon=True).start()
+
+
+def warmup_status():
+    return dict(_state)
+
+
+def _swap(snapshot):
+    try:
+        t0 = time.perf_counter()
+        dataset = Dataset(open_store(snapshot))
+        warmup(dataset)
+        set_dataset(dataset)
+        log.info(f"Swapped to dataset {dataset.version} after {time.perf_counter() - t0} s")
+    except Exception as e:
+        # not retried until the snapshot changes again
+        log.exception(e)
+
+
+def check_for_update():
+    """
+    Swap to the snapshot `data/current` points to in a background thread, if it differs from the
+    loaded one. Checks at most once every `SWORM_DATASET_CHECK_INTERVAL` seconds, so it is cheap
+    enough to call on every request. Requests keep using the old dataset until it is replaced.
+    """
+    interval = getattr(settings, "SWORM_DATASET_CHECK_INTERVAL", 1)
+    now = time.monotonic()
+    if not is_loaded() or now - _update["checked"] < interval:
+        return
+    _update["checked"] = now
+
+    snapshot = current_snapshot()
+    try:
+        version, _ = source_version(snapshot)
+    except OSError:
+        # the pickles are being replaced, check again later
+        return
+    if version == get_dataset().version:
+        return
+
+    with _lock:
+        if version == _update["version"]:
+            return
+        _update["version"] = version
+    log.info(f"Found dataset {version} in {snapshot}, swapping in the background")
+    threading.Thread(target=_swap, args=(snapshot,), daemon=True).start()